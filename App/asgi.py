@@ -15,6 +15,7 @@ from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 
 import chat.routing
+from chat.lifespan import LifespanApp
 
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'App.settings')
@@ -26,5 +27,6 @@ application = ProtocolTypeRouter({
             chat.routing.websocket_urlpatterns
         )
     ),
+    "lifespan": LifespanApp(),
 })
 
@@ -44,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.metrics.MetricsMiddleware',
+    'chat.tracing.TracingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,12 +79,48 @@ WSGI_APPLICATION = 'App.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Threads that run database work for the WebSocket consumers (see chat/db.py).
+CHAT_DB_THREADS = int(os.environ.get('CHAT_DB_THREADS', min(32, (os.cpu_count() or 1) + 4)))
+# Pooled connections beyond CHAT_DB_THREADS, for HTTP requests and background flushes.
+DB_POOL_EXTRA = int(os.environ.get('DB_POOL_EXTRA', 8))
+
+if os.environ.get('DATABASE_ENGINE', 'sqlite') == 'postgres':
+    # Needs psycopg with its pool extra: pip install 'psycopg[binary,pool]'.
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'chat'),
+            'USER': os.environ.get('POSTGRES_USER', 'chat'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Pooled connections must not also be persistent.
+            'CONN_MAX_AGE': 0,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', 2)),
+                    'max_size': CHAT_DB_THREADS + DB_POOL_EXTRA,
+                    'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+                },
+            },
+        }
+    }
+else:
+    # Local development. WAL lets readers run alongside the writer; IMMEDIATE
+    # transactions queue for the write lock instead of failing with "database is locked".
+    # Connections are kept open, so each database thread connects once rather than per call.
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': None,
+            'OPTIONS': {
+                'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 20,
+            },
+        }
     }
-}
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -126,11 +164,30 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
 ASGI_APPLICATION = "App.asgi.application"
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379')
+# Comma-separated Redis URLs for the channel layer; groups and sockets are spread over them.
+CHANNEL_LAYER_URLS = [url for url in os.environ.get('CHANNEL_LAYER_URLS', REDIS_URL).split(',') if url]
+# Sub-groups per chat/presence group, so very large groups are spread over several keys and hosts.
+CHAT_GROUP_SHARDS = int(os.environ.get('CHAT_GROUP_SHARDS', 1))
+# Join each group once per worker process and fan out to local sockets in memory.
+CHAT_LOCAL_FANOUT = os.environ.get('CHAT_LOCAL_FANOUT', '1') == '1'
+# Messages the fan-out hub's layer channel may queue before group sends to it are dropped.
+# It carries all of a worker's group traffic, so it gets more than the layer's default of 100.
+CHAT_FANOUT_CHANNEL_CAPACITY = int(os.environ.get('CHAT_FANOUT_CHANNEL_CAPACITY', 1000))
+# Messages queued for one slow socket before the oldest are dropped.
+CHAT_FANOUT_MAX_BACKLOG = int(os.environ.get('CHAT_FANOUT_MAX_BACKLOG', 1000))
+# Seconds between renewals of the worker's group memberships, which the layer expires after a day.
+CHAT_FANOUT_REFRESH_INTERVAL = float(os.environ.get('CHAT_FANOUT_REFRESH_INTERVAL', 3600))
+# Upper bound on pooled Redis connections per worker process, shared by all consumers.
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
+# Seconds to wait for a free pooled connection before failing.
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', 5))
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
-            "hosts": [("127.0.0.1", 6379)],
+            "hosts": CHANNEL_LAYER_URLS,
+            "channel_capacity": {"fanout.*": CHAT_FANOUT_CHANNEL_CAPACITY},
         },
     },
     # "default": {
@@ -138,7 +195,68 @@ CHANNEL_LAYERS = {
     # }
 }
 SECURE_SSL_REDIRECT = True
+# Prometheus usually scrapes over plain HTTP inside the cluster.
+SECURE_REDIRECT_EXEMPT = [r'^metrics$']
 SESSION_COOKIE_SECURE = True
 CSRF_COOKIE_SECURE = True
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 FERNET_KEY = os.environ['FERNET_KEY']
+# Comma-separated Fernet keys, newest first. Older keys only decrypt existing messages.
+FERNET_KEYS = [key for key in os.environ.get('FERNET_KEYS', FERNET_KEY).split(',') if key]
+# Key for the blind (HMAC) search index; when unset, derived from FERNET_KEY with HKDF.
+# Changing it requires `manage.py rebuild_search_index`.
+SEARCH_INDEX_KEY = os.environ.get('SEARCH_INDEX_KEY', '')
+# Threads used for message encryption; 0 runs it inline on the event loop.
+CHAT_CRYPTO_THREADS = int(os.environ.get('CHAT_CRYPTO_THREADS', 2))
+# Recently decrypted messages kept in memory per process.
+CHAT_PLAINTEXT_CACHE_SIZE = int(os.environ.get('CHAT_PLAINTEXT_CACHE_SIZE', 10000))
+# Persist chat messages through a per-process write-behind queue instead of one INSERT per message.
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', '0') == '1'
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('CHAT_WRITE_BEHIND_BATCH_SIZE', 100))
+CHAT_WRITE_BEHIND_INTERVAL = float(os.environ.get('CHAT_WRITE_BEHIND_INTERVAL', 0.5))
+# Failed flushes of one batch before unwritable rows are isolated and dropped, and the queue's size cap.
+CHAT_WRITE_BEHIND_MAX_RETRIES = int(os.environ.get('CHAT_WRITE_BEHIND_MAX_RETRIES', 5))
+CHAT_WRITE_BEHIND_MAX_PENDING = int(os.environ.get('CHAT_WRITE_BEHIND_MAX_PENDING', 10000))
+# Channel membership checks: in-process LRU in front of Redis.
+CHAT_MEMBERSHIP_CACHE_SIZE = int(os.environ.get('CHAT_MEMBERSHIP_CACHE_SIZE', 10000))
+CHAT_MEMBERSHIP_LOCAL_TTL = int(os.environ.get('CHAT_MEMBERSHIP_LOCAL_TTL', 5))
+CHAT_MEMBERSHIP_REDIS_TTL = int(os.environ.get('CHAT_MEMBERSHIP_REDIS_TTL', 300))
+# Presence changes are coalesced and broadcast at most once per interval (seconds) across all workers.
+PRESENCE_TICK_INTERVAL = float(os.environ.get('PRESENCE_TICK_INTERVAL', 1.0))
+# A presence connection expires unless its worker refreshes it within PRESENCE_TTL seconds.
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', 30))
+PRESENCE_HEARTBEAT_INTERVAL = int(os.environ.get('PRESENCE_HEARTBEAT_INTERVAL', 10))
+# Typing indicators expire after CHAT_TYPING_TTL seconds; a connection sends at most one start event per CHAT_TYPING_THROTTLE.
+CHAT_TYPING_TTL = float(os.environ.get('CHAT_TYPING_TTL', 5))
+CHAT_TYPING_THROTTLE = float(os.environ.get('CHAT_TYPING_THROTTLE', 2))
+# Seconds between batched writes of buffered read cursors to ChannelMembership.last_seen.
+CHAT_READ_STATE_FLUSH_INTERVAL = float(os.environ.get('CHAT_READ_STATE_FLUSH_INTERVAL', 10))
+# Sockets that negotiate a "+batch" subprotocol get events grouped into one frame per CHAT_BATCH_DELAY seconds.
+CHAT_BATCH_DELAY = float(os.environ.get('CHAT_BATCH_DELAY', 0.02))
+CHAT_BATCH_MAX_EVENTS = int(os.environ.get('CHAT_BATCH_MAX_EVENTS', 50))
+# Maximum operations accepted in one batched WebSocket frame; capped at the user and channel bursts below.
+CHAT_MAX_BATCH_OPERATIONS = int(os.environ.get('CHAT_MAX_BATCH_OPERATIONS', 100))
+# Token-bucket limits on chat writes: sustained rate per second and burst size, per user and per channel.
+CHAT_RATE_LIMIT = os.environ.get('CHAT_RATE_LIMIT', '1') == '1'
+CHAT_RATE_LIMIT_USER_RATE = float(os.environ.get('CHAT_RATE_LIMIT_USER_RATE', 5))
+CHAT_RATE_LIMIT_USER_BURST = int(os.environ.get('CHAT_RATE_LIMIT_USER_BURST', 30))
+CHAT_RATE_LIMIT_CHANNEL_RATE = float(os.environ.get('CHAT_RATE_LIMIT_CHANNEL_RATE', 100))
+CHAT_RATE_LIMIT_CHANNEL_BURST = int(os.environ.get('CHAT_RATE_LIMIT_CHANNEL_BURST', 300))
+# Consecutive rejected writes after which a socket is disconnected.
+CHAT_RATE_LIMIT_MAX_REJECTIONS = int(os.environ.get('CHAT_RATE_LIMIT_MAX_REJECTIONS', 50))
+# Newest messages kept per channel in Redis for reconnect replay, and the most replayed to one socket.
+CHAT_RECENT_MESSAGES = int(os.environ.get('CHAT_RECENT_MESSAGES', 1000))
+CHAT_REPLAY_LIMIT = int(os.environ.get('CHAT_REPLAY_LIMIT', 500))
+# A channel's recent-message buffer is dropped this many seconds after its last write.
+CHAT_RECENT_MESSAGES_TTL = int(os.environ.get('CHAT_RECENT_MESSAGES_TTL', 86400))
+# Messages older than this many days are moved to the archive by `manage.py archive_messages`.
+CHAT_ARCHIVE_AFTER_DAYS = int(os.environ.get('CHAT_ARCHIVE_AFTER_DAYS', 180))
+# Seconds between each process publishing its metrics for /metrics to aggregate.
+CHAT_METRICS_INTERVAL = float(os.environ.get('CHAT_METRICS_INTERVAL', 5))
+# If set, /metrics requires "Authorization: Bearer <token>".
+CHAT_METRICS_TOKEN = os.environ.get('CHAT_METRICS_TOKEN', '')
+# Tracing defaults until changed at runtime with `manage.py tracing`. Traces slower than the
+# threshold are logged by the chat.tracing logger; sample_rate is the fraction of work traced.
+CHAT_TRACING = os.environ.get('CHAT_TRACING', '0') == '1'
+CHAT_TRACING_THRESHOLD_MS = float(os.environ.get('CHAT_TRACING_THRESHOLD_MS', 250))
+CHAT_TRACING_SAMPLE_RATE = float(os.environ.get('CHAT_TRACING_SAMPLE_RATE', 1.0))
@@ -17,11 +17,12 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
-from chat.views import ChatRoomView
+from chat.views import ChatRoomView, MetricsView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('chat/', ChatRoomView.as_view(), name='chat-room'),
 
     path('api/', include('chat.urls')),
+    path('metrics', MetricsView.as_view(), name='metrics'),
 ]
@@ -1,4 +1,5 @@
 from .channel import *
 from .channel_membership import *
 from .message import *
+from .search import *
 from .team import *
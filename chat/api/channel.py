@@ -1,42 +1,53 @@
+from django.http import Http404
 from django.shortcuts import get_object_or_404
+from redis.exceptions import RedisError
 from rest_framework import status, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from chat.api.mixins import FlatRepresentationMixin
+from chat.membership import MEMBER, NO_CHANNEL, get_membership_cache
 from chat.models import Channel
-from chat.serializers import ChannelSerializer
+from chat.presence import get_presence_store
+from chat.serializers import ChannelSerializer, FlatChannelSerializer
 
 
-class ChannelListAPIView(APIView):
+class ChannelListAPIView(FlatRepresentationMixin, APIView):
     permission_classes = [permissions.IsAuthenticated]
+    model = Channel
+    serializer_class = ChannelSerializer
+    flat_serializer_class = FlatChannelSerializer
 
     def get(self, request):
-        channels = Channel.objects.all()
-        serializer = ChannelSerializer(channels, many=True)
+        channels = self.get_queryset()
+        serializer = self.get_serializer_class()(channels, many=True)
         return Response(serializer.data)
 
     def post(self, request):
-        serializer = ChannelSerializer(data=request.data)
+        serializer = self.get_serializer_class()(data=request.data)
         if serializer.is_valid():
             serializer.save(created_by=request.user)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class ChannelDetailAPIView(APIView):
+class ChannelDetailAPIView(FlatRepresentationMixin, APIView):
     permission_classes = [permissions.IsAuthenticated]
+    model = Channel
+    serializer_class = ChannelSerializer
+    flat_serializer_class = FlatChannelSerializer
 
     def get_object(self, pk):
-        return get_object_or_404(Channel, pk=pk)
+        return get_object_or_404(self.get_queryset(), pk=pk)
 
     def get(self, request, pk):
         channel = self.get_object(pk)
-        serializer = ChannelSerializer(channel)
+        serializer = self.get_serializer_class()(channel)
         return Response(serializer.data)
 
     def put(self, request, pk):
         channel = self.get_object(pk)
-        serializer = ChannelSerializer(channel, data=request.data, partial=True)
+        serializer = self.get_serializer_class()(channel, data=request.data, partial=True)
         if serializer.is_valid():
             serializer.save(created_by=request.user)
             return Response(serializer.data)
@@ -46,3 +57,23 @@ class ChannelDetailAPIView(APIView):
         channel = self.get_object(pk)
         channel.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class ChannelPresenceAPIView(APIView):
+    """Ids of the channel's members who currently have a live connection."""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, pk):
+        membership = get_membership_cache().get_status(request.user.id, pk)
+        if membership == NO_CHANNEL:
+            raise Http404
+        if membership != MEMBER:
+            return Response({'detail': 'Not a member of this channel.'}, status=status.HTTP_403_FORBIDDEN)
+
+        try:
+            online = get_presence_store().online_in_channel_sync(pk)
+        except RedisError:
+            return Response(
+                {'detail': 'Presence is temporarily unavailable.'}, status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        return Response({'channel': pk, 'online': sorted(online)})
@@ -1,42 +1,53 @@
+from django.http import Http404
 from django.shortcuts import get_object_or_404
+from redis.exceptions import RedisError
 from rest_framework import status, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from chat.api.mixins import FlatRepresentationMixin
+from chat.membership import MEMBER, NO_CHANNEL, get_membership_cache
 from chat.models import ChannelMembership
-from chat.serializers import ChannelMembershipSerializer
+from chat.read_state import get_read_state
+from chat.serializers import ChannelMembershipSerializer, FlatChannelMembershipSerializer
 
 
-class ChannelMembershipListAPIView(APIView):
+class ChannelMembershipListAPIView(FlatRepresentationMixin, APIView):
     permission_classes = [permissions.IsAuthenticated]
+    model = ChannelMembership
+    serializer_class = ChannelMembershipSerializer
+    flat_serializer_class = FlatChannelMembershipSerializer
 
     def get(self, request):
-        memberships = ChannelMembership.objects.all()
-        serializer = ChannelMembershipSerializer(memberships, many=True)
+        memberships = self.get_queryset()
+        serializer = self.get_serializer_class()(memberships, many=True)
         return Response(serializer.data)
 
     def post(self, request):
-        serializer = ChannelMembershipSerializer(data=request.data)
+        serializer = self.get_serializer_class()(data=request.data)
         if serializer.is_valid():
             serializer.save()  # Expect request.data to contain valid channel and user info
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class ChannelMembershipDetailAPIView(APIView):
+class ChannelMembershipDetailAPIView(FlatRepresentationMixin, APIView):
     permission_classes = [permissions.IsAuthenticated]
+    model = ChannelMembership
+    serializer_class = ChannelMembershipSerializer
+    flat_serializer_class = FlatChannelMembershipSerializer
 
     def get_object(self, pk):
-        return get_object_or_404(ChannelMembership, pk=pk)
+        return get_object_or_404(self.get_queryset(), pk=pk)
 
     def get(self, request, pk):
         membership = self.get_object(pk)
-        serializer = ChannelMembershipSerializer(membership)
+        serializer = self.get_serializer_class()(membership)
         return Response(serializer.data)
 
     def put(self, request, pk):
         membership = self.get_object(pk)
-        serializer = ChannelMembershipSerializer(membership, data=request.data, partial=True)
+        serializer = self.get_serializer_class()(membership, data=request.data, partial=True)
         if serializer.is_valid():
             serializer.save()
             return Response(serializer.data)
@@ -46,3 +57,39 @@ class ChannelMembershipDetailAPIView(APIView):
         membership = self.get_object(pk)
         membership.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class ChannelReadAPIView(APIView):
+    """Mark a channel as read up to its latest message."""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, pk):
+        membership = get_membership_cache().get_status(request.user.id, pk)
+        if membership == NO_CHANNEL:
+            raise Http404
+        if membership != MEMBER:
+            return Response({'detail': 'Not a member of this channel.'}, status=status.HTTP_403_FORBIDDEN)
+
+        read_state = get_read_state()
+        try:
+            read_state.mark_read(request.user.id, pk)
+        except RedisError:
+            return Response(
+                {'detail': 'Read state is temporarily unavailable.'}, status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        read_state.maybe_flush()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UnreadCountAPIView(APIView):
+    """Unread message counts for all of the user's channels, keyed by channel id."""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        try:
+            counts = get_read_state().unread_counts(request.user.id)
+        except RedisError:
+            return Response(
+                {'detail': 'Unread counts are temporarily unavailable.'}, status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        return Response(counts)
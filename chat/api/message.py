@@ -1,55 +1,163 @@
+import logging
+
+from django.contrib.auth.models import User
+from django.http import Http404
 from django.shortcuts import get_object_or_404
+from redis.exceptions import RedisError
 from rest_framework import status, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from chat.api.mixins import FlatRepresentationMixin
+from chat.archive import ChannelArchive
+from chat.crypto import decrypt_messages
+from chat.membership import MEMBER, NO_CHANNEL, get_membership_cache
 from chat.models import Message, Channel
-from chat.serializers import MessageSerializer
+from chat.pagination import MessageCursorPaginator
+from chat.persistence import create_message
+from chat.read_state import get_read_state
+from chat.recent import get_recent_messages
+from chat.search import index_message
+from chat.sequence import get_channel_sequence
+from chat.serializers import ChannelSerializer, MessageSerializer, FlatMessageSerializer
+
+logger = logging.getLogger(__name__)
 
 
-class MessageListAPIView(APIView):
+class MessageListAPIView(FlatRepresentationMixin, APIView):
+    """Messages newest first, paginated with the same cursors as channel history."""
     permission_classes = [permissions.IsAuthenticated]
+    model = Message
+    serializer_class = MessageSerializer
+    flat_serializer_class = FlatMessageSerializer
+    paginator_class = MessageCursorPaginator
 
     def get(self, request):
-        messages = Message.objects.all().order_by('-timestamp')
-        serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        page = self.paginator_class().paginate(self.get_queryset(), request)
+        serializer = self.get_serializer_class()(decrypt_messages(page['results']), many=True)
+        return Response({
+            'results': serializer.data,
+            'next': page['next'],
+            'previous': page['previous'],
+        })
 
     def post(self, request):
         # Expect the channel id in request.data as "channel"
-        serializer = MessageSerializer(data=request.data)
+        serializer = self.get_serializer_class()(data=request.data)
         if serializer.is_valid():
             channel_id = request.data.get('channel')
             # If a channel is provided, ensure it exists
             if channel_id:
                 channel = get_object_or_404(Channel, pk=channel_id)
-                serializer.save(sender=request.user, channel=channel)
-            else:
-                serializer.save(sender=request.user)
+                seq, = get_channel_sequence().allocate(channel.pk)
+                # Indexing decrypts the content once; the response reuses it.
+                message = create_message(
+                    None, sender=request.user, channel=channel, seq=seq, **serializer.validated_data
+                )
+                # Counted and buffered once committed; a failure here must not fail the request.
+                try:
+                    get_read_state().record_message(channel.pk)
+                    get_recent_messages().add(channel.pk, [message])
+                except RedisError:
+                    logger.warning("Failed to count and buffer message %s.", message.pk)
+                return Response(self.get_serializer_class()(message).data, status=status.HTTP_201_CREATED)
+            serializer.save(sender=request.user)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class MessageDetailAPIView(APIView):
+class ChannelMessageListAPIView(FlatRepresentationMixin, APIView):
+    """
+    Cursor-paginated message history for a single channel.
+    Accepts ``before``, ``after`` or ``around`` cursors and an optional ``limit``.
+    The newest page is served from the channel's recent-message buffer when it can be,
+    and paging continues into archived messages past the oldest one in the table.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    model = Message
+    serializer_class = MessageSerializer
+    flat_serializer_class = FlatMessageSerializer
+    paginator_class = MessageCursorPaginator
+
+    def get(self, request, pk):
+        membership = get_membership_cache().get_status(request.user.id, pk)
+        if membership == NO_CHANNEL:
+            raise Http404
+        if membership != MEMBER:
+            return Response({'detail': 'Not a member of this channel.'}, status=status.HTTP_403_FORBIDDEN)
+
+        paginator = self.paginator_class(archive=ChannelArchive(pk))
+        recent = get_recent_messages()
+        warm = paginator.is_first_page(request)
+        cached = None
+        if warm:
+            try:
+                cached = recent.latest(pk, paginator.get_limit(request))
+            except RedisError:
+                logger.warning("Recent-message buffer unavailable; reading channel %s from the database.", pk)
+                warm = False
+        if cached is not None:
+            messages, has_older = cached
+            if not self.is_flat():
+                self.load_related(pk, messages)
+            page = paginator.get_page(messages, has_older, has_newer=False)
+        else:
+            page = paginator.paginate(self.get_queryset().filter(channel_id=pk), request)
+            archived = [message for message in page['results'] if message._state.adding]
+            if archived and not self.is_flat():
+                self.load_related(pk, archived)
+            if warm:
+                try:
+                    recent.warm(pk, page['results'])
+                except RedisError:
+                    pass
+
+        serializer = self.get_serializer_class()(decrypt_messages(page['results']), many=True)
+        return Response({
+            'results': serializer.data,
+            'next': page['next'],
+            'previous': page['previous'],
+        })
+
+    def load_related(self, channel_id, messages):
+        """
+        Attach the channel and senders the nested representation reads to buffered
+        or archived messages. A sender deleted since is rendered as null.
+        """
+        channel = ChannelSerializer.setup_eager_loading(Channel.objects.all()).get(pk=channel_id)
+        senders = User.objects.in_bulk({message.sender_id for message in messages})
+        for message in messages:
+            message.channel = channel
+            message.sender = senders.get(message.sender_id)
+
+
+class MessageDetailAPIView(FlatRepresentationMixin, APIView):
     permission_classes = [permissions.IsAuthenticated]
+    model = Message
+    serializer_class = MessageSerializer
+    flat_serializer_class = FlatMessageSerializer
 
     def get_object(self, pk):
-        return get_object_or_404(Message, pk=pk)
+        return get_object_or_404(self.get_queryset(), pk=pk)
 
     def get(self, request, pk):
         message = self.get_object(pk)
-        serializer = MessageSerializer(message)
+        serializer = self.get_serializer_class()(message)
         return Response(serializer.data)
 
     def put(self, request, pk):
         message = self.get_object(pk)
-        serializer = MessageSerializer(message, data=request.data, partial=True)
+        serializer = self.get_serializer_class()(message, data=request.data, partial=True)
         if serializer.is_valid():
-            serializer.save()  # Update message; consider checking sender permissions
+            message = serializer.save()  # Update message; consider checking sender permissions
+            index_message(message)
+            get_recent_messages().replace(message.channel_id, [message])
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def delete(self, request, pk):
         message = self.get_object(pk)
         message.soft_delete()  # Soft delete instead of full removal
+        index_message(message)
+        get_recent_messages().replace(message.channel_id, [message])
         return Response(status=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,21 @@
+class FlatRepresentationMixin:
+    """
+    Picks the serializer and the joins for a request.
+
+    Clients can pass ``?flat=1`` to get related objects as ids instead of nested
+    objects; otherwise the queryset is built with the joins the nested serializer needs.
+    """
+    model = None
+    serializer_class = None
+    flat_serializer_class = None
+
+    def is_flat(self):
+        return self.request.query_params.get('flat', '').lower() in ('1', 'true', 'yes')
+
+    def get_serializer_class(self):
+        if self.flat_serializer_class is not None and self.is_flat():
+            return self.flat_serializer_class
+        return self.serializer_class
+
+    def get_queryset(self):
+        return self.get_serializer_class().setup_eager_loading(self.model.objects.all())
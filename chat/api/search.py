@@ -0,0 +1,55 @@
+from rest_framework import status, permissions
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from chat.api.mixins import FlatRepresentationMixin
+from chat.crypto import decrypt_messages
+from chat.models import ChannelMembership, Message
+from chat.search import search_messages
+from chat.serializers import MessageSerializer, FlatMessageSerializer
+
+
+class MessageSearchAPIView(FlatRepresentationMixin, APIView):
+    """
+    Search messages in the user's channels, optionally limited to one ``channel``.
+    Paginated with ``limit`` and ``offset``.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    model = Message
+    serializer_class = MessageSerializer
+    flat_serializer_class = FlatMessageSerializer
+    default_limit = 20
+    max_limit = 100
+
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'q': 'This parameter is required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+            offset = int(request.query_params.get('offset', 0))
+        except ValueError:
+            return Response({'detail': 'limit and offset must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1 or offset < 0:
+            return Response({'detail': 'limit and offset must be positive.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        channel_ids = ChannelMembership.objects.filter(user=request.user).values('channel_id')
+        channel = request.query_params.get('channel')
+        if channel:
+            try:
+                channel_ids = channel_ids.filter(channel_id=int(channel))
+            except ValueError:
+                return Response({'channel': 'Must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        matches = search_messages(query, channel_ids)
+        if matches is None:
+            return Response({'results': [], 'next_offset': None})
+
+        page = list(self.get_serializer_class().setup_eager_loading(matches)[offset:offset + limit + 1])
+        has_more = len(page) > limit
+        serializer = self.get_serializer_class()(decrypt_messages(page[:limit]), many=True)
+        return Response({
+            'results': serializer.data,
+            'next_offset': offset + limit if has_more else None,
+        })
@@ -3,40 +3,47 @@ from rest_framework import status, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from chat.api.mixins import FlatRepresentationMixin
 from chat.models import Team
-from chat.serializers import TeamSerializer
+from chat.serializers import TeamSerializer, FlatTeamSerializer
 
 
-class TeamListAPIView(APIView):
+class TeamListAPIView(FlatRepresentationMixin, APIView):
     permission_classes = [permissions.IsAuthenticated]
+    model = Team
+    serializer_class = TeamSerializer
+    flat_serializer_class = FlatTeamSerializer
 
     def get(self, request):
-        teams = Team.objects.all()
-        serializer = TeamSerializer(teams, many=True)
+        teams = self.get_queryset()
+        serializer = self.get_serializer_class()(teams, many=True)
         return Response(serializer.data)
 
     def post(self, request):
-        serializer = TeamSerializer(data=request.data)
+        serializer = self.get_serializer_class()(data=request.data)
         if serializer.is_valid():
             serializer.save(created_by=request.user)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class TeamDetailAPIView(APIView):
+class TeamDetailAPIView(FlatRepresentationMixin, APIView):
     permission_classes = [permissions.IsAuthenticated]
+    model = Team
+    serializer_class = TeamSerializer
+    flat_serializer_class = FlatTeamSerializer
 
     def get_object(self, pk):
-        return get_object_or_404(Team, pk=pk)
+        return get_object_or_404(self.get_queryset(), pk=pk)
 
     def get(self, request, pk):
         team = self.get_object(pk)
-        serializer = TeamSerializer(team)
+        serializer = self.get_serializer_class()(team)
         return Response(serializer.data)
 
     def put(self, request, pk):
         team = self.get_object(pk)
-        serializer = TeamSerializer(team, data=request.data, partial=True)
+        serializer = self.get_serializer_class()(team, data=request.data, partial=True)
         if serializer.is_valid():
             serializer.save(created_by=request.user)
             return Response(serializer.data)
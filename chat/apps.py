@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from chat import signals  # noqa: F401
+        from chat.crypto import get_cipher
+
+        # Build the shared cipher once at startup rather than on the first message.
+        get_cipher()
@@ -0,0 +1,124 @@
+"""
+Cold storage for old messages.
+
+The Message table only keeps recent history. ``archive_messages`` moves older
+messages, per channel and in sequence order, into ArchivedMessageChunk rows of
+a few hundred zlib-compressed messages each, so the hot table and its indexes
+stay small. Channel history and reconnect replay fall through to the archive
+when they run past the oldest message left in the table.
+"""
+import json
+import zlib
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from chat.models import ArchivedMessageChunk, Message
+from chat.recent import RecentMessageBuffer
+
+
+def pack_rows(rows):
+    return zlib.compress(json.dumps(rows, separators=(",", ":")).encode(), 9)
+
+
+def unpack_rows(data):
+    return json.loads(zlib.decompress(data))
+
+
+def position_key(message):
+    return message.timestamp, message.pk
+
+
+def archive_channel(channel_id, before, chunk_size=500):
+    """
+    Move the channel's messages older than ``before`` into compressed chunks of
+    up to ``chunk_size`` messages, oldest first. Each chunk is written and its
+    messages deleted in one transaction. Returns the number of messages archived.
+    """
+    archived = 0
+    while True:
+        with transaction.atomic():
+            messages = list(
+                Message.objects.filter(channel_id=channel_id, timestamp__lt=before, seq__isnull=False)
+                .select_related('sender').select_for_update(of=('self',)).order_by('seq')[:chunk_size]
+            )
+            if not messages:
+                return archived
+            rows = [RecentMessageBuffer.row(message) for message in messages]
+            ArchivedMessageChunk.objects.create(
+                channel_id=channel_id,
+                first_seq=messages[0].seq,
+                last_seq=messages[-1].seq,
+                first_timestamp=min(message.timestamp for message in messages),
+                last_timestamp=max(message.timestamp for message in messages),
+                message_count=len(messages),
+                data=pack_rows(rows),
+            )
+            # Search tokens go with the messages; archived messages are not searchable.
+            Message.objects.filter(pk__in=[message.pk for message in messages]).delete()
+        archived += len(messages)
+
+
+class ChannelArchive:
+    """
+    Read access to one channel's archived messages, as unsaved ``Message``
+    instances. Archived messages are read-only: they cannot be edited, deleted
+    or found by search. Messages of deleted users are left out, as their
+    messages in the table are deleted with them.
+    """
+
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+
+    def rows(self, chunk):
+        rows = unpack_rows(chunk.data)
+        senders = set(User.objects.filter(pk__in={row["sender_id"] for row in rows}).values_list('pk', flat=True))
+        return [row for row in rows if row["sender_id"] in senders]
+
+    def messages(self, chunk):
+        return [RecentMessageBuffer.to_message(self.channel_id, row) for row in self.rows(chunk)]
+
+    def older(self, position, limit, inclusive):
+        """Archived messages before ``position`` (or the newest ones), newest first."""
+        chunks = ArchivedMessageChunk.objects.filter(channel_id=self.channel_id).order_by('-last_timestamp')
+        if position is not None:
+            chunks = chunks.filter(first_timestamp__lte=position[0])
+        selected = []
+        for chunk in chunks.iterator(chunk_size=4):
+            # Chunks can overlap in time, so stop only once no later chunk can hold a newer match.
+            if len(selected) >= limit and chunk.last_timestamp < selected[limit - 1].timestamp:
+                break
+            for message in self.messages(chunk):
+                key = position_key(message)
+                if position is None or key < position or (inclusive and key == position):
+                    selected.append(message)
+            selected.sort(key=position_key, reverse=True)
+        return selected[:limit]
+
+    def newer(self, position, limit, inclusive):
+        """Archived messages after ``position``, oldest first."""
+        chunks = ArchivedMessageChunk.objects.filter(
+            channel_id=self.channel_id, last_timestamp__gte=position[0]
+        ).order_by('first_timestamp')
+        selected = []
+        for chunk in chunks.iterator(chunk_size=4):
+            if len(selected) >= limit and chunk.first_timestamp > selected[limit - 1].timestamp:
+                break
+            for message in self.messages(chunk):
+                key = position_key(message)
+                if key > position or (inclusive and key == position):
+                    selected.append(message)
+            selected.sort(key=position_key)
+        return selected[:limit]
+
+    def after_seq(self, after_seq, limit):
+        """Rows of archived messages with a sequence number above ``after_seq``, oldest first."""
+        chunks = ArchivedMessageChunk.objects.filter(
+            channel_id=self.channel_id, last_seq__gt=after_seq
+        ).order_by('first_seq')
+        rows = []
+        for chunk in chunks.iterator(chunk_size=4):
+            rows.extend(row for row in self.rows(chunk) if row["seq"] > after_seq)
+            if len(rows) >= limit:
+                break
+        return rows[:limit]
@@ -1,15 +1,30 @@
-import json
+import time
+import uuid
+from urllib.parse import parse_qs
+
 import bleach
 
 from channels.generic.websocket import AsyncWebsocketConsumer
-from cryptography.fernet import Fernet
 from django.conf import settings
 from django.utils.timezone import now
 
-from chat.models import Channel, Message, ChannelMembership
+from chat import metrics, protocol
+from chat.crypto import get_cipher
+from chat.db import db_sync_to_async
+from chat.fanout import get_fanout_hub
+from chat.membership import MEMBER, NO_CHANNEL, get_membership_cache
+from chat.models import Message
+from chat.persistence import apply_message_batch, create_message, get_message_queue
+from chat.ratelimit import get_rate_limiter
+from chat.read_state import get_read_state
+from chat.recent import get_recent_messages
+from chat.search import build_tokens
+from chat.sequence import get_channel_sequence
+from chat.tracing import get_tracer, span
+from chat.typing import get_typing_tracker
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(protocol.WireProtocolMixin, AsyncWebsocketConsumer):
     async def connect(self):
         """Handle WebSocket connection for chat messages."""
         if self.scope["scheme"] != "wss":
@@ -21,7 +36,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.room_group_name = f"chat_{self.channel_id}"
 
         # Accept connection first to allow sending messages
-        await self.accept()
+        await self.accept_with_protocol()
+        metrics.CONNECTIONS.inc(consumer="chat")
+        metrics.get_publisher().ensure_started()
+        get_tracer().ensure_started()
 
         if not self.user.is_authenticated:
             await self.send_error("Authentication required. Connection closed.", close_connection=True)
@@ -31,105 +49,380 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.send_error("No channel_id supplied. Connection closed.", close_connection=True)
             return
 
-        if not await self.channel_exists():
+        if not self.channel_id.isdigit():
+            await self.send_error("Invalid channel ID. Connection closed.", close_connection=True)
+            return
+
+        status = await get_membership_cache().aget_status(self.user.id, self.channel_id)
+        if status == NO_CHANNEL:
             await self.send_error("Invalid channel ID. Connection closed.", close_connection=True)
             return
 
-        is_member = await ChannelMembership.objects.filter(channel_id=self.channel_id, user=self.user).aexists()
-        if not is_member:
+        if status != MEMBER:
             await self.send_error("Not authorized to access this channel.", close_connection=True)
             return
 
         # Join the chat room
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await get_fanout_hub().subscribe(self.room_group_name, self)
+
+        # Replay what a reconnecting client missed. This runs after joining the group,
+        # so nothing falls in between; clients drop duplicates by seq.
+        params = self.query_params()
+        if "resume_from" in params:
+            try:
+                resume_from = int(params["resume_from"][0])
+            except ValueError:
+                await self.send_error("Invalid resume_from.")
+            else:
+                await self.replay(resume_from)
 
         # Send join notification
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "chat_message",
-                "message": f"{self.user.username} has joined the chat.",
-                "username": "System",
-                "channel_id": self.channel_id,
-                "timestamp": str(now()),
-            },
+        await self.broadcast(
+            protocol.MESSAGE,
+            message=f"{self.user.username} has joined the chat.",
+            username="System",
+            channel_id=self.channel_id,
+            timestamp=str(now()),
         )
 
     async def disconnect(self, close_code):
         """Handle WebSocket disconnection."""
+        if hasattr(self, 'room_group_name'):
+            metrics.CONNECTIONS.dec(consumer="chat")
         if hasattr(self, 'room_group_name') and self.user.is_authenticated:
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "chat_message",
-                    "message": f"{self.user.username} has left the chat.",
-                    "username": "System",
-                    "channel_id": self.channel_id,
-                    "timestamp": str(now()),
-                },
+            await self.handle_typing(False)
+            await self.broadcast(
+                protocol.MESSAGE,
+                message=f"{self.user.username} has left the chat.",
+                username="System",
+                channel_id=self.channel_id,
+                timestamp=str(now()),
             )
-            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+            await get_fanout_hub().unsubscribe(self.room_group_name, self)
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """Handle incoming chat messages."""
+        with get_tracer().trace("chat.receive", channel_id=self.channel_id, user_id=self.user.id):
+            await self.handle_frame(text_data, bytes_data)
+
+    async def handle_frame(self, text_data, bytes_data):
         if not self.user.is_authenticated:
             await self.send_error("Authentication required. Connection closed.", close_connection=True)
             return
 
         try:
-            data = json.loads(text_data)
+            with span("decode"):
+                data = self.decode_frame(text_data, bytes_data)
+            if isinstance(data, list) or "batch" in data:
+                metrics.FRAMES_RECEIVED.inc(consumer="chat", kind="batch")
+                await self.handle_batch(data if isinstance(data, list) else data["batch"])
+                return
+
+            kind = data.get("type") if data.get("type") in ("typing", "read") else "message"
+            metrics.FRAMES_RECEIVED.inc(consumer="chat", kind=kind)
+            if data.get("type") == "typing":
+                await self.handle_typing(bool(data.get("is_typing", True)))
+                return
+
+            if data.get("type") == "read":
+                await get_read_state().amark_read(self.user.id, self.channel_id)
+                return
+
             message = data.get("message", "").strip()
 
             if not message:
                 await self.send_error("Message content cannot be empty.")
                 return
 
+            with span("rate_limit"):
+                if not await self.allow_writes(1):
+                    return
+
             # Save message to database
-            message_content = bleach.clean(message)
+            with span("sanitize"):
+                message_content = bleach.clean(message)
             message_obj = await self.save_message(message_content)
 
             # Broadcast message to group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "chat_message",
-                    "message": message,
-                    "username": self.user.username,
-                    "channel_id": self.channel_id,
-                    "timestamp": str(message_obj.timestamp),
-                },
-            )
+            with span("broadcast"):
+                await self.broadcast(
+                    protocol.MESSAGE,
+                    id=str(message_obj.id),
+                    message=message,
+                    username=self.user.username,
+                    channel_id=self.channel_id,
+                    timestamp=str(message_obj.timestamp),
+                    seq=message_obj.seq,
+                )
+            with span("typing"):
+                await self.handle_typing(False)
 
-        except json.JSONDecodeError:
+        except ValueError:
             await self.send_error("Invalid message format.")
         except Exception:
             await self.send_error("An error occurred while processing your message.")
 
+    async def handle_batch(self, operations):
+        """
+        Apply a list of operations from one frame: ``send`` ({"message"}), ``edit``
+        ({"id", "message"}), ``delete`` ({"id"}) and ``ack`` (mark the channel read).
+        All writes share one transaction and the room gets one grouped broadcast.
+        The sender receives a ``batch_result`` with one entry per operation.
+        """
+        if not isinstance(operations, list) or not operations:
+            await self.send_error("Batch must be a non-empty list of operations.")
+            return
+        max_operations = self.max_batch_operations()
+        if len(operations) > max_operations:
+            await self.send_error(
+                f"Batch is limited to {max_operations} operations.",
+                code="batch_too_large", max_operations=max_operations,
+            )
+            return
+
+        results = [None] * len(operations)
+        sends, edits, deletes, ack = [], [], [], False
+        for index, operation in enumerate(operations):
+            op = operation.get("op") if isinstance(operation, dict) else None
+            if op == "ack":
+                ack = True
+                results[index] = {"op": op, "ok": True}
+                continue
+            if op in ("send", "edit"):
+                message = str(operation.get("message", "")).strip()
+                if not message:
+                    results[index] = {"op": op, "ok": False, "error": "Message content cannot be empty."}
+                    continue
+            if op in ("edit", "delete"):
+                try:
+                    message_id = uuid.UUID(str(operation.get("id")))
+                except ValueError:
+                    results[index] = {"op": op, "ok": False, "error": "Invalid message id."}
+                    continue
+            if op == "send":
+                sends.append((index, message))
+            elif op == "edit":
+                edits.append((index, message_id, message))
+            elif op == "delete":
+                deletes.append((index, message_id))
+            else:
+                results[index] = {"op": op, "ok": False, "error": "Unknown operation."}
+
+        if not await self.allow_writes(len(sends) + len(edits) + len(deletes)):
+            return
+
+        # Encrypt everything in one pass, then write in one transaction.
+        with span("sanitize"):
+            cleaned = [bleach.clean(message) for _, message in sends] + [bleach.clean(message) for _, _, message in edits]
+        with span("encrypt"):
+            encrypted = await get_cipher().aencrypt_many(cleaned)
+        send_rows = list(zip(encrypted[:len(sends)], cleaned[:len(sends)]))
+        edit_rows = [
+            (message_id, token, plaintext)
+            for (_, message_id, _), token, plaintext in zip(edits, encrypted[len(sends):], cleaned[len(sends):])
+        ]
+        with span("db"):
+            created, edited, deleted = await db_sync_to_async(apply_message_batch)(
+                self.channel_id, self.user, send_rows, edit_rows, [message_id for _, message_id in deletes]
+            )
+
+        events = []
+        for (index, message), message_obj in zip(sends, created):
+            results[index] = {"op": "send", "ok": True, "id": str(message_obj.id)}
+            events.append(protocol.envelope(
+                protocol.MESSAGE,
+                id=str(message_obj.id),
+                message=message,
+                username=self.user.username,
+                channel_id=self.channel_id,
+                timestamp=str(message_obj.timestamp),
+                seq=message_obj.seq,
+            ))
+        edited_ids = {message.pk for message in edited}
+        for index, message_id, message in edits:
+            results[index] = self._batch_result("edit", message_id, message_id in edited_ids)
+            if message_id in edited_ids:
+                events.append(protocol.envelope(
+                    protocol.EDIT, id=str(message_id), message=message, channel_id=self.channel_id
+                ))
+        deleted_ids = set(deleted)
+        for index, message_id in deletes:
+            results[index] = self._batch_result("delete", message_id, message_id in deleted_ids)
+            if message_id in deleted_ids:
+                events.append(protocol.envelope(protocol.DELETE, id=str(message_id), channel_id=self.channel_id))
+
+        if created:
+            metrics.MESSAGES_SAVED.inc(len(created))
+            await get_read_state().arecord_message(self.channel_id, len(created))
+        if ack:
+            await get_read_state().amark_read(self.user.id, self.channel_id)
+        if events:
+            with span("broadcast"):
+                await self.broadcast(protocol.BATCH, events=events)
+        await self.send_event(protocol.BATCH_RESULT, results=results)
+
+    def query_params(self):
+        return parse_qs(self.scope.get("query_string", b"").decode())
+
+    async def replay(self, after_seq):
+        """
+        Send the messages saved after ``after_seq``, then a ``replay`` event with
+        the last seq sent. ``complete`` is false when there were too many to
+        replay and the client should page through history instead.
+        """
+        events, complete = await get_recent_messages().replay(self.channel_id, after_seq)
+        for fields in events:
+            await self.send_event(protocol.MESSAGE, **fields)
+        await self.send_event(
+            protocol.REPLAY,
+            resume_from=after_seq,
+            last_seq=events[-1]["seq"] if events else after_seq,
+            complete=complete,
+        )
+
+    @staticmethod
+    def _batch_result(op, message_id, ok):
+        result = {"op": op, "ok": ok, "id": str(message_id)}
+        if not ok:
+            result["error"] = "Message not found."
+        return result
+
+    @staticmethod
+    def max_batch_operations():
+        """
+        The most operations one batch may hold. With rate limiting on, a batch
+        larger than the limiter's burst could never be allowed, so the limit is
+        capped at it and such batches are refused as invalid, not as rate limited.
+        """
+        if settings.CHAT_RATE_LIMIT:
+            return min(settings.CHAT_MAX_BATCH_OPERATIONS, get_rate_limiter().max_cost)
+        return settings.CHAT_MAX_BATCH_OPERATIONS
+
+    async def allow_writes(self, cost):
+        """
+        Charge ``cost`` writes against the user's and the channel's rate limits.
+        Rejected requests get a ``rate_limited`` error with ``retry_after``; a
+        client that keeps sending regardless is disconnected.
+        """
+        if not settings.CHAT_RATE_LIMIT or not cost:
+            return True
+        limiter = get_rate_limiter()
+        if cost > limiter.max_cost:
+            await self.send_error(
+                f"At most {limiter.max_cost} writes fit in one request.",
+                code="batch_too_large", max_operations=limiter.max_cost,
+            )
+            return False
+
+        retry_after = await limiter.acquire(self.user.id, self.channel_id, cost)
+        if not retry_after:
+            self.rejections = 0
+            return True
+
+        self.rejections = getattr(self, "rejections", 0) + 1
+        if self.rejections > settings.CHAT_RATE_LIMIT_MAX_REJECTIONS:
+            await self.send_error("Rate limit exceeded repeatedly. Connection closed.", close_connection=True)
+        else:
+            await self.send_error("Rate limit exceeded.", code="rate_limited", retry_after=round(retry_after, 3))
+        return False
+
+    async def handle_typing(self, is_typing):
+        """
+        Broadcast typing start/stop without touching the database.
+        Start events are throttled per connection and deduplicated across tabs in Redis.
+        """
+        tracker = get_typing_tracker()
+        if is_typing:
+            sent_at = getattr(self, "typing_sent_at", 0)
+            if time.monotonic() - sent_at < tracker.throttle:
+                return
+            self.typing_sent_at = time.monotonic()
+            changed = await tracker.start(self.channel_id, self.user.id)
+        else:
+            self.typing_sent_at = 0
+            changed = await tracker.stop(self.channel_id, self.user.id)
+
+        if changed:
+            await self.broadcast(
+                protocol.TYPING,
+                skip_sender=True,
+                user_id=self.user.id,
+                username=self.user.username,
+                is_typing=is_typing,
+                expires_in=tracker.ttl,
+            )
+
+    async def broadcast(self, event_type, skip_sender=False, **fields):
+        """Encode an event once and fan it out to the room as a ready-to-send frame."""
+        await get_fanout_hub().send(
+            self.room_group_name,
+            {
+                "type": "chat_broadcast",
+                **protocol.frame(event_type, **fields),
+                "sender_channel": self.channel_name if skip_sender else None,
+            },
+        )
+
+    async def chat_broadcast(self, event):
+        """Forward a pre-encoded frame to the WebSocket client."""
+        if event["sender_channel"] == self.channel_name:
+            return
+        await self.send_frame(event)
+
     async def chat_message(self, event):
-        """Send chat messages to WebSocket clients."""
-        await self.send(text_data=json.dumps(event))
+        """Send chat messages in the pre-envelope event format, e.g. from workers mid-deploy."""
+        fields = {key: value for key, value in event.items() if key != "type"}
+        await self.send_event(protocol.MESSAGE, **fields)
 
-    async def send_error(self, message, close_connection=False):
+    async def send_error(self, message, close_connection=False, **fields):
         """Send an error message to the client."""
-        await self.send(text_data=json.dumps({
-            "message": message
-        }))
+        metrics.ERRORS.inc(consumer="chat")
+        await self.send_event(protocol.ERROR, message=message, **fields)
         if close_connection:
+            await self.frames.flush()
             await self.close()
 
-    async def channel_exists(self):
-        """Check if channel exists."""
-        return await Channel.objects.filter(id=self.channel_id).aexists()
-
     async def save_message(self, message_content):
-        """Encrypt and save message to the database."""
-        fernet = Fernet(settings.FERNET_KEY)
-        encrypted_content = fernet.encrypt(message_content.encode())
-        encrypted_content_str = encrypted_content.decode('utf-8')
-
-        channel = await Channel.objects.aget(id=self.channel_id)
-        return await Message.objects.acreate(
-            channel=channel,
-            sender=self.user,
-            content=encrypted_content_str
-        )
+        """
+        Encrypt and save message to the database.
+        In write-behind mode the message is queued and written in a later batch.
+        """
+        with metrics.SAVE_SECONDS.time():
+            message = await self._save_message(message_content)
+        metrics.MESSAGES_SAVED.inc()
+        return message
+
+    async def _save_message(self, message_content):
+        with span("encrypt"):
+            encrypted_content_str = await get_cipher().aencrypt(message_content)
+        with span("sequence"):
+            seq, = await get_channel_sequence().aallocate(self.channel_id)
+
+        # The channel was validated on connect, so there is no need to fetch it again.
+        if settings.CHAT_WRITE_BEHIND:
+            message = Message(
+                channel_id=self.channel_id,
+                sender=self.user,
+                content=encrypted_content_str,
+                timestamp=now(),
+                seq=seq,
+            )
+            with span("enqueue"):
+                message.pending_search_tokens = build_tokens(message, message_content)
+                get_message_queue().enqueue(message)
+        else:
+            with span("db"):
+                message = await db_sync_to_async(create_message)(
+                    message_content,
+                    channel_id=self.channel_id,
+                    sender=self.user,
+                    content=encrypted_content_str,
+                    seq=seq,
+                )
+            # Queued messages are counted by the queue once they are written.
+            with span("read_state"):
+                await get_read_state().arecord_message(self.channel_id)
+
+        with span("recent"):
+            await get_recent_messages().aadd(self.channel_id, [message])
+        return message
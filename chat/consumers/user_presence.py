@@ -1,79 +1,149 @@
-import json
 import uuid
 
-from redis.asyncio import Redis
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.contrib.auth.models import AnonymousUser
 
+from chat import metrics, protocol
+from chat.db import db_sync_to_async
+from chat.fanout import get_fanout_hub
+from chat.models import ChannelMembership
+from chat.presence import (
+    PRESENCE_GROUP, channel_group, get_presence_aggregator, get_presence_store, team_group,
+)
 
-REDIS_URL = "redis://127.0.0.1:6379"
 
-class UserPresenceConsumer(AsyncWebsocketConsumer):
+class UserPresenceConsumer(protocol.WireProtocolMixin, AsyncWebsocketConsumer):
     async def connect(self):
         """Handles WebSocket connection with proper connection tracking"""
-        self.redis = Redis.from_url(REDIS_URL, decode_responses=True)
+        self.presence = get_presence_store()
         self.user = self.scope["user"]
         self.connection_id = str(uuid.uuid4())
+        self.subscriptions = set()
 
         # Accept connection first to enable communication
-        await self.accept()
+        await self.accept_with_protocol()
+        metrics.CONNECTIONS.inc(consumer="presence")
+        metrics.get_publisher().ensure_started()
 
-        # Track connection in Redis
-        if isinstance(self.user, AnonymousUser):
-            await self._track_anonymous_connection()
-        else:
-            await self._track_authenticated_connection()
+        # Track connection in Redis; it stays live only while this worker keeps sending heartbeats
+        await self.presence.connect(self.connection_id, self._user_id())
 
-        # Add to presence group and send initial status
-        await self.channel_layer.group_add("presence_updates", self.channel_name)
-        await self._broadcast_presence()
+        # Join the presence group; updates are broadcast by the aggregator on its next tick
+        await get_fanout_hub().subscribe(PRESENCE_GROUP, self)
+        get_presence_aggregator().attach()
+        await self.send_event(protocol.PRESENCE, **await self.presence.counts())
 
     async def disconnect(self, close_code):
-        """Handles WebSocket disconnection with atomic Redis operations"""
-        pipeline = self.redis.pipeline()
+        """Handles WebSocket disconnection; the user stays online while other tabs are open"""
+        metrics.CONNECTIONS.dec(consumer="presence")
+        await self.presence.disconnect(self.connection_id, self._user_id())
+        await get_fanout_hub().unsubscribe(PRESENCE_GROUP, self)
+        for group in self.subscriptions:
+            await get_fanout_hub().unsubscribe(group, self)
+        get_presence_aggregator().detach()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Handle subscription requests for per-channel or per-team presence, e.g.
+        ``{"subscribe": {"channels": [1], "teams": [2]}}`` or the same with ``unsubscribe``.
+        """
+        metrics.FRAMES_RECEIVED.inc(consumer="presence", kind="subscribe")
+        try:
+            data = self.decode_frame(text_data, bytes_data)
+        except ValueError:
+            await self.send_error("Invalid message format.")
+            return
+        if not isinstance(data, dict):
+            await self.send_error("Invalid message format.")
+            return
 
         if isinstance(self.user, AnonymousUser):
-            pipeline.srem("anonymous_connections", self.connection_id)
-        else:
-            pipeline.hincrby("user_connections", self.user.id, -1)
-            pipeline.hdel("user_connections", self.user.id)
-
-        await pipeline.execute()
-        await self.channel_layer.group_discard("presence_updates", self.channel_name)
-        await self._broadcast_presence()
-
-    async def _track_authenticated_connection(self):
-        """Track authenticated user connection with connection count"""
-        await self.redis.hincrby("user_connections", self.user.id, 1)
-
-    async def _track_anonymous_connection(self):
-        """Track anonymous connection with unique ID"""
-        await self.redis.sadd("anonymous_connections", self.connection_id)
-
-    async def _get_presence_data(self):
-        """Get current presence data from Redis atomically"""
-        pipeline = self.redis.pipeline()
-        pipeline.hlen("user_connections")
-        pipeline.scard("anonymous_connections")
-        logged_in, anonymous = await pipeline.execute()
-
-        return {
-            "logged_in_users": logged_in,
-            "anonymous_users": anonymous,
-            "total_connections": logged_in + anonymous
-        }
-
-    async def _broadcast_presence(self):
-        """Broadcast presence update to all connected clients"""
-        presence_data = await self._get_presence_data()
-        await self.channel_layer.group_send(
-            "presence_updates",
-            {
-                "type": "presence.update",
-                "data": presence_data
-            }
+            await self.send_error("Authentication required to subscribe.")
+            return
+
+        if "unsubscribe" in data:
+            for scope, scope_id in self._parse_scopes(data["unsubscribe"]):
+                group = self._group_for(scope, scope_id)
+                self.subscriptions.discard(group)
+                await get_fanout_hub().unsubscribe(group, self)
+
+        if "subscribe" in data:
+            requested = self._parse_scopes(data["subscribe"])
+            allowed = await db_sync_to_async(self._visible_scopes)(requested)
+            for scope, scope_id in requested:
+                if (scope, scope_id) not in allowed:
+                    await self.send_error(f"Not authorized to subscribe to {scope} {scope_id}.")
+                    continue
+                group = self._group_for(scope, scope_id)
+                self.subscriptions.add(group)
+                await get_fanout_hub().subscribe(group, self)
+                await self._send_snapshot(scope, scope_id, allowed[(scope, scope_id)])
+
+    def _user_id(self):
+        return None if isinstance(self.user, AnonymousUser) else self.user.id
+
+    async def _send_snapshot(self, scope, scope_id, member_ids):
+        """Send the full online list for a scope so later deltas can be applied to it."""
+        online = await self.presence.online_user_ids(member_ids)
+        await self.send_event(
+            protocol.PRESENCE,
+            scope=scope,
+            id=scope_id,
+            snapshot=True,
+            online=sorted(online),
         )
 
+    @staticmethod
+    def _parse_scopes(spec):
+        scopes = []
+        if not isinstance(spec, dict):
+            return scopes
+        for scope, key in (("channel", "channels"), ("team", "teams")):
+            for scope_id in spec.get(key, []):
+                try:
+                    scopes.append((scope, int(scope_id)))
+                except (TypeError, ValueError):
+                    continue
+        return scopes
+
+    @staticmethod
+    def _group_for(scope, scope_id):
+        return channel_group(scope_id) if scope == "channel" else team_group(scope_id)
+
+    def _visible_scopes(self, requested):
+        """
+        Map each requested scope the user belongs to onto its member ids.
+        A user can follow a team if they are in any of its channels.
+        """
+        channel_ids = [scope_id for scope, scope_id in requested if scope == "channel"]
+        team_ids = [scope_id for scope, scope_id in requested if scope == "team"]
+        own = ChannelMembership.objects.filter(user=self.user)
+        visible_channels = set(own.filter(channel_id__in=channel_ids).values_list('channel_id', flat=True))
+        visible_teams = set(own.filter(channel__team_id__in=team_ids).values_list('channel__team_id', flat=True))
+
+        members = ChannelMembership.objects.filter(
+            channel_id__in=visible_channels
+        ).values_list('channel_id', 'user_id')
+        team_members = ChannelMembership.objects.filter(
+            channel__team_id__in=visible_teams
+        ).values_list('channel__team_id', 'user_id')
+
+        allowed = {("channel", channel_id): set() for channel_id in visible_channels}
+        allowed.update({("team", team_id): set() for team_id in visible_teams})
+        for channel_id, user_id in members:
+            allowed[("channel", channel_id)].add(user_id)
+        for team_id, user_id in team_members:
+            allowed[("team", team_id)].add(user_id)
+        return allowed
+
+    async def send_error(self, message):
+        metrics.ERRORS.inc(consumer="presence")
+        await self.send_event(protocol.ERROR, message=message)
+
+    async def presence_broadcast(self, event):
+        """Forward a pre-encoded presence frame to the WebSocket client"""
+        await self.send_frame(event)
+
     async def presence_update(self, event):
-        """Send presence updates to WebSocket client"""
-        await self.send(text_data=json.dumps(event["data"]))
+        """Send presence updates in the pre-envelope event format, e.g. from workers mid-deploy"""
+        await self.send_event(protocol.PRESENCE, **event["data"])
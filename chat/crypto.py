@@ -0,0 +1,175 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from django.conf import settings
+
+from chat.tracing import span
+
+
+class MessageCipher:
+    """
+    Process-wide Fernet cipher for message content.
+
+    Keys are tried newest first, so older keys can stay configured while existing
+    messages are re-encrypted. With ``max_workers`` set, the async helpers run the
+    AES/HMAC work in a thread pool instead of on the event loop.
+    """
+
+    # Batches smaller than this are decrypted inline; the pool hand-off costs more.
+    parallel_threshold = 64
+
+    def __init__(self, keys, max_workers=0):
+        if not keys:
+            raise ValueError("At least one Fernet key is required.")
+        self.fernet = MultiFernet([Fernet(key) for key in keys])
+        self.max_workers = max_workers
+        self.executor = (
+            ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat-crypto")
+            if max_workers else None
+        )
+
+    def encrypt(self, plaintext):
+        return self.fernet.encrypt(plaintext.encode()).decode('utf-8')
+
+    def decrypt(self, token):
+        return self.fernet.decrypt(token.encode()).decode('utf-8')
+
+    def encrypt_many(self, plaintexts):
+        return [self.encrypt(plaintext) for plaintext in plaintexts]
+
+    async def aencrypt_many(self, plaintexts):
+        """Encrypt a batch with a single hand-off to the pool."""
+        return await self._run(self.encrypt_many, list(plaintexts))
+
+    def decrypt_many(self, tokens):
+        """
+        Decrypt a batch of tokens, in parallel chunks when a pool is configured.
+        Tokens that are not valid Fernet tokens (e.g. legacy plaintext) are returned unchanged.
+        """
+        tokens = list(tokens)
+        if self.executor is None or len(tokens) < self.parallel_threshold:
+            return self._decrypt_chunk(tokens)
+        size = -(-len(tokens) // self.max_workers)
+        chunks = [tokens[i:i + size] for i in range(0, len(tokens), size)]
+        return list(chain.from_iterable(self.executor.map(self._decrypt_chunk, chunks)))
+
+    async def adecrypt_many(self, tokens):
+        """Decrypt a batch with a single hand-off to the pool."""
+        return await self._run(self._decrypt_chunk, list(tokens))
+
+    def _decrypt_chunk(self, tokens):
+        plaintexts = []
+        for token in tokens:
+            try:
+                plaintexts.append(self.decrypt(token))
+            except InvalidToken:
+                plaintexts.append(token)
+        return plaintexts
+
+    def rotate(self, token):
+        """Re-encrypt a token under the primary key."""
+        return self.fernet.rotate(token.encode()).decode('utf-8')
+
+    async def aencrypt(self, plaintext):
+        return await self._run(self.encrypt, plaintext)
+
+    async def adecrypt(self, token):
+        return await self._run(self.decrypt, token)
+
+    async def _run(self, func, value):
+        if self.executor is None:
+            return func(value)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, value)
+
+
+_cipher = None
+_cipher_lock = threading.Lock()
+
+
+def get_cipher():
+    """Return the shared cipher, building it from settings on first use."""
+    global _cipher
+    if _cipher is None:
+        with _cipher_lock:
+            if _cipher is None:
+                _cipher = MessageCipher(settings.FERNET_KEYS, settings.CHAT_CRYPTO_THREADS)
+    return _cipher
+
+
+class PlaintextCache:
+    """
+    Bounded LRU of decrypted message content keyed by message id.
+
+    Entries remember the ciphertext they came from, so an edited or re-keyed
+    message is never served stale plaintext.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, message_id, token):
+        with self._lock:
+            entry = self._entries.get(message_id)
+            if entry is None or entry[0] != token:
+                return None
+            self._entries.move_to_end(message_id)
+            return entry[1]
+
+    def set(self, message_id, token, plaintext):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[message_id] = (token, plaintext)
+            self._entries.move_to_end(message_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+_plaintext_cache = None
+
+
+def get_plaintext_cache():
+    global _plaintext_cache
+    if _plaintext_cache is None:
+        with _cipher_lock:
+            if _plaintext_cache is None:
+                _plaintext_cache = PlaintextCache(settings.CHAT_PLAINTEXT_CACHE_SIZE)
+    return _plaintext_cache
+
+
+def decrypt_messages(messages):
+    """
+    Attach decrypted content to a page of messages as ``plaintext``.
+
+    Cached entries are reused and all misses are decrypted in one batch.
+    """
+    messages = list(messages)
+    cache = get_plaintext_cache()
+    misses = []
+    for message in messages:
+        plaintext = cache.get(message.pk, message.content)
+        if plaintext is None:
+            misses.append(message)
+        else:
+            message.plaintext = plaintext
+
+    if misses:
+        with span("decrypt"):
+            plaintexts = get_cipher().decrypt_many(message.content for message in misses)
+        for message, plaintext in zip(misses, plaintexts):
+            message.plaintext = plaintext
+            cache.set(message.pk, message.content, plaintext)
+    return messages
+
+
+def decrypt_message(message):
+    """Return the decrypted content of a single message."""
+    if not hasattr(message, 'plaintext'):
+        decrypt_messages([message])
+    return message.plaintext
@@ -0,0 +1,36 @@
+"""
+Database access from async code.
+
+``channels.db.database_sync_to_async`` is thread-sensitive: outside an HTTP
+request every call from every consumer runs on asgiref's one shared thread,
+so database work for all sockets in a process is serialised. Calls made
+through ``db_sync_to_async`` run on a dedicated pool of ``CHAT_DB_THREADS``
+threads instead, each keeping its own (pooled or persistent) connection.
+The connection pool in ``DATABASES`` is sized to match.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+_executor = None
+_lock = threading.Lock()
+
+
+def get_db_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.CHAT_DB_THREADS, thread_name_prefix="chat-db")
+    return _executor
+
+
+def db_sync_to_async(func):
+    """
+    Like ``database_sync_to_async``, on the database thread pool. Only for
+    self-contained calls: consecutive calls may run on different threads, so
+    a transaction must not span more than one of them.
+    """
+    return DatabaseSyncToAsync(func, thread_sensitive=False, executor=get_db_executor())
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from chat.groups import sharded_group
+from chat.metrics import GROUP_SEND_SECONDS, CollectedMetric
+from chat.lifespan import on_shutdown
+
+logger = logging.getLogger(__name__)
+
+
+class LocalFanoutHub:
+    """
+    Per-process subscriber that fans group messages out to local consumers.
+
+    Instead of every socket joining a channel layer group, the process joins
+    each group once with a single channel of its own and keeps the local
+    consumers per group in memory. A group message then crosses Redis once
+    per worker rather than once per socket, and is delivered by calling the
+    consumers' handlers directly. Messages name their group in a ``group``
+    field so one receive loop can serve every group. With ``enabled`` off,
+    consumers join groups directly as before.
+
+    The hub's channel carries all of the worker's group traffic, so it is
+    named ``fanout.*`` and given its own, larger capacity in CHANNEL_LAYERS
+    (CHAT_FANOUT_CHANNEL_CAPACITY). Each consumer has its own ordered
+    backlog, drained by a task of its own, so a slow socket only delays
+    itself; past ``max_backlog`` its oldest messages are dropped.
+    """
+
+    def __init__(self, enabled=True, max_backlog=1000):
+        self.enabled = enabled
+        self.max_backlog = max_backlog
+        self.channel_name = None
+        self.groups = {}
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self._backlogs = {}
+        self._locks = {}
+        self._drainers = set()
+        self._task = None
+        self._refresh_task = None
+        on_shutdown(self.stop)
+
+    def stats(self):
+        return {
+            "groups": len(self.groups),
+            "consumers": sum(len(consumers) for consumers in self.groups.values()),
+            "received": self.received,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "backlogged": len(self._backlogs),
+        }
+
+    @asynccontextmanager
+    async def _membership(self, group):
+        """
+        Serialise membership changes per group, so a layer group_discard for
+        the last local subscriber never lands after the next one's group_add.
+        """
+        entry = self._locks.get(group)
+        if entry is None:
+            entry = self._locks[group] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[group]
+
+    async def subscribe(self, group, consumer):
+        if not self.enabled:
+            await sharded_group(group).add(consumer.channel_layer, consumer.channel_name)
+            return
+        await self._ensure_reader()
+        async with self._membership(group):
+            consumers = self.groups.setdefault(group, set())
+            consumers.add(consumer)
+            if len(consumers) == 1:
+                await sharded_group(group).add(get_channel_layer(), self.channel_name)
+
+    async def unsubscribe(self, group, consumer):
+        if not self.enabled:
+            await sharded_group(group).discard(consumer.channel_layer, consumer.channel_name)
+            return
+        async with self._membership(group):
+            consumers = self.groups.get(group)
+            if consumers is None:
+                return
+            consumers.discard(consumer)
+            if not consumers:
+                del self.groups[group]
+                await sharded_group(group).discard(get_channel_layer(), self.channel_name)
+
+    async def send(self, group, message):
+        """Send to every subscriber of ``group`` on any worker."""
+        with GROUP_SEND_SECONDS.time():
+            await sharded_group(group).send(get_channel_layer(), {**message, "group": group})
+
+    async def _ensure_reader(self):
+        if self._task is None or self._task.done():
+            if self.channel_name is None:
+                self.channel_name = await get_channel_layer().new_channel(prefix="fanout")
+            loop = asyncio.get_running_loop()
+            self._task = loop.create_task(self._run())
+            self._refresh_task = loop.create_task(self._refresh())
+
+    async def stop(self):
+        for task in (self._task, self._refresh_task):
+            if task is not None:
+                task.cancel()
+        self._task = self._refresh_task = None
+
+    async def _run(self):
+        channel_layer = get_channel_layer()
+        while True:
+            try:
+                message = await channel_layer.receive(self.channel_name)
+            except Exception:
+                logger.exception("Fan-out receive failed.")
+                await asyncio.sleep(1)
+                continue
+            self.dispatch(message)
+
+    async def _refresh(self):
+        """Group memberships expire in the layer; renew the ones still in use."""
+        while True:
+            await asyncio.sleep(settings.CHAT_FANOUT_REFRESH_INTERVAL)
+            for group in list(self.groups):
+                try:
+                    await sharded_group(group).add(get_channel_layer(), self.channel_name)
+                except Exception:
+                    logger.exception("Failed to renew fan-out group %s.", group)
+
+    def dispatch(self, message):
+        """Queue the message for each local subscriber of its group, without waiting for delivery."""
+        self.received += 1
+        for consumer in self.groups.get(message.get("group"), ()):
+            backlog = self._backlogs.get(consumer)
+            if backlog is None:
+                backlog = self._backlogs[consumer] = deque()
+                task = asyncio.get_running_loop().create_task(self._drain(consumer, backlog))
+                self._drainers.add(task)
+                task.add_done_callback(self._drainers.discard)
+            elif len(backlog) >= self.max_backlog:
+                backlog.popleft()
+                self.dropped += 1
+            backlog.append(message)
+
+    async def _drain(self, consumer, backlog):
+        """Deliver a consumer's backlog in order by calling the handler named by each message type."""
+        try:
+            while backlog:
+                message = backlog.popleft()
+                try:
+                    await getattr(consumer, message["type"].replace(".", "_"))(message)
+                except Exception:
+                    logger.exception("Fan-out delivery failed.")
+                else:
+                    self.delivered += 1
+        finally:
+            del self._backlogs[consumer]
+
+
+_hub = None
+
+
+def get_fanout_hub():
+    global _hub
+    if _hub is None:
+        _hub = LocalFanoutHub(enabled=settings.CHAT_LOCAL_FANOUT, max_backlog=settings.CHAT_FANOUT_MAX_BACKLOG)
+    return _hub
+
+
+HUB_GROUPS = CollectedMetric(
+    "chat_fanout_groups", "Groups the local fan-out hub is subscribed to.", "gauge",
+    lambda: None if _hub is None else _hub.stats()["groups"],
+)
+HUB_CONSUMERS = CollectedMetric(
+    "chat_fanout_consumers", "Local sockets subscribed through the fan-out hub.", "gauge",
+    lambda: None if _hub is None else _hub.stats()["consumers"],
+)
+HUB_BACKLOGGED = CollectedMetric(
+    "chat_fanout_backlogged_consumers", "Local sockets with undelivered fan-out messages.", "gauge",
+    lambda: None if _hub is None else _hub.stats()["backlogged"],
+)
+HUB_MESSAGES = CollectedMetric(
+    "chat_fanout_messages_total", "Fan-out hub messages received from the layer, delivered or dropped.", "counter",
+    lambda: None if _hub is None else {
+        (event,): _hub.stats()[event] for event in ("received", "delivered", "dropped")
+    },
+    ["event"],
+)
@@ -0,0 +1,65 @@
+import asyncio
+import bisect
+import functools
+import zlib
+
+from django.conf import settings
+
+# Points per shard on the hash ring; more points spread members more evenly.
+RING_POINTS = 64
+
+
+@functools.lru_cache(maxsize=None)
+def _ring(shards):
+    """Sorted (point, shard) pairs. A shard's points do not depend on the shard count."""
+    return sorted(
+        (zlib.crc32(f"{shard}:{point}".encode()), shard)
+        for shard in range(shards)
+        for point in range(RING_POINTS)
+    )
+
+
+class ShardedGroup:
+    """
+    A channel layer group split into ``shards`` sub-groups.
+
+    Every socket joins one sub-group, picked by consistent hashing of its
+    channel name, and ``send`` fans a message out to all sub-groups at once.
+    The layer hashes each sub-group name to a Redis host on its own, so the
+    members of a very large group and the work of delivering to them are
+    spread over several keys and hosts instead of one. Changing the shard
+    count only moves the sockets whose sub-group disappeared or gained points;
+    they pick up the new layout when they reconnect. With one shard the group
+    keeps its plain name, so nothing changes for unsharded deployments.
+    """
+
+    def __init__(self, name, shards=1):
+        self.name = name
+        self.shards = max(shards, 1)
+
+    def names(self):
+        if self.shards == 1:
+            return [self.name]
+        return [f"{self.name}.{shard}" for shard in range(self.shards)]
+
+    def shard_for(self, channel_name):
+        """The sub-group a socket belongs to."""
+        if self.shards == 1:
+            return self.name
+        ring = _ring(self.shards)
+        index = bisect.bisect(ring, (zlib.crc32(channel_name.encode()),)) % len(ring)
+        return f"{self.name}.{ring[index][1]}"
+
+    async def add(self, channel_layer, channel_name):
+        await channel_layer.group_add(self.shard_for(channel_name), channel_name)
+
+    async def discard(self, channel_layer, channel_name):
+        await channel_layer.group_discard(self.shard_for(channel_name), channel_name)
+
+    async def send(self, channel_layer, message):
+        await asyncio.gather(*(channel_layer.group_send(name, message) for name in self.names()))
+
+
+def sharded_group(name):
+    """The group called ``name``, sharded as configured by CHAT_GROUP_SHARDS."""
+    return ShardedGroup(name, settings.CHAT_GROUP_SHARDS)
@@ -0,0 +1,39 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+_shutdown_hooks = []
+
+
+def on_shutdown(hook):
+    """Register a coroutine function to run when the ASGI server shuts down."""
+    if hook not in _shutdown_hooks:
+        _shutdown_hooks.append(hook)
+    return hook
+
+
+async def run_shutdown_hooks():
+    for hook in reversed(_shutdown_hooks):
+        try:
+            await hook()
+        except Exception:
+            logger.exception("Shutdown hook %r failed.", hook)
+
+
+class LifespanApp:
+    """
+    ASGI lifespan handler that releases per-process resources on shutdown.
+    Servers without lifespan support (daphne) never run these hooks. Only the
+    write-behind queue has an atexit fallback, so queued messages are still
+    written. Other state is left in Redis for live workers or expires there.
+    """
+
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await run_shutdown_hooks()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
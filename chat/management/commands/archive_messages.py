@@ -0,0 +1,39 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from chat.archive import archive_channel
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages older than the retention window out of the message table into "
+        "compressed per-channel archive chunks. History and reconnect replay still read them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.CHAT_ARCHIVE_AFTER_DAYS,
+                            help="Archive messages older than this many days.")
+        parser.add_argument('--chunk-size', type=int, default=500, help="Messages per archive chunk.")
+        parser.add_argument('--channel', type=int, action='append', help="Only archive this channel; repeatable.")
+        parser.add_argument('--dry-run', action='store_true', help="Only count what would be archived.")
+
+    def handle(self, *args, **options):
+        before = now() - timedelta(days=options['days'])
+        old = Message.objects.filter(timestamp__lt=before, seq__isnull=False)
+        if options['channel']:
+            old = old.filter(channel_id__in=options['channel'])
+
+        if options['dry_run']:
+            self.stdout.write(f"{old.count()} messages older than {before:%Y-%m-%d %H:%M} would be archived.")
+            return
+
+        total = 0
+        for channel_id in old.values_list('channel_id', flat=True).distinct().order_by('channel_id'):
+            archived = archive_channel(channel_id, before, options['chunk_size'])
+            self.stdout.write(f"channel {channel_id}: {archived} messages")
+            total += archived
+        self.stdout.write(self.style.SUCCESS(f"Archived {total} messages."))
@@ -0,0 +1,296 @@
+import asyncio
+import itertools
+import json
+import os
+import re
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import timedelta
+
+from channels.layers import channel_layers
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.utils.timezone import now
+
+from chat.lifespan import run_shutdown_hooks
+from chat.models import Channel, ChannelMembership
+
+BENCH_PREFIX = "bench:"
+
+
+class QueryCounter:
+    """Counts SQL statements on every database connection, including the ones in sync worker threads."""
+
+    def __init__(self):
+        self.count = 0
+        self._counter = itertools.count(1)
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count = next(self._counter)
+        return execute(sql, params, many, context)
+
+    def install(self):
+        connection_created.connect(self._on_connection_created)
+        for conn in connections.all():
+            conn.execute_wrappers.append(self)
+
+    def _on_connection_created(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+
+class Client:
+    """One simulated WebSocket client that records the latency of every benchmark message it receives."""
+
+    def __init__(self, communicator, sent_at):
+        self.communicator = communicator
+        self.sent_at = sent_at
+        self.latencies = []
+        self.events = 0
+        self._task = None
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError("WebSocket connection was rejected.")
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._read())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _read(self):
+        while True:
+            output = await self.communicator.output_queue.get()
+            if output.get("type") != "websocket.send" or output.get("text") is None:
+                continue
+            received_at = time.perf_counter()
+            self.events += 1
+            event = json.loads(output["text"])
+            message = event.get("message") if isinstance(event, dict) else None
+            if isinstance(message, str) and message.startswith(BENCH_PREFIX):
+                self.latencies.append(received_at - self.sent_at[message])
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test the ASGI application with simulated chat and presence WebSocket clients "
+        "against a throwaway test database. Reports throughput, end-to-end latency, "
+        "database queries per message and memory per connection."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000, help="Chat sockets, spread over the channels.")
+        parser.add_argument('--channels', type=int, default=10)
+        parser.add_argument('--presence', type=int, default=1000, help="Presence sockets.")
+        parser.add_argument('--messages', type=int, default=1000)
+        parser.add_argument('--rate', type=float, default=0, help="Messages per second to send; 0 sends flat out.")
+        parser.add_argument('--layer', choices=('memory', 'redis'), default='memory',
+                            help="Channel layer to use. Other Redis-backed state always uses REDIS_URL.")
+        parser.add_argument('--rate-limit', action='store_true', help="Keep the inbound rate limits enabled.")
+        parser.add_argument('--timeout', type=float, default=60)
+        parser.add_argument('--json', dest='json_path', help="Also write the results to this file.")
+
+    def handle(self, *args, **options):
+        if options['layer'] == 'memory':
+            settings.CHANNEL_LAYERS = {"default": {
+                "BACKEND": "channels.layers.InMemoryChannelLayer",
+                # The in-memory layer expects compiled patterns here.
+                "CONFIG": {"channel_capacity": [(re.compile(r"fanout\."), settings.CHAT_FANOUT_CHANNEL_CAPACITY)]},
+            }}
+            channel_layers.backends.clear()
+        if not options['rate_limit']:
+            settings.CHAT_RATE_LIMIT = False
+
+        if connection.vendor == 'sqlite':
+            # Consumers query from worker threads, which do not see an in-memory test database.
+            test_name = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = test_name
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            cookies = self.create_workload(options['clients'], options['channels'], options['presence'])
+            results = asyncio.run(self.run(cookies, options))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results['commit'] = self.commit()
+        results['options'] = {
+            key: options[key] for key in ('clients', 'channels', 'presence', 'messages', 'rate', 'layer', 'rate_limit')
+        }
+        self.report(results)
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def create_workload(self, clients, channels, presence):
+        """Create one user per socket, the channels and memberships, and a login session per user."""
+        users = User.objects.bulk_create(User(username=f"bench{index}") for index in range(max(clients, presence)))
+        owner = users[0]
+        channel_objs = Channel.objects.bulk_create(
+            Channel(name=f"bench{index}", created_by=owner) for index in range(channels)
+        )
+        ChannelMembership.objects.bulk_create(
+            ChannelMembership(user=users[index], channel=channel_objs[index % channels]) for index in range(clients)
+        )
+
+        backend = settings.AUTHENTICATION_BACKENDS[0]
+        store = SessionStore()
+        sessions = []
+        cookies = []
+        expires = now() + timedelta(days=1)
+        for user in users:
+            key = store._get_new_session_key()
+            data = {SESSION_KEY: str(user.pk), BACKEND_SESSION_KEY: backend, HASH_SESSION_KEY: user.get_session_auth_hash()}
+            sessions.append(Session(session_key=key, session_data=store.encode(data), expire_date=expires))
+            cookies.append(f"{settings.SESSION_COOKIE_NAME}={key}".encode())
+        Session.objects.bulk_create(sessions)
+        return [(cookie, f"/ws/chat/{channel_objs[index % channels].pk}/") for index, cookie in enumerate(cookies)]
+
+    async def run(self, cookies, options):
+        from App.asgi import application
+
+        counter = QueryCounter()
+        counter.install()
+        sent_at = {}
+        clients, chat_connect = await self.open(
+            application, [cookies[index] for index in range(options['clients'])], sent_at
+        )
+        watchers, presence_connect = await self.open(
+            application, [(cookie, "/ws/user_presence/") for cookie, _ in cookies[:options['presence']]], sent_at
+        )
+
+        # Let join notifications and presence snapshots settle before measuring.
+        await asyncio.sleep(1)
+        for client in clients + watchers:
+            client.start()
+
+        members = {}
+        for _, path in cookies[:options['clients']]:
+            members[path] = members.get(path, 0) + 1
+        expected = 0
+        interval = 1 / options['rate'] if options['rate'] else 0
+
+        queries_before = counter.count
+        started = time.perf_counter()
+        for index in range(options['messages']):
+            sender = clients[index % len(clients)]
+            text = f"{BENCH_PREFIX}{index}"
+            sent_at[text] = time.perf_counter()
+            await sender.communicator.send_to(text_data=json.dumps({"message": text}))
+            expected += members[cookies[index % len(clients)][1]]
+            if interval:
+                await asyncio.sleep(interval)
+            elif index % 100 == 99:
+                await asyncio.sleep(0)
+
+        deadline = time.monotonic() + options['timeout']
+        while sum(len(client.latencies) for client in clients) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        queries = counter.count - queries_before
+
+        for client in clients + watchers:
+            await client.stop()
+        presence_events = sum(client.events for client in watchers)
+        await asyncio.gather(
+            *(client.communicator.disconnect() for client in clients + watchers), return_exceptions=True
+        )
+
+        # Flush the write-behind queue and other buffers before the test database goes away.
+        await run_shutdown_hooks()
+
+        latencies = [latency for client in clients for latency in client.latencies]
+        return {
+            "chat": chat_connect,
+            "presence": dict(presence_connect, events_received=presence_events),
+            "messages": {
+                "sent": options['messages'],
+                "deliveries": len(latencies),
+                "expected_deliveries": expected,
+                "seconds": round(elapsed, 3),
+                "messages_per_second": round(options['messages'] / elapsed, 1),
+                "deliveries_per_second": round(len(latencies) / elapsed, 1),
+                "latency_ms": {
+                    "p50": self.ms(percentile(latencies, 0.5)),
+                    "p99": self.ms(percentile(latencies, 0.99)),
+                    "max": self.ms(max(latencies, default=None)),
+                },
+                "db_queries_per_message": round(queries / options['messages'], 2) if options['messages'] else None,
+            },
+        }
+
+    async def open(self, application, targets, sent_at):
+        """Connect one client per (cookie, path), measuring time and traced memory per connection."""
+        clients = []
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        for start in range(0, len(targets), 100):
+            chunk = []
+            for cookie, path in targets[start:start + 100]:
+                communicator = WebsocketCommunicator(application, path, headers=[(b"cookie", cookie)])
+                communicator.scope["scheme"] = "wss"
+                chunk.append(Client(communicator, sent_at))
+            await asyncio.gather(*(client.connect() for client in chunk))
+            clients.extend(chunk)
+        elapsed = time.perf_counter() - started
+        used = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        return clients, {
+            "connections": len(clients),
+            "connect_seconds": round(elapsed, 3),
+            "memory_per_connection_kb": round(used / len(clients) / 1024, 1) if clients else None,
+        }
+
+    @staticmethod
+    def ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 2)
+
+    @staticmethod
+    def commit():
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=settings.BASE_DIR
+            ).stdout.strip() or None
+        except OSError:
+            return None
+
+    def report(self, results):
+        messages = results['messages']
+        self.stdout.write(f"commit {results['commit']}  {results['options']}")
+        for kind in ('chat', 'presence'):
+            stats = results[kind]
+            self.stdout.write(
+                f"{kind:<9} {stats['connections']} connections in {stats['connect_seconds']}s, "
+                f"{stats['memory_per_connection_kb']} KiB each"
+            )
+        self.stdout.write(
+            f"messages  {messages['sent']} sent, {messages['deliveries']}/{messages['expected_deliveries']} delivered "
+            f"in {messages['seconds']}s: {messages['messages_per_second']} msgs/s, "
+            f"{messages['deliveries_per_second']} deliveries/s"
+        )
+        latency = messages['latency_ms']
+        self.stdout.write(
+            f"latency   p50 {latency['p50']} ms, p99 {latency['p99']} ms, max {latency['max']} ms; "
+            f"{messages['db_queries_per_message']} DB queries per message"
+        )
@@ -0,0 +1,74 @@
+import asyncio
+import os
+import tempfile
+import time
+
+from channels.db import database_sync_to_async
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from chat.crypto import get_cipher
+from chat.db import db_sync_to_async
+from chat.models import Channel, Message
+from chat.persistence import create_message
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure database connect and message-save throughput of the configured engine against "
+        "a throwaway test database, comparing the shared sync thread with the database thread pool."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connects', type=int, default=500)
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--concurrency', type=int, default=50, help="Concurrent async savers.")
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite':
+            # The thread pool does not see an in-memory test database.
+            test_name = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = test_name
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            user = User.objects.create(username="bench")
+            channel = Channel.objects.create(name="bench", created_by=user)
+            self.stdout.write(f"{connection.vendor}, {options['concurrency']} concurrent savers")
+            self.report_connects(options['connects'])
+            content = get_cipher().encrypt("benchmark message")
+            for label, wrapper in (("shared thread", database_sync_to_async), ("db thread pool", db_sync_to_async)):
+                elapsed = asyncio.run(self.save(wrapper, channel, user, content, options))
+                self.stdout.write(
+                    f"save      {label:<15} {options['messages'] / elapsed:10.1f} msgs/s "
+                    f"({elapsed / options['messages'] * 1000:.2f} ms each)"
+                )
+            close_old_connections()
+        finally:
+            connection.close()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def report_connects(self, count):
+        """Open, use and release a connection ``count`` times, as each sync-to-async call does."""
+        connection.close()
+        started = time.perf_counter()
+        for _ in range(count):
+            connection.ensure_connection()
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.close()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"connect   {count / elapsed:26.1f} per s ({elapsed / count * 1000:.2f} ms each)")
+
+    async def save(self, wrapper, channel, user, content, options):
+        save = wrapper(create_message)
+        seq = iter(range(await Message.objects.acount() + 1, 1 << 62))
+        remaining = iter(range(options['messages']))
+
+        async def saver():
+            for _ in remaining:
+                await save("benchmark message", channel=channel, sender=user, content=content, seq=next(seq))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(saver() for _ in range(options['concurrency'])))
+        return time.perf_counter() - started
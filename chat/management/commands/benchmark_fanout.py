@@ -0,0 +1,51 @@
+import asyncio
+import time
+import uuid
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from chat.groups import ShardedGroup
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure group_send fan-out through the configured channel layer for one large group, "
+        "split into different numbers of shards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=10000)
+        parser.add_argument('--messages', type=int, default=20)
+        parser.add_argument('--shards', default='1,4,16', help="Comma-separated shard counts to compare.")
+
+    def handle(self, *args, **options):
+        shard_counts = [int(value) for value in options['shards'].split(',')]
+        asyncio.run(self.run(options['members'], options['messages'], shard_counts))
+
+    async def run(self, members, messages, shard_counts):
+        layer = get_channel_layer()
+        channel_names = [await layer.new_channel() for _ in range(members)]
+        payload = {"type": "chat_broadcast", "text": "x" * 200, "sender_channel": None}
+
+        self.stdout.write(f"{members} members, {messages} messages per run")
+        for shards in shard_counts:
+            group = ShardedGroup(f"benchmark_fanout_{uuid.uuid4().hex[:8]}", shards)
+            await self.each(channel_names, lambda name: group.add(layer, name))
+
+            started = time.perf_counter()
+            for _ in range(messages):
+                await group.send(layer, payload)
+            elapsed = time.perf_counter() - started
+
+            await self.each(channel_names, lambda name: group.discard(layer, name))
+            self.stdout.write(
+                f"shards={shards:<3} {messages / elapsed:10.1f} msgs/s "
+                f"{members * messages / elapsed:12.0f} deliveries/s "
+                f"{elapsed / messages * 1000:8.1f} ms per message"
+            )
+
+    @staticmethod
+    async def each(channel_names, func, chunk_size=500):
+        for start in range(0, len(channel_names), chunk_size):
+            await asyncio.gather(*(func(name) for name in channel_names[start:start + chunk_size]))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from chat.read_state import get_read_state
+
+
+class Command(BaseCommand):
+    help = "Write buffered read cursors to ChannelMembership.last_seen."
+
+    def handle(self, *args, **options):
+        updated = get_read_state().flush()
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} memberships."))
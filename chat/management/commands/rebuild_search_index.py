@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from chat.crypto import decrypt_messages
+from chat.models import Message, MessageSearchToken
+from chat.search import build_tokens
+
+
+class Command(BaseCommand):
+    help = "Rebuild the blind search index from stored messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        MessageSearchToken.objects.all().delete()
+
+        indexed = 0
+        batch = []
+        messages = Message.objects.filter(is_deleted=False).only('id', 'channel_id', 'content')
+        for message in messages.iterator(chunk_size=batch_size):
+            batch.append(message)
+            if len(batch) >= batch_size:
+                indexed += self._index(batch)
+                batch = []
+        if batch:
+            indexed += self._index(batch)
+
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} messages."))
+
+    @staticmethod
+    def _index(messages):
+        tokens = []
+        for message in decrypt_messages(messages):
+            tokens.extend(build_tokens(message, message.plaintext))
+        MessageSearchToken.objects.bulk_create(tokens, ignore_conflicts=True)
+        return len(messages)
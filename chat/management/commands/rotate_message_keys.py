@@ -0,0 +1,97 @@
+import base64
+import binascii
+
+from cryptography.fernet import InvalidToken
+from django.core.management.base import BaseCommand
+from redis.exceptions import RedisError
+
+from chat.archive import pack_rows, unpack_rows
+from chat.crypto import get_cipher
+from chat.models import ArchivedMessageChunk, Message
+from chat.recent import recent_key
+from chat.redis_pool import get_sync_redis
+
+
+def is_fernet_token(value):
+    try:
+        data = base64.urlsafe_b64decode(value)
+    except (binascii.Error, ValueError):
+        return False
+    # Version byte, timestamp, IV, at least one AES block and the HMAC.
+    return len(data) >= 73 and data[0] == 0x80
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-encrypt stored message content, including archived messages, under the primary Fernet key. "
+        "Legacy plaintext content is encrypted, and the recent-message buffers are cleared."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        self.cipher = get_cipher()
+        self.counts = {"rotated": 0, "encrypted": 0, "unreadable": 0}
+        batch_size = options['batch_size']
+        batch = []
+
+        for message in Message.objects.only('id', 'content').iterator(chunk_size=batch_size):
+            message.content = self.rotate(message.content)
+            batch.append(message)
+            if len(batch) >= batch_size:
+                Message.objects.bulk_update(batch, ['content'])
+                batch = []
+
+        if batch:
+            Message.objects.bulk_update(batch, ['content'])
+
+        for chunk in ArchivedMessageChunk.objects.iterator(chunk_size=10):
+            rows = unpack_rows(chunk.data)
+            for row in rows:
+                row["content"] = self.rotate(row["content"])
+            chunk.data = pack_rows(rows)
+            chunk.save(update_fields=['data'])
+
+        self.stdout.write(self.style.SUCCESS(
+            "Rotated {rotated} messages and encrypted {encrypted} plaintext messages.".format(**self.counts)
+        ))
+        if self.counts["unreadable"]:
+            self.stderr.write(
+                f"Left {self.counts['unreadable']} messages encrypted under keys that are no longer configured."
+            )
+        self.clear_recent_buffers()
+
+    def rotate(self, content):
+        try:
+            content = self.cipher.rotate(content)
+            self.counts["rotated"] += 1
+        except InvalidToken:
+            # Ciphertext under a removed key is kept as is, so restoring the key recovers it.
+            if is_fernet_token(content):
+                self.counts["unreadable"] += 1
+            else:
+                content = self.cipher.encrypt(content)
+                self.counts["encrypted"] += 1
+        return content
+
+    def clear_recent_buffers(self):
+        """
+        Buffered messages still hold the old ciphertext; drop them so nothing
+        needs an old key once it is removed. History reads warm them again.
+        """
+        redis = get_sync_redis()
+        cleared = 0
+        try:
+            keys = []
+            for key in redis.scan_iter(match=recent_key("*"), count=1000):
+                keys.append(key)
+                if len(keys) >= 1000:
+                    cleared += redis.unlink(*keys)
+                    keys = []
+            if keys:
+                cleared += redis.unlink(*keys)
+        except RedisError:
+            self.stderr.write(f"Could not clear the recent-message buffers; delete the {recent_key('*')} keys.")
+            return
+        self.stdout.write(self.style.SUCCESS(f"Cleared {cleared} recent-message buffers."))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from chat.tracing import set_config
+
+
+class Command(BaseCommand):
+    help = (
+        "Turn tracing of slow messages and requests on or off for every worker, "
+        "or show the current setting. Workers pick up changes within a few seconds."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('state', nargs='?', choices=('on', 'off'))
+        parser.add_argument('--threshold-ms', type=float, help="Log traces slower than this.")
+        parser.add_argument('--sample-rate', type=float, help="Fraction of messages and requests to trace.")
+
+    def handle(self, *args, **options):
+        enabled = None if options['state'] is None else options['state'] == 'on'
+        config = set_config(enabled, options['threshold_ms'], options['sample_rate'])
+        if not config:
+            self.stdout.write("Tracing is not configured; workers use the CHAT_TRACING settings.")
+            return
+        self.stdout.write(", ".join(f"{key}={value}" for key, value in sorted(config.items())))
@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+from redis.exceptions import RedisError
+
+from chat.db import db_sync_to_async
+from chat.models import Channel, ChannelMembership
+from chat.redis_pool import get_redis, get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+MEMBER = 'member'
+NOT_MEMBER = 'not_member'
+NO_CHANNEL = 'no_channel'
+
+
+class MembershipCache:
+    """
+    Two-level cache of channel membership checks keyed on (user_id, channel_id).
+
+    A small in-process LRU with a short TTL sits in front of Redis, which holds
+    results for longer and is invalidated by signals whenever a ChannelMembership
+    row is saved or deleted. Other processes may keep a revoked entry for up to
+    ``local_ttl`` seconds. Missing channels are never cached.
+    """
+
+    def __init__(self, max_size=10000, local_ttl=5, redis_ttl=300):
+        self.max_size = max_size
+        self.local_ttl = local_ttl
+        self.redis_ttl = redis_ttl
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def redis_key(user_id, channel_id):
+        return f"chat:membership:{channel_id}:{user_id}"
+
+    async def aget_status(self, user_id, channel_id):
+        key = self.redis_key(user_id, channel_id)
+        status = self._get_local(key)
+        if status is not None:
+            return status
+
+        try:
+            status = await get_redis().get(key)
+        except RedisError:
+            logger.warning("Membership cache unavailable; falling back to the database.")
+            status = None
+
+        if status is None:
+            status = await db_sync_to_async(self._query)(user_id, channel_id)
+            if status != NO_CHANNEL:
+                try:
+                    await get_redis().set(key, status, ex=self.redis_ttl)
+                except RedisError:
+                    pass
+
+        self._set_local(key, status)
+        return status
+
+    def get_status(self, user_id, channel_id):
+        key = self.redis_key(user_id, channel_id)
+        status = self._get_local(key)
+        if status is not None:
+            return status
+
+        try:
+            status = get_sync_redis().get(key)
+        except RedisError:
+            status = None
+
+        if status is None:
+            status = self._query(user_id, channel_id)
+            if status != NO_CHANNEL:
+                try:
+                    get_sync_redis().set(key, status, ex=self.redis_ttl)
+                except RedisError:
+                    pass
+
+        self._set_local(key, status)
+        return status
+
+    def invalidate(self, user_id, channel_id):
+        key = self.redis_key(user_id, channel_id)
+        with self._lock:
+            self._local.pop(key, None)
+        try:
+            get_sync_redis().delete(key)
+        except RedisError:
+            logger.warning("Could not invalidate membership cache key %s.", key)
+
+    @staticmethod
+    def _query(user_id, channel_id):
+        """Resolve channel existence and membership in a single query."""
+        is_member = (
+            Channel.objects.filter(pk=channel_id)
+            .annotate(is_member=Exists(
+                ChannelMembership.objects.filter(channel=OuterRef('pk'), user_id=user_id)
+            ))
+            .values_list('is_member', flat=True)
+            .first()
+        )
+        if is_member is None:
+            return NO_CHANNEL
+        return MEMBER if is_member else NOT_MEMBER
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            status, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+            return status
+
+    def _set_local(self, key, status):
+        if status == NO_CHANNEL:
+            return
+        with self._lock:
+            self._local[key] = (status, time.monotonic() + self.local_ttl)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+
+_cache = None
+
+
+def get_membership_cache():
+    global _cache
+    if _cache is None:
+        _cache = MembershipCache(
+            max_size=settings.CHAT_MEMBERSHIP_CACHE_SIZE,
+            local_ttl=settings.CHAT_MEMBERSHIP_LOCAL_TTL,
+            redis_ttl=settings.CHAT_MEMBERSHIP_REDIS_TTL,
+        )
+    return _cache
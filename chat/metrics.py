@@ -0,0 +1,307 @@
+"""
+Process-local metrics, aggregated across workers through Redis.
+
+Counters, gauges and histograms are plain in-memory dicts updated on the hot
+path. Components that already count for themselves (queues, pools, caches)
+are exported as collected metrics, read from their ``stats()`` when a
+snapshot is taken. Each process publishes a snapshot to Redis every few seconds, and the
+``/metrics`` view sums the live snapshots of all processes into the
+Prometheus text format.
+"""
+import asyncio
+import bisect
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from chat import protocol
+from chat.lifespan import on_shutdown
+from chat.redis_pool import get_redis, get_sync_redis, pool_stats
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOTS_KEY = "metrics:snapshots"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    """A value that goes up and down, e.g. open connections. Summed across processes."""
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+class CollectedMetric(Metric):
+    """
+    A counter or gauge whose values are read when a snapshot is taken.
+    ``collect`` returns a number, a dict of label-value tuples to numbers,
+    or None while the component it reads has not been created.
+    """
+
+    def __init__(self, name, documentation, kind, collect, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self.collect = collect
+
+    def snapshot(self):
+        try:
+            values = self.collect()
+        except Exception:
+            logger.exception("Failed to collect %s.", self.name)
+            return []
+        if values is None:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [[[str(label) for label in key], value] for key, value in values.items()]
+
+
+REGISTRY = []
+
+CONNECTIONS = Gauge("chat_websocket_connections", "Open WebSocket connections.", ["consumer"])
+FRAMES_RECEIVED = Counter("chat_frames_received_total", "Inbound WebSocket frames by kind.", ["consumer", "kind"])
+MESSAGES_SAVED = Counter("chat_messages_saved_total", "Chat messages persisted or queued for persistence.")
+ERRORS = Counter("chat_errors_sent_total", "Error events sent to clients.", ["consumer"])
+RATE_LIMITED = Counter("chat_rate_limited_total", "Writes rejected by the rate limiter.", ["scope"])
+SAVE_SECONDS = Histogram("chat_save_message_seconds", "Time to encrypt and save one chat message.")
+GROUP_SEND_SECONDS = Histogram("chat_group_send_seconds", "Time to hand a broadcast to the channel layer.")
+EVENT_LOOP_LAG_SECONDS = Histogram("chat_event_loop_lag_seconds", "How late the event loop runs a scheduled wake-up.")
+HTTP_REQUESTS = Counter("chat_http_requests_total", "API requests.", ["view", "method", "status"])
+HTTP_SECONDS = Histogram("chat_http_request_seconds", "API request latency.", ["view", "method"])
+HTTP_QUERIES = Histogram(
+    "chat_http_request_db_queries", "Database queries per API request.", ["view"], buckets=QUERY_BUCKETS
+)
+REDIS_POOL_CONNECTIONS = CollectedMetric(
+    "chat_redis_pool_connections", "Connections of the shared Redis pools.", "gauge",
+    lambda: {(pool, state): stats[state] for pool, stats in pool_stats().items() for state in ("in_use", "idle")},
+    ["pool", "state"],
+)
+REDIS_POOL_MAX_CONNECTIONS = CollectedMetric(
+    "chat_redis_pool_max_connections", "Connection limit of the shared Redis pools.", "gauge",
+    lambda: {(pool,): stats["max"] for pool, stats in pool_stats().items() if stats["max"] is not None},
+    ["pool"],
+)
+
+
+def snapshot():
+    return {metric.name: metric.snapshot() for metric in REGISTRY}
+
+
+class MetricsPublisher:
+    """
+    Publishes this process's metrics to Redis for the ``/metrics`` view.
+
+    Snapshots are stored under the process id with the time they were taken;
+    snapshots older than ``max_age`` belong to processes that are gone and
+    are dropped when read.
+    """
+
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self.process_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.max_age = interval * 3
+        self._published_at = 0
+        self._task = None
+
+    def _payload(self):
+        return protocol.dumps({"at": time.time(), "metrics": snapshot()})
+
+    def ensure_started(self):
+        """Publish periodically from the running event loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            on_shutdown(self.stop)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await get_redis().hdel(SNAPSHOTS_KEY, self.process_id)
+        except RedisError:
+            pass
+
+    async def _run(self):
+        while True:
+            try:
+                await get_redis().hset(SNAPSHOTS_KEY, self.process_id, self._payload())
+            except RedisError:
+                logger.warning("Failed to publish metrics.")
+            await asyncio.sleep(self.interval)
+
+    def maybe_publish(self):
+        """Publish from synchronous code, at most once per interval."""
+        if time.monotonic() - self._published_at < self.interval:
+            return
+        self._published_at = time.monotonic()
+        try:
+            get_sync_redis().hset(SNAPSHOTS_KEY, self.process_id, self._payload())
+        except RedisError:
+            logger.warning("Failed to publish metrics.")
+
+    def collect(self):
+        """Live snapshots of every process, this one always fresh."""
+        redis = get_sync_redis()
+        redis.hset(SNAPSHOTS_KEY, self.process_id, self._payload())
+        self._published_at = time.monotonic()
+        snapshots = []
+        stale = []
+        for process_id, payload in redis.hgetall(SNAPSHOTS_KEY).items():
+            data = json.loads(payload)
+            if time.time() - data["at"] > self.max_age:
+                stale.append(process_id)
+            else:
+                snapshots.append(data["metrics"])
+        if stale:
+            redis.hdel(SNAPSHOTS_KEY, *stale)
+        return snapshots
+
+
+def render(snapshots):
+    """Sum process snapshots into the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        totals = {}
+        for metrics in snapshots:
+            for key, value in metrics.get(metric.name, []):
+                key = tuple(key)
+                if metric.kind == "histogram":
+                    total = totals.setdefault(key, [[0] * len(value[0]), 0.0, 0])
+                    total[0] = [a + b for a, b in zip(total[0], value[0])]
+                    total[1] += value[1]
+                    total[2] += value[2]
+                else:
+                    totals[key] = totals.get(key, 0) + value
+
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for key, value in sorted(totals.items()):
+            labels = list(zip(metric.labelnames, key))
+            if metric.kind != "histogram":
+                lines.append(f"{metric.name}{_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float("inf"),), value[0]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{metric.name}_bucket{_labels(labels + [('le', le)])} {cumulative}")
+            lines.append(f"{metric.name}_sum{_labels(labels)} {value[1]}")
+            lines.append(f"{metric.name}_count{_labels(labels)} {value[2]}")
+    return "\n".join(lines) + "\n"
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class MetricsMiddleware:
+    """Counts and times API requests, including the database queries each one runs."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not request.path.startswith("/api/"):
+            return self.get_response(request)
+
+        from django.db import connection
+
+        queries = [0]
+
+        def count(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count):
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = match.url_name if match is not None and match.url_name else "unmatched"
+        HTTP_REQUESTS.inc(view=view, method=request.method, status=response.status_code)
+        HTTP_SECONDS.observe(elapsed, view=view, method=request.method)
+        HTTP_QUERIES.observe(queries[0], view=view)
+        get_publisher().maybe_publish()
+        return response
+
+
+_publisher = None
+
+
+def get_publisher():
+    global _publisher
+    if _publisher is None:
+        _publisher = MetricsPublisher(interval=settings.CHAT_METRICS_INTERVAL)
+    return _publisher
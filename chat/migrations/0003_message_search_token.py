@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_message_history_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=32)),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.channel')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', related_query_name='search_token', to='chat.message')),
+            ],
+            options={
+                'verbose_name': 'Message Search Token',
+                'verbose_name_plural': 'Message Search Tokens',
+                'indexes': [models.Index(fields=['token', 'channel'], name='chat_search_token_idx')],
+                'unique_together': {('message', 'token')},
+            },
+        ),
+    ]
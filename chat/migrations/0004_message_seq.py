@@ -0,0 +1,37 @@
+from django.db import migrations, models
+
+
+def number_existing_messages(apps, schema_editor):
+    """Give existing messages sequence numbers in (timestamp, id) order per channel."""
+    Message = apps.get_model('chat', 'Message')
+    channel_ids = Message.objects.values_list('channel_id', flat=True).distinct()
+    for channel_id in channel_ids:
+        batch = []
+        messages = Message.objects.filter(channel_id=channel_id).order_by('timestamp', 'id').only('id')
+        for seq, message in enumerate(messages.iterator(chunk_size=1000), start=1):
+            message.seq = seq
+            batch.append(message)
+            if len(batch) >= 1000:
+                Message.objects.bulk_update(batch, ['seq'])
+                batch = []
+        Message.objects.bulk_update(batch, ['seq'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message_search_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(number_existing_messages, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('channel', 'seq'), name='chat_message_channel_seq'),
+        ),
+    ]
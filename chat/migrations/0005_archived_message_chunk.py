@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_seq'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessageChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_seq', models.BigIntegerField()),
+                ('last_seq', models.BigIntegerField()),
+                ('first_timestamp', models.DateTimeField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_chunks', related_query_name='archived_chunk', to='chat.channel')),
+            ],
+            options={
+                'verbose_name': 'Archived Message Chunk',
+                'verbose_name_plural': 'Archived Message Chunks',
+                'indexes': [models.Index(fields=['channel', 'last_timestamp'], name='chat_archive_time_idx'), models.Index(fields=['channel', 'last_seq'], name='chat_archive_seq_idx')],
+            },
+        ),
+    ]
@@ -106,8 +106,12 @@ class ChannelMembership(models.Model):
         verbose_name_plural = 'Channel Memberships'
 
     def update_last_seen(self):
+        """
+        Write last_seen immediately. Chat clients go through chat.read_state instead,
+        which buffers read cursors and flushes them in batches.
+        """
         self.last_seen = now()
-        self.save()
+        self.save(update_fields=['last_seen'])
 
 
 class Message(models.Model):
@@ -128,19 +132,37 @@ class Message(models.Model):
         related_query_name='message_sender'
     )
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the message is created, not when it is written: write-behind saves it later.
+    timestamp = models.DateTimeField(default=now, editable=False)
     edited_at = models.DateTimeField(null=True, blank=True)
     is_deleted = models.BooleanField(default=False)
+    # Per-channel position assigned by chat.sequence when the message is saved.
+    seq = models.BigIntegerField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return f"{self.sender.username}: {self.content[:50]}"
 
     class Meta:
-        indexes = [models.Index(fields=['timestamp'])]
+        indexes = [
+            models.Index(fields=['timestamp']),
+            models.Index(fields=['channel', 'timestamp', 'id'], name='chat_message_history_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['channel', 'seq'], name='chat_message_channel_seq'),
+        ]
         ordering = ['timestamp']
         verbose_name = 'Message'
         verbose_name_plural = 'Messages'
 
+    def save(self, *args, **kwargs):
+        # Messages created outside the chat paths, e.g. in the admin, still need a position:
+        # history and archiving assume every message has one.
+        if self._state.adding and self.seq is None:
+            from chat.sequence import get_channel_sequence
+
+            self.seq, = get_channel_sequence().allocate(self.channel_id)
+        super().save(*args, **kwargs)
+
     def edit(self, new_content):
         """Edit the message content and record the edit timestamp."""
         self.content = new_content
@@ -151,3 +173,57 @@ class Message(models.Model):
         """Soft delete the message."""
         self.is_deleted = True
         self.save()
+
+
+class MessageSearchToken(models.Model):
+    """
+    Blind index entry for message search.
+    Holds a keyed hash of one word of a message, never the word itself.
+    """
+    message = models.ForeignKey(
+        Message,
+        on_delete=models.CASCADE,
+        related_name='search_tokens',
+        related_query_name='search_token'
+    )
+    channel = models.ForeignKey(
+        Channel,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    token = models.CharField(max_length=32)
+
+    class Meta:
+        unique_together = ('message', 'token')
+        indexes = [models.Index(fields=['token', 'channel'], name='chat_search_token_idx')]
+        verbose_name = 'Message Search Token'
+        verbose_name_plural = 'Message Search Tokens'
+
+
+class ArchivedMessageChunk(models.Model):
+    """
+    A run of a channel's old messages moved out of the Message table.
+    Holds up to a few hundred consecutive messages as one compressed document.
+    """
+    channel = models.ForeignKey(
+        Channel,
+        on_delete=models.CASCADE,
+        related_name='archived_chunks',
+        related_query_name='archived_chunk'
+    )
+    first_seq = models.BigIntegerField()
+    last_seq = models.BigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    # zlib-compressed JSON list of message rows, content still encrypted.
+    data = models.BinaryField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['channel', 'last_timestamp'], name='chat_archive_time_idx'),
+            models.Index(fields=['channel', 'last_seq'], name='chat_archive_seq_idx'),
+        ]
+        verbose_name = 'Archived Message Chunk'
+        verbose_name_plural = 'Archived Message Chunks'
@@ -0,0 +1,123 @@
+import base64
+import binascii
+import uuid
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+
+
+class MessageCursorPaginator:
+    """
+    Keyset pagination over a channel's messages ordered by (timestamp, id).
+
+    Each page is fetched with an indexed range scan on (channel, timestamp, id),
+    so the cost of a page does not depend on how deep into history it is.
+    Clients pass one of ``before``, ``after`` or ``around`` with an opaque
+    cursor returned by a previous page; without a cursor the newest page is returned.
+    Results are always ordered newest first.
+
+    With an ``archive`` (a ``chat.archive.ChannelArchive``), pages continue into
+    archived messages once the table runs out; the archive only holds messages
+    older than everything left in the table.
+    """
+    default_limit = 50
+    max_limit = 200
+
+    cursor_params = ('before', 'after', 'around')
+
+    def __init__(self, archive=None):
+        self.archive = archive
+
+    def is_first_page(self, request):
+        """True when the request asks for the newest page, without a cursor."""
+        return not any(request.query_params.get(param) for param in self.cursor_params)
+
+    def paginate(self, queryset, request):
+        """Return a page dict with ``results``, ``next`` (older) and ``previous`` (newer)."""
+        limit = self.get_limit(request)
+        params = request.query_params
+
+        if params.get('around'):
+            results, has_older, has_newer = self._around(queryset, self.decode_cursor(params['around']), limit)
+        elif params.get('after'):
+            results, has_newer = self._newer(queryset, self.decode_cursor(params['after']), limit, inclusive=False)
+            has_older = True
+        elif params.get('before'):
+            results, has_older = self._older(queryset, self.decode_cursor(params['before']), limit, inclusive=False)
+            has_newer = True
+        else:
+            results, has_older = self._older(queryset, None, limit, inclusive=False)
+            has_newer = False
+
+        return self.get_page(results, has_older, has_newer)
+
+    def get_page(self, results, has_older, has_newer):
+        """Build a page from newest-first ``results``."""
+        return {
+            'results': results,
+            'next': self.encode_cursor(results[-1]) if results and has_older else None,
+            'previous': self.encode_cursor(results[0]) if results and has_newer else None,
+        }
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get('limit', self.default_limit))
+        except (TypeError, ValueError):
+            raise ValidationError({'limit': 'Must be an integer.'})
+        if limit < 1:
+            raise ValidationError({'limit': 'Must be a positive integer.'})
+        return min(limit, self.max_limit)
+
+    @staticmethod
+    def encode_cursor(message):
+        raw = f"{message.timestamp.isoformat()}|{message.id}"
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+            timestamp, message_id = raw.split('|', 1)
+            timestamp = parse_datetime(timestamp)
+            message_id = uuid.UUID(message_id)
+        except (binascii.Error, UnicodeError, ValueError):
+            raise ValidationError({'cursor': 'Invalid cursor.'})
+        if timestamp is None:
+            raise ValidationError({'cursor': 'Invalid cursor.'})
+        return timestamp, message_id
+
+    def _older(self, queryset, position, limit, inclusive):
+        """Messages at or before ``position``, newest first."""
+        if position is not None:
+            timestamp, message_id = position
+            id_lookup = 'id__lte' if inclusive else 'id__lt'
+            queryset = queryset.filter(
+                Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, **{id_lookup: message_id})
+            )
+        rows = list(queryset.order_by('-timestamp', '-id')[:limit + 1])
+        if self.archive is not None and len(rows) <= limit:
+            rows += self.archive.older(position, limit + 1 - len(rows), inclusive)
+        return rows[:limit], len(rows) > limit
+
+    def _newer(self, queryset, position, limit, inclusive):
+        """Messages at or after ``position``, returned newest first."""
+        timestamp, message_id = position
+        rows = self.archive.newer(position, limit + 1, inclusive) if self.archive is not None else []
+        if len(rows) <= limit:
+            id_lookup = 'id__gte' if inclusive else 'id__gt'
+            queryset = queryset.filter(
+                Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, **{id_lookup: message_id})
+            )
+            rows += queryset.order_by('timestamp', 'id')[:limit + 1 - len(rows)]
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        return rows, has_more
+
+    def _around(self, queryset, position, limit):
+        """The message at ``position`` with up to ``limit`` messages split on either side."""
+        newer_limit = limit // 2
+        older, has_older = self._older(queryset, position, limit - newer_limit, inclusive=True)
+        newer, has_newer = self._newer(queryset, position, newer_limit, inclusive=False) if newer_limit else ([], True)
+        return newer + older, has_older, has_newer
@@ -0,0 +1,264 @@
+import asyncio
+import atexit
+import logging
+from collections import Counter
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, transaction
+from django.utils.timezone import now
+from redis.exceptions import RedisError
+
+from chat.db import db_sync_to_async
+from chat.metrics import CollectedMetric
+from chat.lifespan import on_shutdown
+from chat.models import Message, MessageSearchToken
+from chat.read_state import get_read_state
+from chat.recent import get_recent_messages
+from chat.search import build_tokens, index_message
+from chat.sequence import get_channel_sequence
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriteBehindQueue:
+    """
+    Per-process buffer that persists chat messages with ``bulk_create``.
+
+    Consumers enqueue unsaved ``Message`` instances (with their search index rows
+    in ``pending_search_tokens``) and carry on; a background
+    task flushes the buffer when it reaches ``max_batch_size`` or every
+    ``flush_interval`` seconds. Whatever is left is flushed on shutdown.
+
+    A batch that violates a constraint (say its channel was deleted meanwhile)
+    is split in halves until the offending rows are isolated; those are logged
+    and dropped and the rest is written. Other failures put the batch back at
+    the head of the queue to retry with backoff, up to ``max_retries`` times
+    before it is salvaged the same way. At most ``max_pending`` messages wait;
+    beyond that the oldest are dropped.
+    """
+
+    def __init__(self, max_batch_size=100, flush_interval=0.5, retry_delay=1.0, max_retries=5, max_pending=10000):
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        self.max_pending = max_pending
+        self._pending = []
+        self._attempts = 0
+        self._wakeup = None
+        self._task = None
+        self._closed = False
+        self.flushed = 0
+        self.failures = 0
+        self.dropped = 0
+
+    @property
+    def depth(self):
+        """Number of messages waiting to be written."""
+        return len(self._pending)
+
+    def stats(self):
+        return {"depth": self.depth, "flushed": self.flushed, "failures": self.failures, "dropped": self.dropped}
+
+    def enqueue(self, message):
+        self._pending.append(message)
+        if len(self._pending) > self.max_pending:
+            overflow = len(self._pending) - self.max_pending
+            del self._pending[:overflow]
+            self.dropped += overflow
+            logger.error("Write-behind queue full; dropped %d queued messages.", overflow)
+        self._ensure_worker()
+        if len(self._pending) >= self.max_batch_size:
+            self._wakeup.set()
+
+    def _ensure_worker(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._closed = False
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not await self.flush():
+                await asyncio.sleep(self.retry_delay)
+
+    async def flush(self):
+        """Write everything currently queued. Returns False if a batch failed."""
+        while self._pending:
+            batch = self._pending[:self.max_batch_size]
+            del self._pending[:len(batch)]
+            try:
+                await db_sync_to_async(self._write)(batch)
+            except (IntegrityError, DataError):
+                self.failures += 1
+                logger.exception("Queued batch of %d messages was rejected; writing it in parts.", len(batch))
+                await db_sync_to_async(self._salvage)(batch)
+            except Exception:
+                self.failures += 1
+                self._attempts += 1
+                if self._attempts < self.max_retries:
+                    self._pending[:0] = batch
+                    logger.exception("Failed to persist %d queued messages; will retry.", len(batch))
+                    return False
+                logger.exception("Failed to persist %d queued messages; writing it in parts.", len(batch))
+                try:
+                    await db_sync_to_async(self._salvage)(batch)
+                except Exception:
+                    self.dropped += len(batch)
+                    logger.exception("Dropped %d queued messages.", len(batch))
+            self._attempts = 0
+        return True
+
+    async def close(self):
+        """Stop the background task and flush what is left."""
+        self._closed = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def flush_sync(self):
+        """Last-resort flush for interpreter shutdown, outside any event loop."""
+        while self._pending:
+            batch = self._pending[:self.max_batch_size]
+            del self._pending[:len(batch)]
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception("Failed to persist %d queued messages at shutdown; writing it in parts.", len(batch))
+                self._salvage(batch)
+
+    def _write(self, batch):
+        tokens = [token for message in batch for token in getattr(message, 'pending_search_tokens', ())]
+        with transaction.atomic():
+            Message.objects.bulk_create(batch, batch_size=self.max_batch_size)
+            MessageSearchToken.objects.bulk_create(tokens, batch_size=1000, ignore_conflicts=True)
+        self.flushed += len(batch)
+        # Counted once committed; a failure here must not make the batch look unwritten.
+        try:
+            for channel_id, count in Counter(message.channel_id for message in batch).items():
+                get_read_state().record_message(channel_id, count)
+        except RedisError:
+            logger.warning("Failed to count %d written messages for unread counts.", len(batch))
+
+    def _salvage(self, batch):
+        """
+        Write the halves of a failed batch separately, recursing into halves
+        that fail too; single messages that still cannot be written are dropped.
+        """
+        if len(batch) == 1:
+            self.dropped += 1
+            logger.error("Dropped queued message %s that could not be written.", batch[0].pk)
+            return
+        middle = len(batch) // 2
+        for half in (batch[:middle], batch[middle:]):
+            try:
+                self._write(half)
+            except Exception:
+                self._salvage(half)
+
+
+def create_message(plaintext, **fields):
+    """Insert a message and its search index rows in one thread hop."""
+    with transaction.atomic():
+        message = Message.objects.create(**fields)
+        index_message(message, plaintext, created=True)
+    return message
+
+
+def apply_message_batch(channel_id, sender, sends=(), edits=(), deletes=()):
+    """
+    Apply a client batch of message operations in one transaction.
+
+    ``sends`` are ``(encrypted, plaintext)`` pairs, ``edits`` are
+    ``(message_id, encrypted, plaintext)`` triples and ``deletes`` are message ids.
+    Edits and deletes only apply to the sender's own live messages in the channel.
+    Returns the created messages, the edited messages and the ids actually deleted.
+    """
+    seqs = get_channel_sequence().allocate(channel_id, len(sends)) if sends else ()
+    with transaction.atomic():
+        created = [
+            Message(channel_id=channel_id, sender=sender, content=encrypted, seq=seq)
+            for (encrypted, _), seq in zip(sends, seqs)
+        ]
+        Message.objects.bulk_create(created)
+        tokens = [
+            token
+            for message, (_, plaintext) in zip(created, sends)
+            for token in build_tokens(message, plaintext)
+        ]
+
+        own = Message.objects.filter(channel_id=channel_id, sender=sender, is_deleted=False)
+        edited = []
+        if edits:
+            found = own.in_bulk([message_id for message_id, _, _ in edits])
+            edited_at = now()
+            for message_id, encrypted, plaintext in edits:
+                message = found.get(message_id)
+                if message is None:
+                    continue
+                message.sender = sender
+                message.content = encrypted
+                message.edited_at = edited_at
+                edited.append(message)
+                tokens.extend(build_tokens(message, plaintext))
+            Message.objects.bulk_update(edited, ['content', 'edited_at'])
+
+        deleted = []
+        if deletes:
+            deleted = list(own.filter(pk__in=deletes))
+            own.filter(pk__in=[message.pk for message in deleted]).update(is_deleted=True)
+            for message in deleted:
+                message.sender = sender
+                message.is_deleted = True
+
+        stale = [message.pk for message in edited + deleted]
+        if stale:
+            MessageSearchToken.objects.filter(message_id__in=stale).delete()
+        MessageSearchToken.objects.bulk_create(tokens, batch_size=1000, ignore_conflicts=True)
+
+    recent = get_recent_messages()
+    if created:
+        recent.add(channel_id, created)
+    if edited or deleted:
+        recent.replace(channel_id, edited + deleted)
+    return created, edited, [message.pk for message in deleted]
+
+
+_queue = None
+
+
+def get_message_queue():
+    """Return the process-wide write-behind queue."""
+    global _queue
+    if _queue is None:
+        _queue = MessageWriteBehindQueue(
+            max_batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+            flush_interval=settings.CHAT_WRITE_BEHIND_INTERVAL,
+            max_retries=settings.CHAT_WRITE_BEHIND_MAX_RETRIES,
+            max_pending=settings.CHAT_WRITE_BEHIND_MAX_PENDING,
+        )
+        on_shutdown(_queue.close)
+        atexit.register(_queue.flush_sync)
+    return _queue
+
+
+QUEUE_DEPTH = CollectedMetric(
+    "chat_write_behind_queue_depth", "Messages waiting in the write-behind queue.", "gauge",
+    lambda: None if _queue is None else _queue.stats()["depth"],
+)
+QUEUE_MESSAGES = CollectedMetric(
+    "chat_write_behind_messages_total", "Queued messages written or dropped.", "counter",
+    lambda: None if _queue is None else {(outcome,): _queue.stats()[outcome] for outcome in ("flushed", "dropped")},
+    ["outcome"],
+)
+QUEUE_FAILURES = CollectedMetric(
+    "chat_write_behind_failures_total", "Failed write-behind batch writes.", "counter",
+    lambda: None if _queue is None else _queue.stats()["failures"],
+)
@@ -0,0 +1,338 @@
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from chat import protocol
+from chat.db import db_sync_to_async
+from chat.fanout import get_fanout_hub
+from chat.lifespan import on_shutdown
+from chat.models import ChannelMembership
+from chat.redis_pool import get_redis, get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_GROUP = "presence_updates"
+ONLINE_USERS_KEY = "presence:online"
+ANONYMOUS_CONNECTIONS_KEY = "presence:anonymous"
+CHANGED_KEY = "presence:changed"
+TICK_LOCK_KEY = "presence:tick_lock"
+ANONYMOUS_MARKER = "anonymous"
+
+# Removes one connection and recomputes the user's expiry from the ones left,
+# atomically, so a closing tab never hides a user's other open tabs.
+DISCONNECT_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+local latest = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+if #latest == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[3])
+    return 0
+end
+redis.call('ZADD', KEYS[2], latest[2], ARGV[3])
+return 1
+"""
+
+
+def connections_key(user_id):
+    return f"presence:connections:{user_id}"
+
+
+def channel_online_key(channel_id):
+    return f"presence:channel:{channel_id}"
+
+
+def channel_group(channel_id):
+    return f"presence_channel_{channel_id}"
+
+
+def team_group(team_id):
+    return f"presence_team_{team_id}"
+
+
+def mark_changed(pipeline, member):
+    """Queue a presence change for the next aggregator tick on an open pipeline."""
+    pipeline.sadd(CHANGED_KEY, member)
+
+
+class PresenceStore:
+    """
+    Redis-backed presence built on expiring connection entries.
+
+    Every connection is a member of a per-user sorted set scored by its expiry
+    time, and ``presence:online`` holds each user's latest expiry, so "is user X
+    online" is a single ZSCORE. Workers refresh their own connections every
+    ``heartbeat_interval`` seconds; connections of a crashed worker simply stop
+    being refreshed, expire after ``ttl`` seconds and are cleared by ``sweep``.
+
+    Each channel also has a set of its online members, kept by the aggregator,
+    so "who is online here" reads one set instead of the channel's member list.
+    Members are still checked against their expiry, so the set may lag by a tick.
+    """
+
+    def __init__(self, ttl=30, heartbeat_interval=10):
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        # connection_id -> user_id (None for anonymous) for sockets on this worker
+        self.local_connections = {}
+        self._disconnect_script = None
+
+    async def connect(self, connection_id, user_id=None):
+        self.local_connections[connection_id] = user_id
+        pipeline = get_redis().pipeline()
+        self._refresh(pipeline, connection_id, user_id, time.time() + self.ttl)
+        mark_changed(pipeline, ANONYMOUS_MARKER if user_id is None else user_id)
+        await pipeline.execute()
+
+    async def disconnect(self, connection_id, user_id=None):
+        self.local_connections.pop(connection_id, None)
+        redis = get_redis()
+        if user_id is None:
+            pipeline = redis.pipeline()
+            pipeline.zrem(ANONYMOUS_CONNECTIONS_KEY, connection_id)
+            mark_changed(pipeline, ANONYMOUS_MARKER)
+            await pipeline.execute()
+            return
+
+        if self._disconnect_script is None:
+            self._disconnect_script = redis.register_script(DISCONNECT_SCRIPT)
+        still_online = await self._disconnect_script(
+            keys=[connections_key(user_id), ONLINE_USERS_KEY],
+            args=[connection_id, time.time(), user_id],
+        )
+        if not still_online:
+            await redis.sadd(CHANGED_KEY, user_id)
+
+    async def heartbeat(self):
+        """Extend the expiry of every connection held by this worker."""
+        if not self.local_connections:
+            return
+        expires_at = time.time() + self.ttl
+        pipeline = get_redis().pipeline(transaction=False)
+        for connection_id, user_id in self.local_connections.items():
+            self._refresh(pipeline, connection_id, user_id, expires_at)
+        await pipeline.execute()
+
+    def _refresh(self, pipeline, connection_id, user_id, expires_at):
+        if user_id is None:
+            pipeline.zadd(ANONYMOUS_CONNECTIONS_KEY, {connection_id: expires_at})
+            return
+        key = connections_key(user_id)
+        pipeline.zadd(key, {connection_id: expires_at})
+        pipeline.expire(key, int(self.ttl) + 1)
+        pipeline.zadd(ONLINE_USERS_KEY, {user_id: expires_at}, gt=True)
+
+    async def sweep(self):
+        """Drop expired connections left behind by dead workers and flag the affected users."""
+        now = time.time()
+        redis = get_redis()
+        expired = await redis.zrangebyscore(ONLINE_USERS_KEY, "-inf", now)
+
+        pipeline = redis.pipeline()
+        pipeline.zremrangebyscore(ANONYMOUS_CONNECTIONS_KEY, "-inf", now)
+        # Only removes users whose expiry was not pushed forward in the meantime.
+        pipeline.zremrangebyscore(ONLINE_USERS_KEY, "-inf", now)
+        for user_id in expired:
+            mark_changed(pipeline, user_id)
+        anonymous_removed = (await pipeline.execute())[0]
+        if anonymous_removed:
+            await redis.sadd(CHANGED_KEY, ANONYMOUS_MARKER)
+
+    async def is_online(self, user_id):
+        score = await get_redis().zscore(ONLINE_USERS_KEY, user_id)
+        return score is not None and score > time.time()
+
+    async def online_user_ids(self, user_ids):
+        """Return the subset of ``user_ids`` that currently have a live connection."""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        scores = await get_redis().zmscore(ONLINE_USERS_KEY, user_ids)
+        return self._filter_online(user_ids, scores)
+
+    def online_user_ids_sync(self, user_ids):
+        """Blocking variant of ``online_user_ids`` for views."""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        scores = get_sync_redis().zmscore(ONLINE_USERS_KEY, user_ids)
+        return self._filter_online(user_ids, scores)
+
+    @staticmethod
+    def _filter_online(user_ids, scores):
+        now = time.time()
+        return {user_id for user_id, score in zip(user_ids, scores) if score is not None and score > now}
+
+    async def online_in_channel(self, channel_id):
+        """Ids of the channel's members who are online."""
+        members = await get_redis().smembers(channel_online_key(channel_id))
+        return await self.online_user_ids(int(member) for member in members)
+
+    def online_in_channel_sync(self, channel_id):
+        """Blocking variant of ``online_in_channel`` for views."""
+        members = get_sync_redis().smembers(channel_online_key(channel_id))
+        return self.online_user_ids_sync(int(member) for member in members)
+
+    def member_added(self, user_id):
+        """Pick up a new membership at the next tick, as if the user's presence changed."""
+        try:
+            get_sync_redis().sadd(CHANGED_KEY, user_id)
+        except RedisError:
+            logger.warning("Could not flag user %s for a presence update.", user_id)
+
+    def member_removed(self, user_id, channel_id):
+        try:
+            get_sync_redis().srem(channel_online_key(channel_id), user_id)
+        except RedisError:
+            logger.warning("Could not remove user %s from channel %s presence.", user_id, channel_id)
+
+    async def counts(self):
+        """Current connection counts, as sent to the global presence group."""
+        now = time.time()
+        pipeline = get_redis().pipeline()
+        pipeline.zcount(ONLINE_USERS_KEY, now, "+inf")
+        pipeline.zcount(ANONYMOUS_CONNECTIONS_KEY, now, "+inf")
+        logged_in, anonymous = await pipeline.execute()
+
+        return {
+            "logged_in_users": logged_in,
+            "anonymous_users": anonymous,
+            "total_connections": logged_in + anonymous
+        }
+
+
+class PresenceAggregator:
+    """
+    Coalesces presence changes into one broadcast per tick across all workers.
+
+    Presence changes are recorded as user ids in a Redis set. Every ``interval``
+    seconds each worker with presence sockets tries to take a short Redis lock;
+    the holder sweeps expired connections, drains the set, sends fresh counts to
+    the global group and per-scope deltas (who came online / went offline) to the
+    channel and team groups those users belong to, and updates the channels'
+    online sets. The same loop sends this worker's heartbeats. After its last
+    presence socket closes, a worker runs one more tick before stopping, so
+    changes marked during the previous tick are not left behind.
+    """
+
+    def __init__(self, store, interval=1.0):
+        self.store = store
+        self.interval = interval
+        self._consumers = 0
+        self._task = None
+
+    def attach(self):
+        self._consumers += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            on_shutdown(self.stop)
+
+    def detach(self):
+        self._consumers = max(self._consumers - 1, 0)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        next_heartbeat = time.monotonic() + self.store.heartbeat_interval
+        while True:
+            idle = not self._consumers
+            await asyncio.sleep(self.interval)
+            try:
+                if time.monotonic() >= next_heartbeat:
+                    await self.store.heartbeat()
+                    next_heartbeat = time.monotonic() + self.store.heartbeat_interval
+                await self.tick()
+            except Exception:
+                logger.exception("Presence tick failed.")
+            if idle and not self._consumers:
+                return
+
+    async def tick(self):
+        redis = get_redis()
+        if not await redis.set(TICK_LOCK_KEY, "1", nx=True, px=int(self.interval * 1000)):
+            return
+
+        await self.store.sweep()
+        pipeline = redis.pipeline(transaction=True)
+        pipeline.smembers(CHANGED_KEY)
+        pipeline.delete(CHANGED_KEY)
+        changed, _ = await pipeline.execute()
+        if not changed:
+            return
+
+        hub = get_fanout_hub()
+        await hub.send(
+            PRESENCE_GROUP,
+            {"type": "presence.broadcast", **protocol.frame(protocol.PRESENCE, **await self.store.counts())},
+        )
+
+        user_ids = [int(member) for member in changed if member != ANONYMOUS_MARKER]
+        if not user_ids:
+            return
+
+        online = await self.store.online_user_ids(user_ids)
+        scopes = await db_sync_to_async(self.scopes_for_users)(user_ids)
+        pipeline = redis.pipeline(transaction=False)
+        for (scope, scope_id), members in scopes.items():
+            if scope == "channel":
+                if members & online:
+                    pipeline.sadd(channel_online_key(scope_id), *(members & online))
+                if members - online:
+                    pipeline.srem(channel_online_key(scope_id), *(members - online))
+        await pipeline.execute()
+
+        for (scope, scope_id), members in scopes.items():
+            group = channel_group(scope_id) if scope == "channel" else team_group(scope_id)
+            await hub.send(group, {
+                "type": "presence.broadcast",
+                **protocol.frame(
+                    protocol.PRESENCE,
+                    scope=scope,
+                    id=scope_id,
+                    online=sorted(members & online),
+                    offline=sorted(members - online),
+                ),
+            })
+
+    @staticmethod
+    def scopes_for_users(user_ids):
+        """Map each (scope, id) the given users belong to onto the subset of those users."""
+        scopes = {}
+        memberships = ChannelMembership.objects.filter(user_id__in=user_ids).values_list(
+            'user_id', 'channel_id', 'channel__team_id'
+        )
+        for user_id, channel_id, team_id in memberships:
+            scopes.setdefault(("channel", channel_id), set()).add(user_id)
+            if team_id is not None:
+                scopes.setdefault(("team", team_id), set()).add(user_id)
+        return scopes
+
+
+_store = None
+_aggregator = None
+
+
+def get_presence_store():
+    global _store
+    if _store is None:
+        _store = PresenceStore(
+            ttl=settings.PRESENCE_TTL,
+            heartbeat_interval=settings.PRESENCE_HEARTBEAT_INTERVAL,
+        )
+    return _store
+
+
+def get_presence_aggregator():
+    global _aggregator
+    if _aggregator is None:
+        _aggregator = PresenceAggregator(get_presence_store(), interval=settings.PRESENCE_TICK_INTERVAL)
+    return _aggregator
@@ -0,0 +1,183 @@
+"""
+Wire format shared by the chat and presence sockets.
+
+Every event is a flat object ``{"v": <version>, "type": <event>, ...fields}``.
+Clients pick an encoding with the WebSocket subprotocol offered at connect:
+
+* ``chat.json`` (default): one JSON text frame per event.
+* ``chat.msgpack``: one MessagePack binary frame per event.
+* either of the above with a ``+batch`` suffix: events are held for a few
+  milliseconds and sent together as one array frame.
+
+Broadcasts travel through the channel layer as one canonical JSON frame.
+The receiving worker converts it to MessagePack only if one of its sockets
+asked for it, once per frame: the local fan-out hub hands the same frame to
+every socket of the process, which caches each format on it. A message to N
+sockets is therefore serialized at most once per format and worker, not N
+times. Batches are assembled from those encoded items without decoding them again.
+"""
+import asyncio
+import json
+
+import msgpack
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is an optional speedup
+    orjson = None
+
+PROTOCOL_VERSION = 1
+
+MESSAGE = "message"
+EDIT = "edit"
+DELETE = "delete"
+BATCH = "batch"
+BATCH_RESULT = "batch_result"
+REPLAY = "replay"
+TYPING = "typing"
+PRESENCE = "presence"
+ERROR = "error"
+
+JSON_SUBPROTOCOL = "chat.json"
+MSGPACK_SUBPROTOCOL = "chat.msgpack"
+BATCH_SUFFIX = "+batch"
+
+
+def dumps(obj):
+    """Compact JSON text, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+def envelope(event_type, **fields):
+    return {"v": PROTOCOL_VERSION, "type": event_type, **fields}
+
+
+def frame(event_type, **fields):
+    """Encode an event for fan-out, in its canonical JSON form only."""
+    return {"text": dumps(envelope(event_type, **fields))}
+
+
+def encoded_as(encoded, binary):
+    """
+    The item of a frame in one format, converted from the other format on first
+    use and cached on the frame so other sockets sharing it reuse the result.
+    """
+    key = "bytes" if binary else "text"
+    item = encoded.get(key)
+    if item is None:
+        if binary:
+            item = msgpack.packb(json.loads(encoded["text"]), use_bin_type=True)
+        else:
+            item = dumps(msgpack.unpackb(encoded["bytes"], raw=False))
+        encoded[key] = item
+    return item
+
+
+class WireFormat:
+    """The encoding negotiated for one connection."""
+
+    def __init__(self, binary=False, batch=False):
+        self.binary = binary
+        self.batch = batch
+
+    @property
+    def subprotocol(self):
+        name = MSGPACK_SUBPROTOCOL if self.binary else JSON_SUBPROTOCOL
+        return name + BATCH_SUFFIX if self.batch else name
+
+    @classmethod
+    def negotiate(cls, offered):
+        """Pick the first subprotocol the client offered that we support, or plain JSON."""
+        for name in offered:
+            base, _, suffix = name.partition("+")
+            if suffix not in ("", "batch"):
+                continue
+            if base in (JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL):
+                return cls(binary=base == MSGPACK_SUBPROTOCOL, batch=bool(suffix)), name
+        return cls(), None
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            return msgpack.unpackb(bytes_data, raw=False)
+        return json.loads(text_data)
+
+    def join(self, items):
+        """Combine pre-encoded items of this format into one array frame."""
+        if self.binary:
+            return msgpack.Packer().pack_array_header(len(items)) + b"".join(items)
+        return "[" + ",".join(items) + "]"
+
+
+class FrameWriter:
+    """
+    Sends pre-encoded frames to one consumer in its negotiated format.
+    In batch mode frames are buffered for up to ``delay`` seconds or ``max_events``.
+    """
+
+    def __init__(self, consumer, wire, delay=0.02, max_events=50):
+        self.consumer = consumer
+        self.wire = wire
+        self.delay = delay
+        self.max_events = max_events
+        self._buffer = []
+        self._flush_task = None
+
+    async def write(self, encoded):
+        item = encoded_as(encoded, self.wire.binary)
+        if not self.wire.batch:
+            await self._send(item)
+            return
+        self._buffer.append(item)
+        if len(self._buffer) >= self.max_events:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delay)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        if self._flush_task is not None and self._flush_task is not asyncio.current_task():
+            self._flush_task.cancel()
+            self._flush_task = None
+        if not self._buffer:
+            return
+        items, self._buffer = self._buffer, []
+        await self._send(self.wire.join(items))
+
+    async def _send(self, data):
+        if self.wire.binary:
+            await self.consumer.send(bytes_data=data)
+        else:
+            await self.consumer.send(text_data=data)
+
+
+class WireProtocolMixin:
+    """Negotiates the wire format on accept and writes events in it."""
+
+    async def accept_with_protocol(self):
+        wire, subprotocol = WireFormat.negotiate(self.scope.get("subprotocols") or [])
+        self.frames = FrameWriter(
+            self, wire, delay=settings.CHAT_BATCH_DELAY, max_events=settings.CHAT_BATCH_MAX_EVENTS
+        )
+        await self.accept(subprotocol=subprotocol)
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        return self.frames.wire.decode(text_data, bytes_data)
+
+    async def send_frame(self, encoded):
+        """Send a frame produced by ``frame()``, e.g. received from a group broadcast."""
+        await self.frames.write(encoded)
+
+    async def send_event(self, event_type, **fields):
+        """Encode and send an event meant for this connection only."""
+        event = envelope(event_type, **fields)
+        if self.frames.wire.binary:
+            await self.send_frame({"bytes": msgpack.packb(event, use_bin_type=True)})
+        else:
+            await self.send_frame({"text": dumps(event)})
@@ -0,0 +1,156 @@
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from chat.metrics import RATE_LIMITED, CollectedMetric
+from chat.redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Token buckets stored as hashes of (tokens, ts). Either every bucket pays the
+# cost or none does; the reply is how long to wait before retrying, 0 if allowed.
+# ARGV: now, cost, then rate and burst for each key.
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + 2 * i])
+    local burst = tonumber(ARGV[2 + 2 * i])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    available = math.min(burst, available + math.max(0, now - updated) * rate)
+    tokens[i] = available
+    if available < cost then
+        wait = math.max(wait, (cost - available) / rate)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + 2 * i])
+    local burst = tonumber(ARGV[2 + 2 * i])
+    local available = tokens[i]
+    if wait == 0 then
+        available = available - cost
+    end
+    redis.call('HSET', key, 'tokens', available, 'ts', now)
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return tostring(wait)
+"""
+
+
+class TokenBucket:
+    """An in-process token bucket refilled at ``rate`` tokens per second up to ``burst``."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait_time(self, cost):
+        """Seconds until ``cost`` tokens are available, 0 if they are now."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+
+    def take(self, cost):
+        self.tokens -= cost
+
+
+class RateLimiter:
+    """
+    Token-bucket limits on chat writes, per user and per channel.
+
+    Each process keeps a bucket per user so a flooding client is turned away
+    without a Redis round trip. Requests that pass it are charged atomically
+    against the global user and channel buckets in Redis, which every worker
+    shares. If Redis is unavailable the local bucket alone decides.
+    """
+
+    def __init__(self, user_rate=5, user_burst=30, channel_rate=100, channel_burst=300, max_local=10000):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.max_local = max_local
+        self.allowed = 0
+        self.rejected = Counter()
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._script = None
+
+    @property
+    def max_cost(self):
+        """The largest single request that can ever be allowed."""
+        return min(self.user_burst, self.channel_burst)
+
+    def stats(self):
+        return {"allowed": self.allowed, "rejected": dict(self.rejected)}
+
+    async def acquire(self, user_id, channel_id, cost=1):
+        """Charge ``cost`` tokens. Returns 0 if allowed, otherwise seconds to wait before retrying."""
+        bucket = self._local_bucket(user_id)
+        wait = bucket.wait_time(cost)
+        if wait:
+            self.rejected["local"] += 1
+            RATE_LIMITED.inc(scope="local")
+            return wait
+
+        try:
+            if self._script is None:
+                self._script = get_redis().register_script(ACQUIRE_SCRIPT)
+            wait = float(await self._script(
+                keys=[f"ratelimit:user:{user_id}", f"ratelimit:channel:{channel_id}"],
+                args=[time.time(), cost, self.user_rate, self.user_burst, self.channel_rate, self.channel_burst],
+            ))
+        except RedisError:
+            logger.warning("Rate limit store unavailable; using local limits only.")
+            wait = 0
+
+        if wait:
+            self.rejected["global"] += 1
+            RATE_LIMITED.inc(scope="global")
+            return wait
+        bucket.take(cost)
+        self.allowed += 1
+        return 0
+
+    def _local_bucket(self, user_id):
+        with self._lock:
+            bucket = self._local.get(user_id)
+            if bucket is None:
+                bucket = self._local[user_id] = TokenBucket(self.user_rate, self.user_burst)
+                while len(self._local) > self.max_local:
+                    self._local.popitem(last=False)
+            else:
+                self._local.move_to_end(user_id)
+            return bucket
+
+
+_limiter = None
+
+
+def get_rate_limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter(
+            user_rate=settings.CHAT_RATE_LIMIT_USER_RATE,
+            user_burst=settings.CHAT_RATE_LIMIT_USER_BURST,
+            channel_rate=settings.CHAT_RATE_LIMIT_CHANNEL_RATE,
+            channel_burst=settings.CHAT_RATE_LIMIT_CHANNEL_BURST,
+        )
+    return _limiter
+
+
+RATE_LIMIT_ALLOWED = CollectedMetric(
+    "chat_rate_limit_allowed_total", "Writes allowed by the rate limiter; rejections are chat_rate_limited_total.",
+    "counter", lambda: None if _limiter is None else _limiter.stats()["allowed"],
+)
@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db.models import Count, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from redis.exceptions import RedisError
+
+from chat.db import db_sync_to_async
+from chat.lifespan import on_shutdown
+from chat.models import ArchivedMessageChunk, Channel, ChannelMembership, Message
+from chat.redis_pool import get_redis, get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_COUNTS_KEY = "read_state:message_counts"
+UNSEEDED_KEY = "read_state:unseeded"
+PENDING_KEY = "read_state:pending"
+FLUSHING_KEY = "read_state:flushing"
+FLUSH_LOCK_KEY = "read_state:flush_lock"
+
+# Counters are only incremented once seeded, so a missing field always means "unknown"
+# rather than a partial count. A message counted while its channel is unseeded marks
+# the channel in KEYS[2], telling a seed in progress that its database count may miss it.
+INCREMENT_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+return nil
+"""
+
+# Store database counts (ARGV: channel, count pairs) for channels still unseeded,
+# unless a message was counted since the seed cleared their mark. Returns the
+# counter of each channel, or the database count where it was not stored.
+SEED_SCRIPT = """
+local counts = {}
+for i = 1, #ARGV, 2 do
+    local count = redis.call('HGET', KEYS[1], ARGV[i])
+    if not count then
+        count = ARGV[i + 1]
+        if redis.call('SISMEMBER', KEYS[2], ARGV[i]) == 0 then
+            redis.call('HSET', KEYS[1], ARGV[i], count)
+        end
+    end
+    counts[#counts + 1] = count
+end
+return counts
+"""
+
+
+def read_counts_key(user_id):
+    return f"read_state:read_counts:{user_id}"
+
+
+class ReadStateStore:
+    """
+    Read cursors and unread counts served from Redis counters.
+
+    Each channel has a running message count, and each user stores the count
+    they had seen when they last read the channel, so unread = total - read
+    without scanning messages. Read events are also buffered in a Redis hash
+    and periodically written to ``ChannelMembership.last_seen`` with a single
+    ``bulk_update`` per flush. Counters missing from Redis are seeded from the
+    database on first use; messages must be counted only once they are committed,
+    so a seed either sees them in the table or is told it raced with them.
+
+    Connections start a background flush loop. Synchronous views, which have
+    no event loop to run it on, call ``maybe_flush`` instead.
+    """
+
+    def __init__(self, flush_interval=10.0):
+        self.flush_interval = flush_interval
+        self._increment_script = None
+        self._sync_increment_script = None
+        self._seed_script = None
+        self._flushed_at = 0.0
+        self._task = None
+
+    async def arecord_message(self, channel_id, count=1):
+        """Count newly saved messages."""
+        if self._increment_script is None:
+            self._increment_script = get_redis().register_script(INCREMENT_SCRIPT)
+        await self._increment_script(keys=[MESSAGE_COUNTS_KEY, UNSEEDED_KEY], args=[channel_id, count])
+
+    def record_message(self, channel_id, count=1):
+        if self._sync_increment_script is None:
+            self._sync_increment_script = get_sync_redis().register_script(INCREMENT_SCRIPT)
+        self._sync_increment_script(keys=[MESSAGE_COUNTS_KEY, UNSEEDED_KEY], args=[channel_id, count])
+
+    def mark_read(self, user_id, channel_id):
+        """Mark everything currently in the channel as read by the user."""
+        total = self._message_counts([channel_id])[channel_id]
+        pipeline = get_sync_redis().pipeline()
+        pipeline.hset(read_counts_key(user_id), channel_id, total)
+        pipeline.hset(PENDING_KEY, f"{user_id}:{channel_id}", time.time())
+        pipeline.execute()
+
+    async def amark_read(self, user_id, channel_id):
+        await db_sync_to_async(self.mark_read)(user_id, channel_id)
+        self.ensure_flusher()
+
+    def unread_counts(self, user_id):
+        """Unread message count for every channel the user belongs to."""
+        memberships = dict(
+            ChannelMembership.objects.filter(user_id=user_id).values_list('channel_id', 'last_seen')
+        )
+        if not memberships:
+            return {}
+
+        channel_ids = list(memberships)
+        totals = self._message_counts(channel_ids)
+        key = read_counts_key(user_id)
+        read = get_sync_redis().hmget(key, channel_ids)
+
+        unknown = [channel_id for channel_id, count in zip(channel_ids, read) if count is None]
+        if unknown:
+            # Seed from last_seen for channels read before counters existed.
+            condition = Q()
+            for channel_id in unknown:
+                condition |= Q(channel_id=channel_id, timestamp__gt=memberships[channel_id])
+            unread_since = dict(
+                Message.objects.filter(condition).values('channel_id')
+                .annotate(n=Count('id')).values_list('channel_id', 'n')
+            )
+            # Archived messages too; a chunk that straddles last_seen counts as read.
+            archived_condition = Q()
+            for channel_id in unknown:
+                archived_condition |= Q(channel_id=channel_id, first_timestamp__gt=memberships[channel_id])
+            archived_since = (
+                ArchivedMessageChunk.objects.filter(archived_condition).values('channel_id')
+                .annotate(n=Sum('message_count')).values_list('channel_id', 'n')
+            )
+            for channel_id, count in archived_since:
+                unread_since[channel_id] = unread_since.get(channel_id, 0) + count
+            seeded = {channel_id: totals[channel_id] - unread_since.get(channel_id, 0) for channel_id in unknown}
+            pipeline = get_sync_redis().pipeline()
+            for channel_id, count in seeded.items():
+                pipeline.hsetnx(key, channel_id, count)
+            pipeline.execute()
+        else:
+            seeded = {}
+
+        counts = {}
+        for channel_id, count in zip(channel_ids, read):
+            read_count = seeded[channel_id] if count is None else int(count)
+            counts[channel_id] = max(totals[channel_id] - read_count, 0)
+        return counts
+
+    def _message_counts(self, channel_ids):
+        redis = get_sync_redis()
+        counts = dict(zip(channel_ids, redis.hmget(MESSAGE_COUNTS_KEY, channel_ids)))
+        missing = [channel_id for channel_id, count in counts.items() if count is None]
+        if missing:
+            # Messages counted before the mark is cleared are already committed, so the
+            # count below includes them; one counted after it leaves the channel unseeded.
+            redis.srem(UNSEEDED_KEY, *missing)
+            seeded = self._stored_counts(missing)
+            if self._seed_script is None:
+                self._seed_script = redis.register_script(SEED_SCRIPT)
+            args = [value for channel_id in missing for value in (channel_id, seeded.get(channel_id, 0))]
+            counts.update(zip(missing, self._seed_script(keys=[MESSAGE_COUNTS_KEY, UNSEEDED_KEY], args=args)))
+        return {channel_id: int(count) for channel_id, count in counts.items()}
+
+    @staticmethod
+    def _stored_counts(channel_ids):
+        """
+        Messages stored per channel, in the table and the archive. Counted in one
+        statement, so a concurrent archive run is seen either entirely or not at all.
+        """
+        hot = Message.objects.filter(channel_id=OuterRef('pk')).order_by().values('channel_id').annotate(
+            n=Count('id')
+        ).values('n')
+        archived = ArchivedMessageChunk.objects.filter(channel_id=OuterRef('pk')).order_by().values(
+            'channel_id'
+        ).annotate(n=Sum('message_count')).values('n')
+        return dict(
+            Channel.objects.filter(pk__in=channel_ids).annotate(
+                n=Coalesce(Subquery(hot), 0) + Coalesce(Subquery(archived), 0)
+            ).values_list('pk', 'n')
+        )
+
+    def flush(self):
+        """Write buffered read cursors to ChannelMembership.last_seen. Returns the rows updated."""
+        redis = get_sync_redis()
+        if not redis.set(FLUSH_LOCK_KEY, "1", nx=True, ex=max(int(self.flush_interval), 1)):
+            return 0
+        try:
+            if not redis.exists(PENDING_KEY) and not redis.exists(FLUSHING_KEY):
+                return 0
+            if not redis.exists(FLUSHING_KEY):
+                # A leftover FLUSHING_KEY means the previous flush failed; retry it first.
+                redis.rename(PENDING_KEY, FLUSHING_KEY)
+            pending = redis.hgetall(FLUSHING_KEY)
+
+            seen = {}
+            for field, value in pending.items():
+                user_id, channel_id = field.split(":")
+                seen[(int(user_id), int(channel_id))] = datetime.fromtimestamp(float(value), tz=timezone.utc)
+
+            users = {user_id for user_id, _ in seen}
+            channels = {channel_id for _, channel_id in seen}
+            memberships = ChannelMembership.objects.filter(user_id__in=users, channel_id__in=channels).only(
+                'id', 'user_id', 'channel_id', 'last_seen'
+            )
+            changed = []
+            for membership in memberships:
+                last_seen = seen.get((membership.user_id, membership.channel_id))
+                if last_seen is not None and last_seen > membership.last_seen:
+                    membership.last_seen = last_seen
+                    changed.append(membership)
+
+            ChannelMembership.objects.bulk_update(changed, ['last_seen'], batch_size=500)
+            redis.delete(FLUSHING_KEY)
+            return len(changed)
+        finally:
+            redis.delete(FLUSH_LOCK_KEY)
+
+    def maybe_flush(self):
+        """Flush from synchronous code, at most once per ``flush_interval``."""
+        if time.monotonic() - self._flushed_at < self.flush_interval:
+            return
+        self._flushed_at = time.monotonic()
+        try:
+            self.flush()
+        except RedisError:
+            logger.warning("Failed to flush read state.")
+
+    def ensure_flusher(self):
+        """Start the periodic flush loop on the running event loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            on_shutdown(self.stop)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await db_sync_to_async(self.flush)()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await db_sync_to_async(self.flush)()
+            except Exception:
+                logger.exception("Failed to flush read state.")
+
+
+_store = None
+
+
+def get_read_state():
+    global _store
+    if _store is None:
+        _store = ReadStateStore(flush_interval=settings.CHAT_READ_STATE_FLUSH_INTERVAL)
+    return _store
@@ -0,0 +1,253 @@
+import json
+import uuid
+from collections import Counter
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from chat import protocol
+from chat.crypto import get_cipher
+from chat.db import db_sync_to_async
+from chat.metrics import CollectedMetric
+from chat.models import Message
+from chat.redis_pool import get_redis, get_sync_redis
+
+# Edits and deletes only refresh a message that is still in the window, so an
+# old message never reappears at the bottom of a channel's buffer.
+REPLACE_SCRIPT = """
+if redis.call('ZCOUNT', KEYS[1], ARGV[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[1])
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+# Warming only extends a buffer backwards from its oldest entry, and only when the
+# rows reach it, so it never leaves a gap. ARGV: ttl, max length, highest seq, then seq/row pairs.
+WARM_SCRIPT = """
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if #oldest > 0 and tonumber(ARGV[3]) < tonumber(oldest[2]) - 1 then
+    return 0
+end
+for i = 4, #ARGV, 2 do
+    if #oldest == 0 or tonumber(ARGV[i]) < tonumber(oldest[2]) then
+        redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[2]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+def recent_key(channel_id):
+    return f"chat:recent:{channel_id}"
+
+
+class RecentMessageBuffer:
+    """
+    The newest ``max_length`` messages of each channel, kept in Redis.
+
+    Each channel has a sorted set of messages scored by their sequence number
+    and trimmed on every write. Content is stored as saved, i.e. encrypted.
+    A channel's buffer expires ``ttl`` seconds after its last write, so only
+    active channels stay cached; the first history page read from the
+    database warms it again.
+
+    The buffer serves the newest history page and reconnect replay. A client
+    that reconnects asks for everything after the last sequence number it saw;
+    when the buffer no longer reaches back that far, the gap is read from the
+    database instead. At most ``replay_limit`` messages are replayed, after
+    which the client is told to page through history.
+    """
+
+    def __init__(self, max_length=1000, replay_limit=500, ttl=86400):
+        self.max_length = max_length
+        self.replay_limit = replay_limit
+        self.ttl = ttl
+        self.hits = Counter()
+        self.misses = Counter()
+        self._replace_script = None
+        self._warm_script = None
+
+    def stats(self):
+        """Hit and miss counts of this process, per use."""
+        return {
+            use: {"hits": self.hits[use], "misses": self.misses[use]}
+            for use in ("history", "replay")
+        }
+
+    @staticmethod
+    def row(message):
+        return {
+            "seq": message.seq,
+            "id": str(message.pk),
+            "sender_id": message.sender_id,
+            "username": message.sender.username,
+            "content": message.content,
+            "timestamp": message.timestamp.isoformat(),
+            "edited_at": message.edited_at.isoformat() if message.edited_at else None,
+            "is_deleted": message.is_deleted,
+        }
+
+    @staticmethod
+    def to_message(channel_id, row):
+        """Rebuild an unsaved ``Message`` from a buffered row."""
+        return Message(
+            id=uuid.UUID(row["id"]),
+            channel_id=int(channel_id),
+            sender_id=row["sender_id"],
+            content=row["content"],
+            timestamp=datetime.fromisoformat(row["timestamp"]),
+            edited_at=datetime.fromisoformat(row["edited_at"]) if row["edited_at"] else None,
+            is_deleted=row["is_deleted"],
+            seq=row["seq"],
+        )
+
+    def add(self, channel_id, messages):
+        """Append newly saved messages."""
+        pipeline = get_sync_redis().pipeline()
+        self._add(pipeline, channel_id, messages)
+        pipeline.execute()
+
+    async def aadd(self, channel_id, messages):
+        pipeline = get_redis().pipeline()
+        self._add(pipeline, channel_id, messages)
+        await pipeline.execute()
+
+    def _add(self, pipeline, channel_id, messages):
+        key = recent_key(channel_id)
+        pipeline.zadd(key, {protocol.dumps(self.row(message)): message.seq for message in messages})
+        pipeline.zremrangebyrank(key, 0, -self.max_length - 1)
+        pipeline.expire(key, self.ttl)
+
+    def warm(self, channel_id, messages):
+        """Fill the buffer from the newest page of messages read from the database."""
+        messages = [message for message in messages if message.seq is not None][:self.max_length]
+        if not messages:
+            return
+        unloaded = {message.sender_id for message in messages if not Message.sender.is_cached(message)}
+        if unloaded:
+            senders = User.objects.only('id', 'username').in_bulk(unloaded)
+            for message in messages:
+                if message.sender_id in unloaded:
+                    message.sender = senders.get(message.sender_id)
+            # Senders deleted since the page was read.
+            messages = [message for message in messages if message.sender is not None]
+            if not messages:
+                return
+
+        redis = get_sync_redis()
+        if self._warm_script is None:
+            self._warm_script = redis.register_script(WARM_SCRIPT)
+        args = [self.ttl, self.max_length, max(message.seq for message in messages)]
+        for message in messages:
+            args.extend([message.seq, protocol.dumps(self.row(message))])
+        self._warm_script(keys=[recent_key(channel_id)], args=args)
+
+    def latest(self, channel_id, limit):
+        """
+        The newest ``limit`` messages, newest first, and whether older ones exist.
+        Returns None when the buffer does not hold enough of the channel to answer.
+        """
+        rows = []
+        if limit <= self.max_length:
+            rows = get_sync_redis().zrevrange(recent_key(channel_id), 0, limit - 1, withscores=True)
+        # A full page, or a short one that reaches the channel's very first message.
+        if len(rows) < limit and (not rows or rows[-1][1] != 1):
+            self.misses["history"] += 1
+            return None
+        self.hits["history"] += 1
+
+        messages = [self.to_message(channel_id, json.loads(member)) for member, _ in rows]
+        # Same order as the database page, which sorts by time rather than seq.
+        messages.sort(key=lambda message: (message.timestamp, message.pk), reverse=True)
+        return messages, rows[-1][1] > 1
+
+    def replace(self, channel_id, messages):
+        """Refresh edited or deleted messages that are still buffered."""
+        redis = get_sync_redis()
+        if self._replace_script is None:
+            self._replace_script = redis.register_script(REPLACE_SCRIPT)
+        pipeline = redis.pipeline()
+        for message in messages:
+            if message.seq is None:
+                continue
+            self._replace_script(
+                keys=[recent_key(channel_id)],
+                args=[message.seq, protocol.dumps(self.row(message))],
+                client=pipeline,
+            )
+        pipeline.execute()
+
+    async def replay(self, channel_id, after_seq):
+        """
+        Live messages with a sequence number above ``after_seq``, oldest first,
+        as the fields of a ``message`` event. Returns ``(events, complete)``.
+        """
+        key = recent_key(channel_id)
+        pipeline = get_redis().pipeline()
+        pipeline.zrange(key, 0, 0, withscores=True)
+        pipeline.zrangebyscore(key, f"({after_seq}", "+inf", start=0, num=self.replay_limit + 1)
+        oldest, members = await pipeline.execute()
+
+        if oldest and oldest[0][1] <= after_seq + 1:
+            self.hits["replay"] += 1
+            rows = [json.loads(member) for member in members]
+        else:
+            self.misses["replay"] += 1
+            rows = await db_sync_to_async(self._load)(channel_id, after_seq)
+
+        complete = len(rows) <= self.replay_limit
+        rows = [row for row in rows[:self.replay_limit] if not row["is_deleted"]]
+        plaintexts = await get_cipher().adecrypt_many(row["content"] for row in rows)
+        events = [
+            {
+                "id": row["id"],
+                "message": plaintext,
+                "username": row["username"],
+                "channel_id": str(channel_id),
+                "timestamp": str(datetime.fromisoformat(row["timestamp"])),
+                "seq": row["seq"],
+            }
+            for row, plaintext in zip(rows, plaintexts)
+        ]
+        return events, complete
+
+    def _load(self, channel_id, after_seq):
+        messages = Message.objects.filter(channel_id=channel_id, seq__gt=after_seq).select_related(
+            'sender'
+        ).order_by('seq')[:self.replay_limit + 1]
+        rows = [self.row(message) for message in messages]
+        if not rows or rows[0]["seq"] > after_seq + 1:
+            # The gap starts in archived messages.
+            from chat.archive import ChannelArchive
+
+            rows = ChannelArchive(channel_id).after_seq(after_seq, self.replay_limit + 1) + rows
+            rows = rows[:self.replay_limit + 1]
+        return rows
+
+
+_buffer = None
+
+
+def get_recent_messages():
+    global _buffer
+    if _buffer is None:
+        _buffer = RecentMessageBuffer(
+            max_length=settings.CHAT_RECENT_MESSAGES,
+            replay_limit=settings.CHAT_REPLAY_LIMIT,
+            ttl=settings.CHAT_RECENT_MESSAGES_TTL,
+        )
+    return _buffer
+
+
+BUFFER_LOOKUPS = CollectedMetric(
+    "chat_recent_buffer_lookups_total", "Recent-message buffer lookups by use and result.", "counter",
+    lambda: None if _buffer is None else {
+        (use, result): count for use, counts in _buffer.stats().items() for result, count in counts.items()
+    },
+    ["use", "result"],
+)
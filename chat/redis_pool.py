@@ -0,0 +1,70 @@
+from django.conf import settings
+from redis import ConnectionPool as SyncConnectionPool, Redis as SyncRedis
+from redis.asyncio import BlockingConnectionPool, Redis
+
+from chat.lifespan import on_shutdown
+
+_async_client = None
+_sync_client = None
+
+
+def get_redis():
+    """
+    Return the process-wide async Redis client.
+    All consumers share its connection pool, sized by REDIS_MAX_CONNECTIONS;
+    callers wait for a free connection instead of opening new ones.
+    """
+    global _async_client
+    if _async_client is None:
+        pool = BlockingConnectionPool.from_url(
+            settings.REDIS_URL,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            decode_responses=True,
+        )
+        _async_client = Redis(connection_pool=pool)
+        on_shutdown(close_redis)
+    return _async_client
+
+
+def get_sync_redis():
+    """Return the process-wide Redis client for sync code such as views and signals."""
+    global _sync_client
+    if _sync_client is None:
+        pool = SyncConnectionPool.from_url(
+            settings.REDIS_URL,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            decode_responses=True,
+        )
+        _sync_client = SyncRedis(connection_pool=pool)
+    return _sync_client
+
+
+async def close_redis():
+    """Close the shared clients and their pooled connections."""
+    global _async_client, _sync_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        await _async_client.connection_pool.disconnect()
+        _async_client = None
+    if _sync_client is not None:
+        _sync_client.close()
+        _sync_client.connection_pool.disconnect()
+        _sync_client = None
+
+
+def pool_stats():
+    """Connection usage of the shared pools, for metrics and debugging."""
+    stats = {}
+    for name, client in (("async", _async_client), ("sync", _sync_client)):
+        if client is None:
+            continue
+        pool = client.connection_pool
+        in_use = len(getattr(pool, "_in_use_connections", ()))
+        available = len(getattr(pool, "_available_connections", ()))
+        stats[name] = {
+            "in_use": in_use,
+            "idle": available,
+            "max": pool.max_connections,
+        }
+    return stats
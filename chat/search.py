@@ -0,0 +1,91 @@
+import hashlib
+import hmac
+import html
+import re
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+from django.db.models import Count
+
+from chat.crypto import decrypt_message
+from chat.models import Message, MessageSearchToken
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+MIN_WORD_LENGTH = 2
+MAX_TOKENS_PER_MESSAGE = 256
+INDEX_KEY_INFO = b"chat search index v1"
+
+_index_key = None
+
+
+def tokenize(text):
+    """Distinct lower-cased words of ``text`` worth indexing."""
+    words = []
+    seen = set()
+    # Stored content is bleach-escaped; index what the user actually typed.
+    for word in WORD_RE.findall(html.unescape(text).lower()):
+        if len(word) >= MIN_WORD_LENGTH and word not in seen:
+            seen.add(word)
+            words.append(word)
+            if len(words) >= MAX_TOKENS_PER_MESSAGE:
+                break
+    return words
+
+
+def get_index_key():
+    """
+    The HMAC key of the index: ``SEARCH_INDEX_KEY``, or a key derived from
+    ``FERNET_KEY`` for this purpose only, so the two never share key material.
+    """
+    global _index_key
+    if _index_key is None:
+        if settings.SEARCH_INDEX_KEY:
+            _index_key = settings.SEARCH_INDEX_KEY.encode()
+        else:
+            hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=INDEX_KEY_INFO)
+            _index_key = hkdf.derive(settings.FERNET_KEY.encode())
+    return _index_key
+
+
+def blind_token(word):
+    """Keyed hash of a word; the index never stores plaintext."""
+    digest = hmac.new(get_index_key(), word.encode(), hashlib.sha256)
+    return digest.hexdigest()[:32]
+
+
+def build_tokens(message, plaintext):
+    """Unsaved index rows for a message."""
+    return [
+        MessageSearchToken(message_id=message.pk, channel_id=message.channel_id, token=blind_token(word))
+        for word in tokenize(plaintext)
+    ]
+
+
+def index_message(message, plaintext=None, created=False):
+    """(Re)index a saved message. Deleted messages are removed from the index."""
+    if not created:
+        MessageSearchToken.objects.filter(message_id=message.pk).delete()
+    if message.is_deleted:
+        return
+    if plaintext is None:
+        plaintext = decrypt_message(message)
+    MessageSearchToken.objects.bulk_create(build_tokens(message, plaintext), ignore_conflicts=True)
+
+
+def search_messages(query, channel_ids):
+    """
+    Messages in ``channel_ids`` containing every word of ``query``, newest first.
+    Returns an unevaluated queryset, or None if the query has no searchable words.
+    """
+    tokens = [blind_token(word) for word in tokenize(query)]
+    if not tokens:
+        return None
+    matches = (
+        MessageSearchToken.objects.filter(token__in=tokens, channel_id__in=channel_ids)
+        .values('message_id')
+        .annotate(hits=Count('id'))
+        .filter(hits=len(tokens))
+        .values('message_id')
+    )
+    return Message.objects.filter(pk__in=matches, is_deleted=False).order_by('-timestamp', '-id')
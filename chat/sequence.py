@@ -0,0 +1,66 @@
+from django.db.models import Max
+
+from chat.db import db_sync_to_async
+from chat.models import ArchivedMessageChunk, Message
+from chat.redis_pool import get_redis, get_sync_redis
+
+# Counters are only incremented once seeded, so a missing key never restarts a channel at 1.
+ALLOCATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return nil
+"""
+
+
+def sequence_key(channel_id):
+    return f"chat:seq:{channel_id}"
+
+
+class ChannelSequence:
+    """
+    Monotonic per-channel message sequence numbers.
+
+    Numbers come from a Redis counter per channel, so every worker hands out
+    the next position without touching the database. A counter missing from
+    Redis is seeded from the highest sequence number stored for the channel,
+    in the message table or the archive.
+    """
+
+    def __init__(self):
+        self._script = None
+        self._sync_script = None
+
+    def allocate(self, channel_id, count=1):
+        """Reserve ``count`` consecutive numbers and return them as a range."""
+        if self._sync_script is None:
+            self._sync_script = get_sync_redis().register_script(ALLOCATE_SCRIPT)
+        last = self._sync_script(keys=[sequence_key(channel_id)], args=[count])
+        if last is None:
+            self.seed(channel_id)
+            last = self._sync_script(keys=[sequence_key(channel_id)], args=[count])
+        return range(int(last) - count + 1, int(last) + 1)
+
+    async def aallocate(self, channel_id, count=1):
+        if self._script is None:
+            self._script = get_redis().register_script(ALLOCATE_SCRIPT)
+        last = await self._script(keys=[sequence_key(channel_id)], args=[count])
+        if last is None:
+            await db_sync_to_async(self.seed)(channel_id)
+            last = await self._script(keys=[sequence_key(channel_id)], args=[count])
+        return range(int(last) - count + 1, int(last) + 1)
+
+    def seed(self, channel_id):
+        hot = Message.objects.filter(channel_id=channel_id).aggregate(seq=Max('seq'))['seq']
+        archived = ArchivedMessageChunk.objects.filter(channel_id=channel_id).aggregate(seq=Max('last_seq'))['seq']
+        get_sync_redis().set(sequence_key(channel_id), max(hot or 0, archived or 0), nx=True)
+
+
+_sequence = None
+
+
+def get_channel_sequence():
+    global _sequence
+    if _sequence is None:
+        _sequence = ChannelSequence()
+    return _sequence
@@ -1,8 +1,28 @@
+import bleach
 from rest_framework import serializers
 from django.contrib.auth.models import User
+from .crypto import decrypt_message, get_cipher
 from .models import Team, Channel, ChannelMembership, Message
 
 
+class EncryptedContentField(serializers.CharField):
+    """
+    Message content, stored as Fernet ciphertext and rendered as plaintext.
+    Uses plaintext already attached by ``decrypt_messages`` when available.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        super().__init__(**kwargs)
+
+    def to_representation(self, message):
+        return decrypt_message(message)
+
+    def to_internal_value(self, data):
+        content = bleach.clean(super().to_internal_value(data))
+        return {'content': get_cipher().encrypt(content)}
+
+
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -16,6 +36,11 @@ class TeamSerializer(serializers.ModelSerializer):
         model = Team
         fields = ('id', 'name', 'description', 'created_by', 'created_at', 'is_active')
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """Join everything the nested representation reads."""
+        return queryset.select_related('created_by')
+
 
 class ChannelSerializer(serializers.ModelSerializer):
     team = TeamSerializer(read_only=True)
@@ -25,6 +50,11 @@ class ChannelSerializer(serializers.ModelSerializer):
         model = Channel
         fields = ('id', 'team', 'name', 'is_private', 'is_direct', 'created_by', 'created_at')
 
+    @staticmethod
+    def setup_eager_loading(queryset, prefix=''):
+        """Join everything the nested representation reads."""
+        return queryset.select_related(f'{prefix}team__created_by', f'{prefix}created_by')
+
 
 class ChannelMembershipSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
@@ -34,12 +64,61 @@ class ChannelMembershipSerializer(serializers.ModelSerializer):
         model = ChannelMembership
         fields = ('id', 'user', 'channel', 'joined_at', 'is_admin', 'last_seen', 'is_typing')
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """Join everything the nested representation reads."""
+        return ChannelSerializer.setup_eager_loading(queryset.select_related('user'), prefix='channel__')
+
 
 class MessageSerializer(serializers.ModelSerializer):
     sender = UserSerializer(read_only=True)
     channel = ChannelSerializer(read_only=True)
+    content = EncryptedContentField()
 
     class Meta:
         model = Message
-        fields = ('id', 'channel', 'sender', 'content', 'timestamp', 'edited_at', 'is_deleted')
+        fields = ('id', 'channel', 'sender', 'content', 'timestamp', 'edited_at', 'is_deleted', 'seq')
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """Join everything the nested representation reads."""
+        return ChannelSerializer.setup_eager_loading(queryset.select_related('sender'), prefix='channel__')
+
+
+class FlatSerializerMixin:
+    """
+    Flat representations render related objects as ids and need no joins.
+    """
+    @staticmethod
+    def setup_eager_loading(queryset, prefix=''):
+        return queryset
 
+
+class FlatTeamSerializer(FlatSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Team
+        fields = TeamSerializer.Meta.fields
+        read_only_fields = ('created_by',)
+
+
+class FlatChannelSerializer(FlatSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Channel
+        fields = ChannelSerializer.Meta.fields
+        read_only_fields = ('team', 'created_by')
+
+
+class FlatChannelMembershipSerializer(FlatSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = ChannelMembership
+        fields = ChannelMembershipSerializer.Meta.fields
+        read_only_fields = ('user', 'channel')
+
+
+class FlatMessageSerializer(FlatSerializerMixin, serializers.ModelSerializer):
+    content = EncryptedContentField()
+
+    class Meta:
+        model = Message
+        fields = MessageSerializer.Meta.fields
+        read_only_fields = ('channel', 'sender')
@@ -0,0 +1,24 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from chat.membership import get_membership_cache
+from chat.models import ChannelMembership
+from chat.presence import get_presence_store
+
+
+@receiver([post_save, post_delete], sender=ChannelMembership)
+def invalidate_membership_cache(sender, instance, **kwargs):
+    """Drop cached membership checks when a membership is added, changed or removed."""
+    get_membership_cache().invalidate(instance.user_id, instance.channel_id)
+
+
+@receiver(post_save, sender=ChannelMembership)
+def add_channel_presence(sender, instance, created, **kwargs):
+    """Let the presence aggregator add a new member who is online to the channel's online set."""
+    if created:
+        get_presence_store().member_added(instance.user_id)
+
+
+@receiver(post_delete, sender=ChannelMembership)
+def remove_channel_presence(sender, instance, **kwargs):
+    get_presence_store().member_removed(instance.user_id, instance.channel_id)
@@ -1,3 +1,651 @@
-from django.test import TestCase
+import json
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+import msgpack
+from asgiref.sync import async_to_sync
+from cryptography.fernet import Fernet
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils.timezone import now
+from redis.exceptions import RedisError
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+
+from chat import crypto, membership, metrics, presence, protocol, ratelimit, read_state, recent, redis_pool, sequence
+from chat.archive import ChannelArchive, archive_channel, pack_rows, unpack_rows
+from chat.consumers.chat import ChatConsumer
+from chat.crypto import MessageCipher, get_cipher
+from chat.models import Channel, ChannelMembership, Message, MessageSearchToken, Team
+from chat.pagination import MessageCursorPaginator
+from chat.persistence import MessageWriteBehindQueue
+from chat.ratelimit import TokenBucket
+from chat.tracing import Tracer
+
+
+class FakeRedisMixin:
+    """
+    Point the shared Redis clients at an in-memory server for each test.
+    The Redis-backed singletons are reset too, since their scripts are bound to a client.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.redis_server = fakeredis.FakeServer()
+        patches = [
+            mock.patch.object(redis_pool, '_sync_client', fakeredis.FakeRedis(
+                server=self.redis_server, decode_responses=True,
+            )),
+            mock.patch.object(redis_pool, '_async_client', fakeredis.FakeAsyncRedis(
+                server=self.redis_server, decode_responses=True,
+            )),
+            mock.patch.object(membership, '_cache', None),
+            mock.patch.object(presence, '_store', None),
+            mock.patch.object(presence, '_aggregator', None),
+            mock.patch.object(ratelimit, '_limiter', None),
+            mock.patch.object(read_state, '_store', None),
+            mock.patch.object(recent, '_buffer', None),
+            mock.patch.object(sequence, '_sequence', None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def redis_down(self):
+        self.redis_server.connected = False
+
+
+class APITestCase(TestCase):
+    # A session and a user lookup authenticate each request.
+    auth_queries = 2
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f"user{i}") for i in range(5)]
+        cls.team = Team.objects.create(name="team", created_by=cls.users[0])
+        cls.channels = [
+            Channel.objects.create(name=f"channel{i}", team=cls.team, created_by=user)
+            for i, user in enumerate(cls.users)
+        ]
+        for channel in cls.channels:
+            for user in cls.users:
+                ChannelMembership.objects.create(channel=channel, user=user)
+        content = get_cipher().encrypt("hello")
+        cls.messages = [
+            Message.objects.create(channel=cls.channels[0], sender=user, content=content, seq=i + 1)
+            for i, user in enumerate(cls.users)
+        ]
+
+    def setUp(self):
+        self.client.force_login(self.users[0])
+
+    def get(self, name, queries, *args, **params):
+        with self.assertNumQueries(self.auth_queries + queries):
+            response = self.client.get(reverse(name, args=args), params, secure=True)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+
+class QueryCountTests(APITestCase):
+    """Each endpoint runs a fixed number of queries, however many rows it returns."""
+
+    def test_team_list(self):
+        self.get('team-list', 1)
+        self.get('team-list', 1, flat=1)
+
+    def test_channel_list(self):
+        data = self.get('channel-list', 1)
+        self.assertEqual(data[0]['team']['created_by']['username'], "user0")
+        data = self.get('channel-list', 1, flat=1)
+        self.assertEqual(data[0]['team'], self.team.pk)
+
+    def test_channel_detail(self):
+        self.get('channel-detail', 1, self.channels[0].pk)
+        self.get('channel-detail', 1, self.channels[0].pk, flat=1)
+
+    def test_membership_list(self):
+        data = self.get('membership-list', 1)
+        self.assertEqual(len(data), 25)
+        self.get('membership-list', 1, flat=1)
+
+    def test_message_list(self):
+        data = self.get('message-list', 1, limit=3)
+        self.assertEqual(len(data['results']), 3)
+        self.assertEqual(data['results'][0]['content'], "hello")
+        data = self.get('message-list', 1, flat=1, before=data['next'])
+        self.assertEqual(len(data['results']), 2)
+        self.assertIsNone(data['next'])
+
+    def test_message_detail(self):
+        data = self.get('message-detail', 1, self.messages[0].pk)
+        self.assertEqual(data['content'], "hello")
+        self.assertEqual(data['channel']['team']['name'], "team")
+        self.get('message-detail', 1, self.messages[0].pk, flat=1)
+
+
+class MessageCursorPaginatorTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user("user")
+        cls.channel = Channel.objects.create(name="channel", created_by=user)
+        start = now() - timedelta(hours=1)
+        cls.messages = []
+        for i in range(10):
+            message = Message.objects.create(channel=cls.channel, sender=user, content="", seq=i + 1)
+            # Pairs of messages share a timestamp, so ties are broken by id.
+            message.timestamp = start + timedelta(minutes=i // 2)
+            message.save(update_fields=['timestamp'])
+            cls.messages.append(message)
+        cls.newest_first = sorted(cls.messages, key=lambda m: (m.timestamp, m.id), reverse=True)
+
+    def paginate(self, **params):
+        request = Request(RequestFactory().get('/', params))
+        return MessageCursorPaginator().paginate(Message.objects.filter(channel=self.channel), request)
+
+    def test_pages_cover_history_once(self):
+        seen = []
+        page = self.paginate(limit=3)
+        self.assertIsNone(page['previous'])
+        while True:
+            seen += page['results']
+            if page['next'] is None:
+                break
+            page = self.paginate(limit=3, before=page['next'])
+            self.assertIsNotNone(page['previous'])
+        self.assertEqual(seen, self.newest_first)
+
+    def test_after_returns_newer_messages_newest_first(self):
+        cursor = MessageCursorPaginator.encode_cursor(self.newest_first[5])
+        page = self.paginate(limit=3, after=cursor)
+        self.assertEqual(page['results'], self.newest_first[2:5])
+        self.assertIsNotNone(page['previous'])
+
+    def test_around_includes_the_cursor_message(self):
+        cursor = MessageCursorPaginator.encode_cursor(self.newest_first[5])
+        page = self.paginate(limit=4, around=cursor)
+        self.assertEqual(page['results'], self.newest_first[3:7])
+
+    def test_invalid_cursor_and_limit(self):
+        with self.assertRaises(ValidationError):
+            self.paginate(before="not-a-cursor")
+        with self.assertRaises(ValidationError):
+            self.paginate(limit="ten")
+        with self.assertRaises(ValidationError):
+            self.paginate(limit=0)
+
+    def test_limit_is_capped(self):
+        request = Request(RequestFactory().get('/', {'limit': 10000}))
+        self.assertEqual(MessageCursorPaginator().get_limit(request), MessageCursorPaginator.max_limit)
+
+
+class TokenBucketTests(TestCase):
+
+    def test_burst_then_refill(self):
+        with mock.patch('chat.ratelimit.time.monotonic', return_value=100.0) as clock:
+            bucket = TokenBucket(rate=2, burst=4)
+            self.assertEqual(bucket.wait_time(4), 0)
+            bucket.take(4)
+            self.assertEqual(bucket.wait_time(1), 0.5)
+            clock.return_value = 101.0
+            self.assertEqual(bucket.wait_time(2), 0)
+            clock.return_value = 1000.0
+            bucket.wait_time(1)
+            self.assertEqual(bucket.tokens, 4)
+
+
+class ArchiveRowsTests(TestCase):
+
+    def test_pack_round_trip(self):
+        rows = [{"id": str(i), "seq": i, "sender_id": 1, "content": "gAAAA" * 20} for i in range(100)]
+        data = pack_rows(rows)
+        self.assertLess(len(data), len(str(rows)))
+        self.assertEqual(unpack_rows(data), rows)
+
+
+class MessageSearchTests(APITestCase):
+
+    def test_non_integer_channel_is_rejected(self):
+        response = self.client.get(reverse('message-search'), {'q': "hello", 'channel': "general"}, secure=True)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('channel', response.json())
+
+
+class BatchLimitTests(TestCase):
+
+    def test_batch_limit_never_exceeds_rate_limit_burst(self):
+        with self.settings(CHAT_RATE_LIMIT=True, CHAT_MAX_BATCH_OPERATIONS=100):
+            with mock.patch('chat.consumers.chat.get_rate_limiter') as limiter:
+                limiter.return_value.max_cost = 30
+                self.assertEqual(ChatConsumer.max_batch_operations(), 30)
+        with self.settings(CHAT_RATE_LIMIT=False, CHAT_MAX_BATCH_OPERATIONS=100):
+            self.assertEqual(ChatConsumer.max_batch_operations(), 100)
+
+
+class ProtocolTests(TestCase):
+
+    def test_frame_is_encoded_once_per_format(self):
+        encoded = protocol.frame(protocol.MESSAGE, message="hi")
+        self.assertEqual(set(encoded), {"text"})
+        packed = protocol.encoded_as(encoded, binary=True)
+        self.assertEqual(msgpack.unpackb(packed), {"v": protocol.PROTOCOL_VERSION, "type": "message", "message": "hi"})
+        with mock.patch('chat.protocol.msgpack.packb') as packb:
+            self.assertIs(protocol.encoded_as(encoded, binary=True), packed)
+            packb.assert_not_called()
+
+
+class TracerConfigTests(TestCase):
+
+    def test_partial_config_keeps_enabled(self):
+        tracer = Tracer(enabled=True, threshold_ms=250)
+        tracer.apply({"threshold_ms": "50"})
+        self.assertTrue(tracer.enabled)
+        self.assertEqual(tracer.threshold_ms, 50)
+        tracer.apply({"enabled": "0"})
+        self.assertFalse(tracer.enabled)
+
+
+class CollectedMetricTests(TestCase):
+
+    def test_collected_values_are_rendered(self):
+        stats = {"depth": None}
+        metric = metrics.CollectedMetric("chat_test_depth", "Test depth.", "gauge", lambda: stats["depth"])
+        self.addCleanup(metrics.REGISTRY.remove, metric)
+        self.assertEqual(metric.snapshot(), [])
+        stats["depth"] = 7
+        self.assertIn("chat_test_depth 7\n", metrics.render([metrics.snapshot()]))
+
+
+class MessageWriteBehindQueueTests(TransactionTestCase):
+    """The queue writes from the database thread pool, so these tests commit for real."""
+
+    def setUp(self):
+        self.user = User.objects.create_user("user")
+        self.channel = Channel.objects.create(name="channel", created_by=self.user)
+
+    def message(self, seq, **fields):
+        return Message(channel=self.channel, sender=self.user, content="x", seq=seq, timestamp=now(), **fields)
+
+    async def test_flush_keeps_the_enqueue_timestamp(self):
+        queue = MessageWriteBehindQueue(flush_interval=60)
+        message = self.message(1)
+        message.timestamp -= timedelta(seconds=5)
+        queue.enqueue(message)
+        await queue.close()
+        stored = await Message.objects.aget(pk=message.pk)
+        self.assertEqual(stored.timestamp, message.timestamp)
+
+    async def test_rejected_rows_are_isolated_and_dropped(self):
+        queue = MessageWriteBehindQueue(flush_interval=60)
+        for seq in (1, 2, 2, 3):
+            queue.enqueue(self.message(seq))
+        await queue.close()
+        self.assertEqual(await Message.objects.acount(), 3)
+        self.assertEqual(queue.stats(), {"depth": 0, "flushed": 3, "failures": 1, "dropped": 1})
+
+    async def test_transient_failures_are_retried(self):
+        queue = MessageWriteBehindQueue(flush_interval=60, max_retries=3)
+        queue.enqueue(self.message(1))
+        write = queue._write
+        failures = iter([OperationalError("locked")])
+
+        def flaky_write(batch):
+            for error in failures:
+                raise error
+            write(batch)
+
+        with mock.patch.object(queue, '_write', side_effect=flaky_write):
+            self.assertFalse(await queue.flush())
+            self.assertEqual(queue.depth, 1)
+            self.assertTrue(await queue.flush())
+        await queue.close()
+        self.assertEqual(await Message.objects.acount(), 1)
+
+    async def test_oldest_messages_are_dropped_when_full(self):
+        queue = MessageWriteBehindQueue(flush_interval=60, max_pending=2)
+        for seq in (1, 2, 3):
+            queue.enqueue(self.message(seq))
+        await queue.close()
+        self.assertEqual([seq async for seq in Message.objects.order_by('seq').values_list('seq', flat=True)], [2, 3])
+        self.assertEqual(queue.dropped, 1)
+
+
+class ChannelHistoryTests(FakeRedisMixin, APITestCase):
+
+    def test_first_page_warms_the_buffer_then_reads_from_it(self):
+        # Channel membership, then the page.
+        from_database = self.get('channel-message-list', 2, self.channels[0].pk, limit=3)
+        buffer = recent.get_recent_messages()
+        self.assertEqual(buffer.stats()["history"], {"hits": 0, "misses": 1})
+
+        # The channel and senders of the buffered messages.
+        from_buffer = self.get('channel-message-list', 2, self.channels[0].pk, limit=3)
+        self.assertEqual(buffer.stats()["history"], {"hits": 1, "misses": 1})
+        self.assertEqual(from_buffer, from_database)
+        self.assertEqual([m['content'] for m in from_buffer['results']], ["hello"] * 3)
+
+    def test_short_buffer_falls_back_to_the_database(self):
+        recent.get_recent_messages().add(self.channels[0].pk, self.messages[-2:])
+        data = self.get('channel-message-list', 2, self.channels[0].pk, limit=3)
+        self.assertEqual(len(data['results']), 3)
+        self.assertEqual(recent.get_recent_messages().stats()["history"], {"hits": 0, "misses": 1})
+
+    def test_redis_outage_reads_from_the_database(self):
+        self.redis_down()
+        # The page reaches the channel's first message, so the archive is checked too.
+        data = self.get('channel-message-list', 3, self.channels[0].pk)
+        self.assertEqual(len(data['results']), 5)
+
+    def test_redis_outage_makes_read_state_and_presence_unavailable(self):
+        self.redis_down()
+        for name, args in (('unread-counts', ()), ('channel-presence', (self.channels[0].pk,))):
+            response = self.client.get(reverse(name, args=args), secure=True)
+            self.assertEqual(response.status_code, 503)
+        response = self.client.post(reverse('channel-read', args=[self.channels[0].pk]), secure=True)
+        self.assertEqual(response.status_code, 503)
+
+
+class ChannelMessageListTests(FakeRedisMixin, APITestCase):
+
+    def history(self, pk, **params):
+        return self.client.get(reverse('channel-message-list', args=[pk]), params, secure=True)
+
+    def test_cursors_walk_the_channel_newest_first(self):
+        ids = []
+        params = {'limit': 2}
+        while True:
+            data = self.history(self.channels[0].pk, **params).json()
+            ids += [message['id'] for message in data['results']]
+            if data['next'] is None:
+                break
+            params['before'] = data['next']
+        newest_first = sorted(self.messages, key=lambda m: (m.timestamp, m.id), reverse=True)
+        self.assertEqual(ids, [str(message.id) for message in newest_first])
+
+    def test_flat_results_render_ids(self):
+        data = self.history(self.channels[0].pk, flat=1).json()
+        self.assertEqual(data['results'][0]['channel'], self.channels[0].pk)
+
+    def test_only_members_can_read(self):
+        channel = Channel.objects.create(name="private", created_by=self.users[1])
+        self.assertEqual(self.history(channel.pk).status_code, 403)
+        self.assertEqual(self.history(channel.pk + 1000).status_code, 404)
+
+
+class MessagePostTests(FakeRedisMixin, APITestCase):
+
+    def post(self, content):
+        data = {'channel': self.channels[0].pk, 'content': content}
+        response = self.client.post(reverse('message-list'), data, secure=True)
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def test_message_is_sequenced_indexed_and_buffered(self):
+        data = self.post("fresh news")
+        self.assertEqual(data['content'], "fresh news")
+        self.assertEqual(data['seq'], 6)
+        self.assertTrue(MessageSearchToken.objects.filter(message_id=data['id']).exists())
+        events, complete = async_to_sync(recent.get_recent_messages().replay)(self.channels[0].pk, 5)
+        self.assertEqual([event['id'] for event in events], [data['id']])
+
+    def test_redis_failure_after_saving_still_succeeds(self):
+        with mock.patch.object(read_state.ReadStateStore, 'record_message', side_effect=RedisError):
+            data = self.post("fresh news")
+        self.assertTrue(Message.objects.filter(pk=data['id']).exists())
+
+
+class ReplayTests(FakeRedisMixin, TransactionTestCase):
+    """Replay reads the database from its thread pool, so these tests commit for real."""
+
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_user("user")
+        self.channel = Channel.objects.create(name="channel", created_by=user)
+        cipher = get_cipher()
+        start = now() - timedelta(days=1)
+        self.messages = [
+            Message.objects.create(
+                channel=self.channel, sender=user, content=cipher.encrypt(f"m{seq}"), seq=seq,
+                timestamp=start + timedelta(minutes=seq),
+            )
+            for seq in range(1, 7)
+        ]
+        self.buffer = recent.get_recent_messages()
+        self.buffer.add(self.channel.pk, self.messages[3:])
+
+    def replay(self, after_seq):
+        events, complete = async_to_sync(self.buffer.replay)(self.channel.pk, after_seq)
+        self.assertTrue(complete)
+        return [event['message'] for event in events]
+
+    def test_buffer_hit(self):
+        self.assertEqual(self.replay(3), ["m4", "m5", "m6"])
+        self.assertEqual(self.buffer.stats()["replay"], {"hits": 1, "misses": 0})
+
+    def test_gap_is_read_from_the_database(self):
+        self.assertEqual(self.replay(1), ["m2", "m3", "m4", "m5", "m6"])
+        self.assertEqual(self.buffer.stats()["replay"], {"hits": 0, "misses": 1})
+
+    def test_gap_is_read_from_the_archive(self):
+        archive_channel(self.channel.pk, self.messages[2].timestamp + timedelta(seconds=1))
+        self.assertEqual(Message.objects.count(), 3)
+        self.assertEqual(self.replay(0), ["m1", "m2", "m3", "m4", "m5", "m6"])
+
+    def test_replay_is_capped(self):
+        self.buffer.replay_limit = 2
+        events, complete = async_to_sync(self.buffer.replay)(self.channel.pk, 3)
+        self.assertEqual([event['seq'] for event in events], [4, 5])
+        self.assertFalse(complete)
+
+
+class RotateMessageKeysTests(FakeRedisMixin, TestCase):
+
+    def test_rotates_encrypts_plaintext_and_clears_buffers(self):
+        old, new = Fernet.generate_key(), Fernet.generate_key()
+        user = User.objects.create_user("user")
+        channel = Channel.objects.create(name="channel", created_by=user)
+        encrypted = Message.objects.create(
+            channel=channel, sender=user, content=MessageCipher([old]).encrypt("secret"), seq=1,
+        )
+        legacy = Message.objects.create(channel=channel, sender=user, content="legacy", seq=2)
+        recent.get_recent_messages().add(channel.pk, [encrypted])
+
+        with mock.patch.object(crypto, '_cipher', MessageCipher([new, old])):
+            call_command('rotate_message_keys', stdout=StringIO(), stderr=StringIO())
+
+        cipher = MessageCipher([new])
+        encrypted.refresh_from_db()
+        legacy.refresh_from_db()
+        self.assertEqual(cipher.decrypt(encrypted.content), "secret")
+        self.assertEqual(cipher.decrypt(legacy.content), "legacy")
+        self.assertEqual(redis_pool.get_sync_redis().keys(recent.recent_key("*")), [])
+
+
+class ArchiveTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("user")
+        self.channel = Channel.objects.create(name="channel", created_by=self.user)
+        start = now() - timedelta(days=30)
+        self.messages = [
+            Message.objects.create(
+                channel=self.channel, sender=self.user, content="", seq=seq, timestamp=start + timedelta(hours=seq),
+            )
+            for seq in range(1, 11)
+        ]
+        self.assertEqual(archive_channel(self.channel.pk, self.messages[5].timestamp, chunk_size=2), 5)
+
+    def paginate(self, **params):
+        request = Request(RequestFactory().get('/', params))
+        paginator = MessageCursorPaginator(archive=ChannelArchive(self.channel.pk))
+        return paginator.paginate(Message.objects.filter(channel=self.channel), request)
+
+    def test_history_continues_into_the_archive(self):
+        seqs = []
+        page = self.paginate(limit=3)
+        while True:
+            seqs += [message.seq for message in page['results']]
+            if page['next'] is None:
+                break
+            page = self.paginate(limit=3, before=page['next'])
+        self.assertEqual(seqs, list(range(10, 0, -1)))
+
+    def test_newer_pages_start_in_the_archive(self):
+        cursor = MessageCursorPaginator.encode_cursor(self.messages[1])
+        page = self.paginate(limit=5, after=cursor)
+        self.assertEqual([message.seq for message in page['results']], [7, 6, 5, 4, 3])
+
+    def test_counts_include_archived_messages(self):
+        ChannelMembership.objects.create(
+            channel=self.channel, user=self.user, last_seen=self.messages[2].timestamp - timedelta(minutes=1),
+        )
+        self.assertEqual(read_state.get_read_state().unread_counts(self.user.pk), {self.channel.pk: 8})
+        read_state.get_read_state().mark_read(self.user.pk, self.channel.pk)
+        self.assertEqual(read_state.get_read_state().unread_counts(self.user.pk), {self.channel.pk: 0})
+        self.assertEqual(redis_pool.get_sync_redis().hget(read_state.MESSAGE_COUNTS_KEY, self.channel.pk), "10")
+
+    def test_messages_saved_without_a_seq_get_the_next_one(self):
+        message = Message.objects.create(channel=self.channel, sender=self.user, content="")
+        self.assertEqual(message.seq, 11)
+
+
+class MembershipCacheTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("user")
+        self.channel = Channel.objects.create(name="channel", created_by=self.user)
+
+    def test_saving_or_deleting_a_membership_invalidates_it(self):
+        cache = membership.get_membership_cache()
+        self.assertEqual(cache.get_status(self.user.pk, self.channel.pk), membership.NOT_MEMBER)
+        joined = ChannelMembership.objects.create(channel=self.channel, user=self.user)
+        self.assertEqual(cache.get_status(self.user.pk, self.channel.pk), membership.MEMBER)
+        joined.delete()
+        self.assertEqual(cache.get_status(self.user.pk, self.channel.pk), membership.NOT_MEMBER)
+
+    def test_other_processes_read_the_invalidated_entry_from_the_database(self):
+        other = membership.MembershipCache()
+        self.assertEqual(other.get_status(self.user.pk, self.channel.pk), membership.NOT_MEMBER)
+        ChannelMembership.objects.create(channel=self.channel, user=self.user)
+        with self.assertNumQueries(1):
+            self.assertEqual(membership.MembershipCache().get_status(self.user.pk, self.channel.pk), membership.MEMBER)
+        with self.assertNumQueries(0):
+            self.assertEqual(membership.MembershipCache().get_status(self.user.pk, self.channel.pk), membership.MEMBER)
+
+    def test_missing_channels_are_not_cached(self):
+        cache = membership.get_membership_cache()
+        missing = self.channel.pk + 1000
+        self.assertEqual(cache.get_status(self.user.pk, missing), membership.NO_CHANNEL)
+        with self.assertNumQueries(1):
+            cache.get_status(self.user.pk, missing)
+
+
+class PresenceTests(FakeRedisMixin, TransactionTestCase):
+    """The aggregator reads memberships from the database thread pool, so these tests commit for real."""
+
+    def setUp(self):
+        super().setUp()
+        self.users = [User.objects.create_user(f"user{i}") for i in range(2)]
+        self.channel = Channel.objects.create(name="channel", created_by=self.users[0])
+        for user in self.users:
+            ChannelMembership.objects.create(channel=self.channel, user=user)
+        # New memberships flag their users for the next tick.
+        redis_pool.get_sync_redis().delete(presence.CHANGED_KEY)
+        self.store = presence.PresenceStore()
+        self.aggregator = presence.PresenceAggregator(self.store)
+        patch = mock.patch('chat.presence.get_fanout_hub')
+        self.hub = patch.start().return_value
+        self.hub.send = mock.AsyncMock()
+        self.addCleanup(patch.stop)
+
+    async def tick(self):
+        self.hub.send.reset_mock()
+        await redis_pool.get_redis().delete(presence.TICK_LOCK_KEY)
+        await self.aggregator.tick()
+        return {group: event for (group, event), _ in self.hub.send.call_args_list}
+
+    def channel_update(self, sent):
+        return json.loads(sent[presence.channel_group(self.channel.pk)]["text"])
+
+    async def test_changes_are_broadcast_and_kept_in_the_channel_set(self):
+        user = self.users[0].pk
+        await self.store.connect("tab-1", user)
+        await self.store.connect("tab-2", user)
+        sent = await self.tick()
+        self.assertEqual(json.loads(sent[presence.PRESENCE_GROUP]["text"])["logged_in_users"], 1)
+        self.assertEqual(self.channel_update(sent)["online"], [user])
+        self.assertEqual(await self.store.online_in_channel(self.channel.pk), {user})
+
+        # Another tab is still open.
+        await self.store.disconnect("tab-1", user)
+        self.assertEqual(await self.tick(), {})
+        self.assertTrue(await self.store.is_online(user))
+
+        await self.store.disconnect("tab-2", user)
+        self.assertEqual(self.channel_update(await self.tick())["offline"], [user])
+        self.assertEqual(await self.store.online_in_channel(self.channel.pk), set())
+
+    async def test_expired_connections_are_swept(self):
+        user = self.users[1].pk
+        with mock.patch('chat.presence.time.time', return_value=time.time() - self.store.ttl - 1):
+            await self.store.connect("tab-1", user)
+        self.assertFalse(await self.store.is_online(user))
+        sent = await self.tick()
+        self.assertEqual(self.channel_update(sent)["offline"], [user])
+        self.assertIsNone(await redis_pool.get_redis().zscore(presence.ONLINE_USERS_KEY, user))
+
+
+class ReadStateTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("user")
+        self.channel = Channel.objects.create(name="channel", created_by=self.user)
+        start = now() - timedelta(hours=1)
+        self.membership = ChannelMembership.objects.create(channel=self.channel, user=self.user, last_seen=start)
+        for seq in range(1, 4):
+            self.send(seq, start + timedelta(minutes=seq))
+        self.read_state = read_state.get_read_state()
+
+    def send(self, seq, timestamp=None):
+        Message.objects.create(channel=self.channel, sender=self.user, content="", seq=seq, timestamp=timestamp or now())
+
+    def unread(self):
+        return self.read_state.unread_counts(self.user.pk)[self.channel.pk]
+
+    def test_counters_are_seeded_then_incremented(self):
+        self.assertEqual(self.unread(), 3)
+        self.send(4)
+        self.read_state.record_message(self.channel.pk)
+        self.assertEqual(self.unread(), 4)
+
+    def test_mark_read_is_flushed_to_last_seen(self):
+        self.read_state.mark_read(self.user.pk, self.channel.pk)
+        self.assertEqual(self.unread(), 0)
+        self.assertEqual(self.read_state.flush(), 1)
+        self.membership.refresh_from_db()
+        self.assertGreater(self.membership.last_seen, now() - timedelta(minutes=1))
+        self.assertEqual(self.read_state.flush(), 0)
+
+    def test_message_counted_during_a_seed_leaves_the_channel_unseeded(self):
+        stored_counts = self.read_state._stored_counts
+
+        def racing_count(channel_ids):
+            counts = stored_counts(channel_ids)
+            # Committed and counted after the database count was read.
+            self.send(4)
+            self.read_state.record_message(self.channel.pk)
+            return counts
+
+        with mock.patch.object(self.read_state, '_stored_counts', side_effect=racing_count):
+            self.assertEqual(self.read_state._message_counts([self.channel.pk]), {self.channel.pk: 3})
+        self.assertIsNone(redis_pool.get_sync_redis().hget(read_state.MESSAGE_COUNTS_KEY, self.channel.pk))
+        self.assertEqual(self.read_state._message_counts([self.channel.pk]), {self.channel.pk: 4})
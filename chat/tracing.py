@@ -0,0 +1,220 @@
+"""
+Opt-in tracing of slow chat messages and API requests.
+
+A trace times one unit of work (a WebSocket frame or an HTTP request) and
+the spans inside it: sanitising, encryption, database, channel layer. Traces
+slower than the threshold are logged as one JSON line each. Tracing is off
+by default and switched at runtime for every worker through Redis with the
+``tracing`` management command; when off, ``span()`` costs one context
+variable lookup.
+"""
+import asyncio
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from chat.lifespan import on_shutdown
+from chat.metrics import EVENT_LOOP_LAG_SECONDS
+from chat.redis_pool import get_redis, get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+CONFIG_KEY = "tracing:config"
+
+_current = ContextVar("chat_trace", default=None)
+
+
+class Trace:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.spans = []
+        self.started = time.perf_counter()
+
+    def as_dict(self, duration):
+        return {
+            "trace": self.name,
+            "duration_ms": round(duration * 1000, 3),
+            **self.attrs,
+            "spans": [
+                {"name": name, "start_ms": round(start * 1000, 3), "duration_ms": round(elapsed * 1000, 3)}
+                for name, start, elapsed in self.spans
+            ],
+        }
+
+
+@contextmanager
+def span(name):
+    """Time a stage of the current trace; does nothing outside a trace."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append((name, started - trace.started, time.perf_counter() - started))
+
+
+class Tracer:
+    """
+    Per-process tracing switch and slow-trace logger.
+
+    The configuration (``enabled``, ``threshold_ms``, ``sample_rate``) lives in
+    a Redis hash and is re-read every ``refresh_interval`` seconds, so turning
+    tracing on reaches every worker without a restart. A background task on
+    the event loop also measures how late its own wake-ups are and reports
+    that as event-loop lag.
+    """
+
+    def __init__(self, enabled=False, threshold_ms=250, sample_rate=1.0, refresh_interval=5.0, lag_interval=0.5):
+        self.enabled = enabled
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        self.refresh_interval = refresh_interval
+        self.lag_interval = lag_interval
+        self.traced = 0
+        self.slow = 0
+        self.max_lag = 0.0
+        self._refreshed_at = 0
+        self._task = None
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "traced": self.traced,
+            "slow": self.slow,
+            "max_lag_ms": round(self.max_lag * 1000, 3),
+        }
+
+    @contextmanager
+    def trace(self, name, **attrs):
+        """Trace the enclosed block if tracing is on and the block is sampled."""
+        if not self.enabled or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            yield None
+            return
+        trace = Trace(name, attrs)
+        token = _current.set(trace)
+        try:
+            yield trace
+        finally:
+            _current.reset(token)
+            self.finish(trace)
+
+    def finish(self, trace):
+        duration = time.perf_counter() - trace.started
+        self.traced += 1
+        if duration * 1000 >= self.threshold_ms:
+            self.slow += 1
+            logger.warning("slow %s %s", trace.name, json.dumps(trace.as_dict(duration), default=str))
+
+    def apply(self, config):
+        if not config:
+            return
+        if "enabled" in config:
+            self.enabled = config["enabled"] == "1"
+        self.threshold_ms = float(config.get("threshold_ms", self.threshold_ms))
+        self.sample_rate = float(config.get("sample_rate", self.sample_rate))
+
+    def maybe_refresh(self):
+        """Re-read the configuration from synchronous code, at most once per interval."""
+        if time.monotonic() - self._refreshed_at < self.refresh_interval:
+            return
+        self._refreshed_at = time.monotonic()
+        try:
+            self.apply(get_sync_redis().hgetall(CONFIG_KEY))
+        except RedisError:
+            logger.warning("Failed to read tracing configuration.")
+
+    def ensure_started(self):
+        """Watch the configuration and the event loop's lag from the running loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            on_shutdown(self.stop)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if loop.time() - self._refreshed_at >= self.refresh_interval:
+                self._refreshed_at = loop.time()
+                try:
+                    self.apply(await get_redis().hgetall(CONFIG_KEY))
+                except RedisError:
+                    logger.warning("Failed to read tracing configuration.")
+
+            expected = loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            lag = max(0.0, loop.time() - expected)
+            EVENT_LOOP_LAG_SECONDS.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if self.enabled and lag * 1000 >= self.threshold_ms:
+                logger.warning("event loop lag %s", json.dumps({"lag_ms": round(lag * 1000, 3)}))
+
+
+def set_config(enabled=None, threshold_ms=None, sample_rate=None):
+    """Change the tracing configuration of every worker."""
+    config = {}
+    if enabled is not None:
+        config["enabled"] = "1" if enabled else "0"
+    if threshold_ms is not None:
+        config["threshold_ms"] = threshold_ms
+    if sample_rate is not None:
+        config["sample_rate"] = sample_rate
+    if config:
+        get_sync_redis().hset(CONFIG_KEY, mapping=config)
+    return get_sync_redis().hgetall(CONFIG_KEY)
+
+
+class TracingMiddleware:
+    """Traces API requests, with a span per database query."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        tracer = get_tracer()
+        tracer.maybe_refresh()
+        if not tracer.enabled or not request.path.startswith("/api/"):
+            return self.get_response(request)
+
+        from django.db import connection
+
+        def query(execute, sql, params, many, context):
+            with span("db"):
+                return execute(sql, params, many, context)
+
+        with tracer.trace("http", method=request.method, path=request.path) as trace:
+            if trace is None:
+                return self.get_response(request)
+            with connection.execute_wrapper(query):
+                response = self.get_response(request)
+            match = request.resolver_match
+            trace.attrs["view"] = match.url_name if match is not None else None
+            trace.attrs["status"] = response.status_code
+        return response
+
+
+_tracer = None
+
+
+def get_tracer():
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(
+            enabled=settings.CHAT_TRACING,
+            threshold_ms=settings.CHAT_TRACING_THRESHOLD_MS,
+            sample_rate=settings.CHAT_TRACING_SAMPLE_RATE,
+        )
+    return _tracer
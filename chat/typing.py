@@ -0,0 +1,52 @@
+import time
+
+from django.conf import settings
+
+from chat.redis_pool import get_redis
+
+
+def typing_key(channel_id):
+    return f"typing:{channel_id}"
+
+
+class TypingTracker:
+    """
+    Ephemeral typing state per channel, kept in Redis and never in the database.
+
+    Each channel has a sorted set of user ids scored by when their typing state
+    expires. A start event only needs broadcasting when the user was not already
+    typing, so repeated keystrokes just push the expiry forward; clients are told
+    ``ttl`` so they can clear the indicator on their own if no stop event arrives.
+    """
+
+    def __init__(self, ttl=5.0, throttle=2.0):
+        self.ttl = ttl
+        self.throttle = throttle
+
+    async def start(self, channel_id, user_id):
+        """Mark the user as typing. Returns True if this is a new typing state."""
+        now = time.time()
+        key = typing_key(channel_id)
+        pipeline = get_redis().pipeline()
+        pipeline.zscore(key, user_id)
+        pipeline.zadd(key, {user_id: now + self.ttl})
+        pipeline.expire(key, int(self.ttl) + 1)
+        previous, _, _ = await pipeline.execute()
+        return previous is None or previous < now
+
+    async def stop(self, channel_id, user_id):
+        """Clear the user's typing state. Returns True if they were typing."""
+        return bool(await get_redis().zrem(typing_key(channel_id), user_id))
+
+    async def typing_user_ids(self, channel_id):
+        return [int(user_id) for user_id in await get_redis().zrangebyscore(typing_key(channel_id), time.time(), "+inf")]
+
+
+_tracker = None
+
+
+def get_typing_tracker():
+    global _tracker
+    if _tracker is None:
+        _tracker = TypingTracker(ttl=settings.CHAT_TYPING_TTL, throttle=settings.CHAT_TYPING_THROTTLE)
+    return _tracker
@@ -2,9 +2,11 @@ from django.urls import path
 
 from .api import (
     TeamListAPIView, TeamDetailAPIView,
-    ChannelListAPIView, ChannelDetailAPIView,
+    ChannelListAPIView, ChannelDetailAPIView, ChannelPresenceAPIView,
     ChannelMembershipListAPIView, ChannelMembershipDetailAPIView,
-    MessageListAPIView, MessageDetailAPIView,
+    ChannelReadAPIView, UnreadCountAPIView,
+    MessageListAPIView, MessageDetailAPIView, ChannelMessageListAPIView,
+    MessageSearchAPIView,
 )
 
 urlpatterns = [
@@ -13,10 +15,16 @@ urlpatterns = [
 
     path('channels/', ChannelListAPIView.as_view(), name='channel-list'),
     path('channels/<int:pk>/', ChannelDetailAPIView.as_view(), name='channel-detail'),
+    path('channels/<int:pk>/presence/', ChannelPresenceAPIView.as_view(), name='channel-presence'),
+    path('channels/<int:pk>/read/', ChannelReadAPIView.as_view(), name='channel-read'),
+    path('channels/<int:pk>/messages/', ChannelMessageListAPIView.as_view(), name='channel-message-list'),
 
     path('memberships/', ChannelMembershipListAPIView.as_view(), name='membership-list'),
     path('memberships/<int:pk>/', ChannelMembershipDetailAPIView.as_view(), name='membership-detail'),
+    path('unread/', UnreadCountAPIView.as_view(), name='unread-counts'),
 
     path('messages/', MessageListAPIView.as_view(), name='message-list'),
     path('messages/<uuid:pk>/', MessageDetailAPIView.as_view(), name='message-detail'),
+
+    path('search/', MessageSearchAPIView.as_view(), name='message-search'),
 ]
@@ -1,5 +1,13 @@
+import hmac
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.views import View
 from django.views.generic import TemplateView
 from django.contrib.auth.mixins import LoginRequiredMixin
+from redis.exceptions import RedisError
+
+from chat import metrics
 
 class ChatRoomView(LoginRequiredMixin, TemplateView):
     template_name = "chat/chat_room.html"
@@ -13,3 +21,18 @@ class ChatRoomView(LoginRequiredMixin, TemplateView):
         # Pass the username for display purposes
         context['username'] = self.request.user.username
         return context
+
+
+class MetricsView(View):
+    """Prometheus scrape endpoint with the metrics of every live worker process summed."""
+
+    def get(self, request):
+        token = settings.CHAT_METRICS_TOKEN
+        if token and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+            return HttpResponse(status=401)
+        try:
+            snapshots = metrics.get_publisher().collect()
+        except RedisError:
+            # Better this process alone than nothing.
+            snapshots = [metrics.snapshot()]
+        return HttpResponse(metrics.render(snapshots), content_type="text/plain; version=0.0.4; charset=utf-8")